@@ -1,11 +1,11 @@
 import json
 
-from flask import Blueprint, request, g
+from flask import Blueprint, request, g, Response, stream_with_context
 from flask_login import current_user
 from flask_login import login_required
 
 from . import dbannotations
-from .utils import debug, getdoc
+from .utils import debug, getdoc, stream_ndjson
 from .autodoc import auto
 
 
@@ -452,7 +452,7 @@ def get_annotation():
         if annotationid is None:
             return(getdoc(cfunc))
     annotationid = int(annotationid)
-    err, annotation = dbannotations.GetAnnotationsFromID(g.con, g.cur, annotationid)
+    err, annotation = dbannotations.GetAnnotationsFromID(g.con, g.cur, annotationid, userid=current_user.user_id)
     if err:
         debug(6, err)
         return ('Problem geting details. error=%s' % err, 400)
@@ -513,6 +513,9 @@ def get_all_annotations():
     URL Params:
     Data Params: JSON
         {
+            format : str (optional)
+                'json' (default) to return all the annotations in one json object
+                'ndjson' to stream the annotations (newline delimited json - one annotation json object per line, ordered by annotationid)
         }
     Success Response:
         Code : 200
@@ -521,12 +524,22 @@ def get_all_annotations():
             annotations : list of annotation
             See annotations/get_annotation() for details
         }
+        for format='ndjson', each line is an annotation object (see annotations/get_annotation()).
+        if an error is encountered while streaming, the last line is {"error": str}
     Details :
         Validation:
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
     debug(3, 'get_all_annotations', request)
+    alldat = request.get_json(silent=True)
+    if alldat is None:
+        alldat = request.args
+    fmt = alldat.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return('format %s not supported. options are: json, ndjson' % fmt, 400)
+    if fmt == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(dbannotations.iter_annotations(g.con, g.cur, userid=current_user.user_id))), mimetype='application/x-ndjson')
     err, annotations = dbannotations.GetAllAnnotations(g.con, g.cur, userid=current_user.user_id)
     if err:
         debug(6, err)
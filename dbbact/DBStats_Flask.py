@@ -3,6 +3,7 @@ from flask import Blueprint, g, request
 from .utils import debug
 from .autodoc import auto
 from . import dbstats
+from . import annotationcache
 
 
 DBStats_Flask_Obj = Blueprint('DBStats_Flask_Obj', __name__, template_folder='templates')
@@ -43,3 +44,35 @@ def dbdstats():
     errmsg = "error encountered %s" % err
     debug(6, errmsg)
     return (errmsg, 400)
+
+
+@DBStats_Flask_Obj.route('/stats/cache', methods=['GET'])
+@auto.doc()
+def cache_stats():
+    """
+    Title: Get statistics about the annotation cache
+    URL: /stats/cache
+    Method: GET
+    URL Params:
+    Data Params:
+     Success Response:
+        Code : 201
+        Content :
+        stats : dict
+        {
+            "enabled" : bool
+                True if the annotation cache is enabled (DBBACT_ANNOTATION_CACHE is set)
+            "hits" : int
+                number of annotation entries found in the cache
+            "misses" : int
+                number of annotation entries not found in the cache (and computed from the database)
+            "entries" : int
+                number of entries currently in the cache
+            "max_entries" : int
+                maximal number of entries in the cache (least recently used entries are evicted)
+        }
+    Details:
+        The cache is shared by all the server workers, so the counters are for all the workers
+    """
+    debug(3, 'cache_stats', request)
+    return json.dumps({'stats': annotationcache.get_stats()})
@@ -1,8 +1,8 @@
 import json
-from flask import Blueprint, g, request
+from flask import Blueprint, g, request, Response, stream_with_context
 from flask_login import current_user
 
-from .utils import getdoc, debug
+from .utils import getdoc, debug, stream_ndjson
 from .autodoc import auto
 from . import dbexperiments
 from . import dbannotations
@@ -232,6 +232,9 @@ def get_annotations():
         {
             "expId" : int
                 the experiment id
+            "format" : str (optional)
+                'json' (default) to return all the annotations in one json object
+                'ndjson' to stream the annotations (newline delimited json - one annotation json object per line)
         }
     Success Response:
         Code : 200
@@ -248,6 +251,8 @@ def get_annotations():
                 "private" : str
             }
         }
+        for format='ndjson', each line is an annotation object (ordered by annotation id).
+        if an error is encountered while streaming, the last line is {"error": str}
     Details :
         Validation:
             If study is private, return only if user is authenticated and created the study. If user not authenticated, return experiment not found
@@ -261,8 +266,17 @@ def get_annotations():
     expid = alldat.get('expId')
     if expid is None:
         return('no expId supplied', 400)
+    fmt = alldat.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return('format %s not supported. options are: json, ndjson' % fmt, 400)
     # TODO: get userid
     userid = 0
+    if fmt == 'ndjson':
+        # test if experiment exists and not private (as in dbannotations.GetAnnotationsFromExpId())
+        if not dbexperiments.TestExpIdExists(g.con, g.cur, expid, userid):
+            debug(3, 'experiment %d does not exist' % expid)
+            return Response('', mimetype='application/x-ndjson')
+        return Response(stream_with_context(stream_ndjson(dbannotations.iter_annotations(g.con, g.cur, userid=userid, expid=expid))), mimetype='application/x-ndjson')
     err, annotations = dbannotations.GetAnnotationsFromExpId(g.con, g.cur, expid, userid)
     if err:
         return(err, 400)
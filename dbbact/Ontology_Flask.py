@@ -1,6 +1,6 @@
 import json
 from flask import Blueprint, g, request
-from flask_login import login_required
+from flask_login import login_required, current_user
 from . import dbontology
 from .utils import getdoc, debug
 from .autodoc import auto
@@ -163,11 +163,22 @@ def get_ontology_annotations():
         {
             term : str
                 the ontology term to get the annotations for
+            descendants : str (optional)
+                'false' (default) to get the annotations containing the term (as an annotation detail or a parent of one)
+                'true' to get the annotations with an annotation detail which is the term or any of its descendants (using the ontology closure table)
+            offset : int (optional)
+                only for descendants='true'. number of annotations (ordered by annotationid) to skip. default is 0
+            limit : int (optional)
+                only for descendants='true'. maximal number of annotations to return. default is all
+            count_only : str (optional)
+                only for descendants='true'. 'true' to return only the number of matching annotations. default is 'false'
         }
     Success Response:
         Code : 200
         Content : JSON
         {
+            "count" : int
+                only for descendants='true'. the total number of matching annotations (regardless of offset/limit)
             "annotations" : list of
                 {
                     "annotationid" : int
@@ -219,7 +230,19 @@ def get_ontology_annotations():
     ontology_term = request.args.get('term')
     if ontology_term is None:
         return(getdoc(cfunc))
-    err, annotations = dbontology.GetTermAnnotations(g.con, g.cur, ontology_term)
+    if request.args.get('descendants', 'false').lower() == 'true':
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', None, type=int)
+        count_only = request.args.get('count_only', 'false').lower() == 'true'
+        err, count, annotations = dbontology.GetTermDescendantAnnotations(g.con, g.cur, ontology_term, userid=current_user.user_id,
+                                                                          offset=offset, limit=limit, count_only=count_only)
+        if err:
+            debug(6, err)
+            return ('Problem geting details. error=%s' % err, 400)
+        if count_only:
+            return json.dumps({'count': count})
+        return json.dumps({'count': count, 'annotations': annotations})
+    err, annotations = dbontology.GetTermAnnotations(g.con, g.cur, ontology_term, userid=current_user.user_id)
     if err:
         debug(6, err)
         return ('Problem geting details. error=%s' % err, 400)
@@ -378,14 +401,14 @@ def get_ontology_term_stats():
     return json.dumps({'term_info': term_info})
 
 
-@Ontology_Flask_Obj.route('/ontology/get_term_pair_count', methods=['GET'])
+@Ontology_Flask_Obj.route('/ontology/get_term_pair_count', methods=['GET', 'POST'])
 @auto.doc()
 def get_term_pair_count():
     """
     Title: get_term_pair_count
     Description : Get statistics about ontology term pair (i.e. "feces+homo sapiens") (in how many experiments it appears)
     URL: ontology/get_term_pair_count
-    Method: GET
+    Method: GET/POST
     URL Params:
     Data Params: JSON
         {
@@ -397,18 +420,23 @@ def get_term_pair_count():
         Content :
         {
             term_count : dict of {term, float}
-                The total number of experiments each term pair appears in
+                The total number of experiments each term pair appears in (0 for pairs not found)
         }
     Details :
+        All the term pairs are looked up in one batch (using the worker term pair index, see termpairs.py),
+        so a request can contain thousands of pairs.
+        Term pairs are in the format 'term1+term2' where term1 is alphabetically before term2.
         Validation:
     """
     debug(3, 'get_term_pair_count', request)
     cfunc = get_term_pair_count
     alldat = request.get_json()
+    if alldat is None:
+        return(getdoc(cfunc))
     term_pairs = alldat.get('term_pairs')
-    debug(1, 'get_term_pair_count for %d term pairs' % len(term_pairs))
     if term_pairs is None:
         return(getdoc(cfunc))
+    debug(1, 'get_term_pair_count for %d term pairs' % len(term_pairs))
     term_count = dbontology.get_term_pairs_count(g.con, g.cur, term_pairs)
     # if err:
     #     debug(6, err)
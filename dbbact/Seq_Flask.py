@@ -1,9 +1,11 @@
 import json
-from flask import Blueprint, request, g
+from flask import Blueprint, request, g, Response, stream_with_context
 from flask_login import login_required, current_user
 from . import dbsequences
 from . import dbannotations
 from . import dbontology
+from . import taxindex
+from . import annotationformat
 from .utils import debug, getdoc
 from .autodoc import auto
 # NOTE: local flask_cors module, not pip installed!
@@ -12,6 +14,9 @@ from .autodoc import auto
 Seq_Flask_Obj = Blueprint('Seq_Flask_Obj', __name__, template_folder='templates')
 # CORS(Seq_Flask_Obj)
 
+# number of seqids above which /sequences/get_info streams the response
+STREAM_MIN_SEQIDS = 10000
+
 
 @Seq_Flask_Obj.route('/sequences/add', methods=['POST', 'GET'])
 @auto.doc()
@@ -83,6 +88,13 @@ def get_sequenceid():
             "no_longer" : bool (optional)
                 False (default) to get also longer sequences from DB if matching on query length.
                 True to get only sequences not longer than the query
+            "kmer_search" : bool (optional)
+                False (default) to match only sequences sharing the prefix with the query (query must be at least 100bp).
+                True to match also sequences overlapping the query (query can be shorter or trimmed at a different position).
+                no_shorter and no_longer are ignored
+            "max_mismatches" : int (optional)
+                if supplied, return the closest database sequences with at most max_mismatches mismatches to the query
+                (on their overlap). no_shorter, no_longer and kmer_search are ignored
         }
     Success Response:
         Code : 201
@@ -91,6 +103,8 @@ def get_sequenceid():
             "seqId" : list of int
                 the sequence ids, or []] if doesn't exists
                 Note: can be more than 1 id since we are looking for
+            "distance" : int
+                only if max_mismatches is supplied - the number of mismatches of the returned sequences
         }
     Details:
         Validation:
@@ -102,10 +116,19 @@ def get_sequenceid():
     sequence = alldat.get('sequence')
     no_shorter = alldat.get('no_shorter', False)
     no_longer = alldat.get('no_longer', False)
+    kmer_search = alldat.get('kmer_search', False)
+    max_mismatches = alldat.get('max_mismatches')
     if sequence is None:
         return(getdoc(cfunc))
 
-    err, seqid = dbsequences.GetSequenceId(g.con, g.cur, sequence=sequence, no_shorter=no_shorter, no_longer=no_longer)
+    if max_mismatches is not None:
+        err, seqids, distances = dbsequences.get_sequences_ids_approx(g.con, g.cur, [sequence], max_mismatches=max_mismatches)
+        if err:
+            return(err, 400)
+        if len(seqids[0]) == 0:
+            return('sequence %s not found' % sequence, 400)
+        return json.dumps({"seqId": seqids[0], "distance": distances[0]})
+    err, seqid = dbsequences.GetSequenceId(g.con, g.cur, sequence=sequence, no_shorter=no_shorter, no_longer=no_longer, kmer_search=kmer_search)
     if err:
         return(err, 400)
     debug(2, 'found sequences')
@@ -151,14 +174,52 @@ def get_sequenceid_list():
     if sequences is None:
         return(getdoc(cfunc))
 
-    out_list = []
-    for cseq in sequences:
-        err, seqid = dbsequences.GetSequenceId(g.con, g.cur, sequence=cseq, no_shorter=no_shorter, no_longer=no_longer)
-        if err:
-            debug(4, 'Sequence %s not found from get_sequenceid_list' % cseq)
-            seqid = []
-            # return(err, 400)
-        out_list.append(seqid)
+    err, out_list = dbsequences.get_sequences_ids_bulk(g.con, g.cur, sequences, no_shorter=no_shorter, no_longer=no_longer)
+    if err:
+        return(err, 400)
+    debug(2, 'found sequences')
+    return json.dumps({"seqIds": out_list})
+
+
+@Seq_Flask_Obj.route('/sequences/getid_hash_list', methods=['GET'])
+@auto.doc()
+def get_sequenceid_hash_list():
+    """
+    Title: Get dbbact ids for a list of sequence md5 hashes
+    URL: /sequences/getid_hash_list
+    Method: GET
+    URL Params:
+    Data Params: JSON
+        {
+            "hashes" : list of str
+                the md5 hex digests of the (upper case) sequences to look for
+            "hash_type" : str (optional)
+                'full' to match the whole sequence, '150' / '100' to match the first 150 / 100 bases,
+                or None (default) to match any of them
+        }
+    Success Response:
+        Code : 201
+        Content :
+        {
+            "seqIds" : list of list of int
+                the sequence ids matching each hash
+        }
+    Details:
+        Validation:
+        Action:
+    """
+    cfunc = get_sequenceid_hash_list
+    alldat = request.get_json()
+    if alldat is None:
+        return(getdoc(cfunc))
+    hashes = alldat.get('hashes')
+    hash_type = alldat.get('hash_type')
+    if hashes is None:
+        return(getdoc(cfunc))
+
+    err, out_list = dbsequences.get_sequences_ids_from_hashes(g.con, g.cur, hashes, hash_type=hash_type)
+    if err:
+        return(err, 400)
     debug(2, 'found sequences')
     return json.dumps({"seqIds": out_list})
 
@@ -430,6 +491,9 @@ def get_fast_annotations():
         {
             sequences : list of str ('ACGT')
                 the list of sequence strings to query the database (can be any length)
+            hashes : list of str (optional)
+                instead of sequences - the md5 hex digests of the (upper case) query sequences (full sequence / first 150 / first 100 bases).
+                all results are ordered by the hashes
             region : int (optional)
                 the region id (default=1 which is V4 515F 806R)
             get_term_info: bool (optional)
@@ -440,6 +504,18 @@ def get_fast_annotations():
                 True (default) to get the parent terms for each annotation ontology term, False to just get tge annotation terms
             get_all_exp_annotations: bool (optional)
                 True (default) to get all the annotations from each experiment containing one annotation with the sequence, False to just get the annotations with the sequence
+            kmer_search: bool (optional)
+                False (default) to match only database sequences sharing the prefix with the query sequence.
+                True to match also database sequences overlapping the query (query can be shorter than 100bp or trimmed at a different position)
+            max_mismatches: int (optional)
+                if supplied, use for each query sequence the closest database sequences with at most max_mismatches mismatches
+                (instead of exact matching). kmer_search is ignored
+            format: str (optional)
+                'json' (default) to return the response described below.
+                'columnar' to return the annotation fields as parallel arrays and the sequence x annotation relation as CSR arrays (json).
+                'msgpack' same as 'columnar', encoded as msgpack with the integer arrays as raw int64 little-endian buffers
+                'npz' same as 'columnar', as a numpy .npz file
+                (see annotationformat.py for the columnar arrays. distances are -1 for sequences not found, and missing integer annotation fields are -1)
     Success Response:
         Code : 200
         Content :
@@ -504,6 +580,9 @@ def get_fast_annotations():
             }
             taxonomy : list of str
             The dbbact assigned taxonomy for each sequence (ordered in the same order as query sequences)
+            distances : list of int or None
+            Only if max_mismatches is supplied. The number of mismatches of the matched database sequences for each query sequence
+            (ordered in the same order as query sequences, None if not found). 0 for the sequences found when using hashes
         }
     Details :
         Return a dict of details for all the annotations associated with at least one of the sequences used as input, and a list of seqpos and the associated annotationids describing it
@@ -518,19 +597,53 @@ def get_fast_annotations():
     if alldat is None:
         return(getdoc(cfunc))
     sequences = alldat.get('sequences')
-    if sequences is None:
+    hashes = alldat.get('hashes')
+    if sequences is None and hashes is None:
         return('sequences parameter missing', 400)
     region = alldat.get('region')
     get_term_info = alldat.get('get_term_info', True)
     get_taxonomy = alldat.get('get_taxonomy', True)
     get_parents = alldat.get('get_parents', True)
     get_all_exp_annotations = alldat.get('get_all_exp_annotations', True)
-    err, annotations, seqannotations, term_info, taxonomy = dbannotations.GetFastAnnotations(g.con, g.cur, sequences, region=region, userid=current_user.user_id, get_term_info=get_term_info, get_taxonomy=get_taxonomy, get_parents=get_parents, get_all_exp_annotations=get_all_exp_annotations)
+    kmer_search = alldat.get('kmer_search', False)
+    max_mismatches = alldat.get('max_mismatches')
+    fmt = alldat.get('format', 'json')
+    if fmt != 'json' and fmt not in annotationformat.FORMATS:
+        return('format %s not supported. options are: json, %s' % (fmt, ', '.join(annotationformat.FORMATS)), 400)
+    sids = None
+    if sequences is None:
+        sequences = hashes
+        err, sids = dbsequences.get_sequences_ids_from_hashes(g.con, g.cur, hashes, idprimer=region)
+        if err:
+            errmsg = 'error encountered while getting the fast annotations: %s' % err
+            debug(6, errmsg)
+            return(errmsg, 400)
+        # hash matches are exact
+        distances = dbsequences.get_exact_distances(sids)
+    elif max_mismatches is not None:
+        err, sids, distances = dbsequences.get_sequences_ids_approx(g.con, g.cur, sequences, max_mismatches=max_mismatches, idprimer=region)
+        if err:
+            errmsg = 'error encountered while getting the fast annotations: %s' % err
+            debug(6, errmsg)
+            return(errmsg, 400)
+    err, annotations, seqannotations, term_info, taxonomy = dbannotations.GetFastAnnotations(g.con, g.cur, sequences, region=region, userid=current_user.user_id, get_term_info=get_term_info, get_taxonomy=get_taxonomy, get_parents=get_parents, get_all_exp_annotations=get_all_exp_annotations, kmer_search=kmer_search, sids=sids)
     if err:
         errmsg = 'error encountered while getting the fast annotations: %s' % err
         debug(6, errmsg)
         return(errmsg, 400)
+    if fmt != 'json':
+        cols = annotationformat.fast_annotations_to_columnar(annotations, seqannotations, term_info, taxonomy, len(sequences))
+        if max_mismatches is not None:
+            cols['distances'] = [-1 if cdist is None else cdist for cdist in distances]
+        err, data, mimetype = annotationformat.encode_columnar(cols, fmt)
+        if err:
+            debug(6, err)
+            return(err, 400)
+        debug(2, 'returning fast annotations in %s format. %d annotations' % (fmt, len(annotations)))
+        return Response(data, mimetype=mimetype)
     res = {'annotations': annotations, 'seqannotations': seqannotations, 'term_info': term_info, 'taxonomy': taxonomy}
+    if max_mismatches is not None:
+        res['distances'] = distances
     debug(2, 'returning fast annotations. res len is %d' % len(res))
     return json.dumps(res)
 
@@ -549,6 +662,14 @@ def get_taxonomy_annotation_ids():
         {
             taxonomy : str
                 the taxonomy substring to look for
+            rank : str (optional)
+                the rank to look for the taxonomy in ('rootrank', 'domain', 'phylum', 'class', 'order', 'family' or 'genus').
+                if not supplied, look in all the ranks
+            match : str (optional)
+                the taxonomy match type:
+                'exact' (default) to match the whole taxonomy name (case insensitive)
+                'prefix' to match taxonomy names starting with taxonomy
+                'substring' to match taxonomy names containing taxonomy
         }
     Success Response:
         Code : 200
@@ -573,7 +694,13 @@ def get_taxonomy_annotation_ids():
     taxonomy = alldat.get('taxonomy')
     if taxonomy is None:
         return('taxonomy parameter missing', 400)
-    err, annotationids, seqids = dbsequences.GetTaxonomyAnnotationIDs(g.con, g.cur, taxonomy, userid=current_user.user_id)
+    rank = alldat.get('rank')
+    match = alldat.get('match', 'exact')
+    if rank is not None and rank not in taxindex.RANKS:
+        return('rank %s not supported' % rank, 400)
+    if match not in taxindex.MATCH_TYPES:
+        return('match %s not supported' % match, 400)
+    err, annotationids, seqids = dbsequences.GetTaxonomyAnnotationIDs(g.con, g.cur, taxonomy, userid=current_user.user_id, rank=rank, match=match)
     if err:
         errmsg = 'error encountered searching for taxonomy annotations for taxonomy %s: %s' % (taxonomy, err)
         debug(6, errmsg)
@@ -595,6 +722,14 @@ def get_taxonomy_annotations():
         {
             taxonomy : str
                 the taxonomy substring to look for
+            rank : str (optional)
+                the rank to look for the taxonomy in ('rootrank', 'domain', 'phylum', 'class', 'order', 'family' or 'genus').
+                if not supplied, look in all the ranks
+            match : str (optional)
+                the taxonomy match type:
+                'exact' (default) to match the whole taxonomy name (case insensitive)
+                'prefix' to match taxonomy names starting with taxonomy
+                'substring' to match taxonomy names containing taxonomy
         }
     Success Response:
         Code : 200
@@ -617,7 +752,13 @@ def get_taxonomy_annotations():
     taxonomy = alldat.get('taxonomy')
     if taxonomy is None:
         return('taxonomy parameter missing', 400)
-    err, annotations, seqids = dbsequences.GetTaxonomyAnnotations(g.con, g.cur, taxonomy, userid=current_user.user_id)
+    rank = alldat.get('rank')
+    match = alldat.get('match', 'exact')
+    if rank is not None and rank not in taxindex.RANKS:
+        return('rank %s not supported' % rank, 400)
+    if match not in taxindex.MATCH_TYPES:
+        return('match %s not supported' % match, 400)
+    err, annotations, seqids = dbsequences.GetTaxonomyAnnotations(g.con, g.cur, taxonomy, userid=current_user.user_id, rank=rank, match=match)
     if err:
         errmsg = 'error encountered searching for taxonomy annotations for taxonomy %s: %s' % (taxonomy, err)
         debug(6, errmsg)
@@ -772,6 +913,14 @@ def get_taxonomy_sequences():
         {
             taxonomy : str
                 the taxonomy substring to look for
+            rank : str (optional)
+                the rank to look for the taxonomy in ('rootrank', 'domain', 'phylum', 'class', 'order', 'family' or 'genus').
+                if not supplied, look in all the ranks
+            match : str (optional)
+                the taxonomy match type:
+                'exact' (default) to match the whole taxonomy name (case insensitive)
+                'prefix' to match taxonomy names starting with taxonomy
+                'substring' to match taxonomy names containing taxonomy
         }
     Success Response:
         Code : 200
@@ -802,7 +951,13 @@ def get_taxonomy_sequences():
     taxonomy = alldat.get('taxonomy')
     if taxonomy is None:
         return('taxonomy parameter missing', 400)
-    seqids = dbsequences.get_taxonomy_seqids(g.con, g.cur, taxonomy, userid=None)
+    rank = alldat.get('rank')
+    match = alldat.get('match', 'exact')
+    if rank is not None and rank not in taxindex.RANKS:
+        return('rank %s not supported' % rank, 400)
+    if match not in taxindex.MATCH_TYPES:
+        return('match %s not supported' % match, 400)
+    seqids = dbsequences.get_taxonomy_seqids(g.con, g.cur, taxonomy, userid=None, rank=rank, match=match)
     err, sequences = dbsequences.SeqFromID(g.con, g.cur, seqids)
     if err:
         return err, err
@@ -837,6 +992,9 @@ def get_sequence_info():
                         the taxonomy of the sequence (or '' if not present)
                 }
         }
+    Details:
+        For more than 10000 seqids, the response is streamed. If an error is encountered while streaming,
+        the response contains the sequences sent until the error, and an 'error' field (str) with the error
     Validation:
     """
     debug(3, 'get_sequence_info', request)
@@ -847,6 +1005,9 @@ def get_sequence_info():
     seqids = alldat.get('seqids')
     if seqids is None:
         return('seqids parameter missing', 400)
+    if isinstance(seqids, list) and len(seqids) > STREAM_MIN_SEQIDS:
+        debug(2, 'streaming sequence information for %d seqids' % len(seqids))
+        return Response(stream_with_context(_stream_seq_info(seqids)), mimetype='application/json')
     err, sequences = dbsequences.SeqFromID(g.con, g.cur, seqids)
     if err:
         errmsg = 'error encountered searching for sequence information: %s' % err
@@ -855,6 +1016,25 @@ def get_sequence_info():
     return json.dumps({'sequences': sequences})
 
 
+def _stream_seq_info(seqids):
+    '''Generate the /sequences/get_info json response ({'sequences': [...]}) one sequence at a time
+    If an error is encountered mid-stream, the sequences sent so far are closed and an 'error' field is added
+    (so the response is still valid json)
+    '''
+    yield '{"sequences": ['
+    try:
+        for idx, cinfo in enumerate(dbsequences.iter_seq_info(g.con, g.cur, seqids)):
+            if idx > 0:
+                yield ', ' + json.dumps(cinfo)
+            else:
+                yield json.dumps(cinfo)
+    except Exception as e:
+        debug(7, 'error encountered while streaming sequence information: %s' % e)
+        yield '], "error": %s}' % json.dumps(str(e))
+        return
+    yield ']}'
+
+
 @login_required
 @Seq_Flask_Obj.route('/sequences/get_string_annotations', methods=['GET', 'POST', 'OPTIONS'])
 # @crossdomain(origin='*', headers=['Content-Type'])
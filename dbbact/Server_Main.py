@@ -12,6 +12,7 @@ from .Ontology_Flask import Ontology_Flask_Obj
 from .utils import debug, SetDebugLevel
 from . import db_access
 from . import dbuser
+from . import seqindex
 import os
 
 
@@ -134,7 +135,7 @@ def load_user(request):
         return None
 
 
-def gunicorn(debug_level=6):
+def gunicorn(debug_level=6, load_seq_index=True):
     '''The entry point for running the api server through gunicorn (http://gunicorn.org/)
     to run dbbact rest server using gunicorn, use:
 
@@ -145,6 +146,8 @@ def gunicorn(debug_level=6):
     ----------
     debug_level: int, optional
         The minimal level of debug messages to log (10 is max, ~5 is equivalent to warning)
+    load_seq_index: bool, optional
+        True (default) to load the sequence index (see seqindex.py) at startup instead of on the first sequence lookup
 
     Returns
     -------
@@ -155,6 +158,10 @@ def gunicorn(debug_level=6):
     # (from https://stackoverflow.com/questions/18059937/flask-app-raises-a-500-error-with-no-exception)
     app.debug = True
     debug(6, 'starting dbbact rest-api server using gunicorn, debug_level=%d' % debug_level)
+    if load_seq_index:
+        con, cur = db_access.connect_db()
+        seqindex.get_index(con, cur)
+        con.close()
     return app
 
 
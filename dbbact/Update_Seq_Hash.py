@@ -1,7 +1,6 @@
 import os
 import time
 import datetime
-import hashlib
 from pathlib import Path
 
 #change the working directory
@@ -92,20 +91,7 @@ def main_func_seq_hash():
             tax_log += "Fatal Error, could not find sequence " + "\n"
             break
         
-        hash_seq_full = 'na'
-        hash_seq_150 = 'na'
-        hash_seq_100 = 'na'
-        
-        seq_str = seq_str.upper()
-        
-        if len(seq_str) > 0  :
-            hash_seq_full = hashlib.md5(seq_str.encode('utf-8')).hexdigest()
-        
-        if len(seq_str) >= 150 :
-            hash_seq_150 = hashlib.md5(seq_str[:150].encode('utf-8')).hexdigest()
-            
-        if len(seq_str) >= 100  :
-            hash_seq_100 = hashlib.md5(seq_str[:100].encode('utf-8')).hexdigest()
+        hash_seq_full, hash_seq_150, hash_seq_100 = dbsequences.get_sequence_hashes(seq_str)
             
         
         hash_log += "id: " + str(seq_id) + "\n"
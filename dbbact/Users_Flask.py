@@ -1,9 +1,9 @@
 import json
-from flask import Blueprint, request, g
+from flask import Blueprint, request, g, Response, stream_with_context
 from flask_login import login_required, current_user
 from . import dbannotations
 from . import dbuser
-from .utils import debug, getdoc, send_email, random_str
+from .utils import debug, getdoc, send_email, random_str, stream_ndjson
 from .autodoc import auto
 
 
@@ -260,6 +260,10 @@ def get_user_annotations():
         {
             foruserid : int
                 the userid to get the annotations created by
+            format : str (optional)
+                'json' (default) to return all the annotations in one json object
+                'ndjson' to stream the annotations (newline delimited json - one annotation json object per line, ordered by annotationid).
+                if an error is encountered while streaming, the last line is {"error": str}
     Success Response:
         Code : 200
         Content :
@@ -320,6 +324,11 @@ def get_user_annotations():
     foruserid = alldat.get('foruserid')
     if foruserid is None:
         return('foruserid parameter missing', 400)
+    fmt = alldat.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return('format %s not supported. options are: json, ndjson' % fmt, 400)
+    if fmt == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(dbannotations.iter_annotations(g.con, g.cur, foruserid=foruserid))), mimetype='application/x-ndjson')
     err, userannotations = dbannotations.GetUserAnnotations(g.con, g.cur, foruserid=foruserid)
     if err:
         debug(6, err)
@@ -0,0 +1,457 @@
+'''Annotation details cache shared by all the server worker processes.
+
+Keeps the assembled annotation data (see dbannotations.GetAnnotationsFromID()) and the annotation ontology
+parents (see dbannotations.GetAnnotationParents()) in an on-disk sqlite database, so they are computed
+once for all the workers instead of on every request. The number of cached entries is bounded
+(least recently used entries are evicted), and the cache keeps hit/miss counters (see get_stats()).
+
+The entries of an annotation are removed (invalidate()) by the functions changing it
+(dbannotations.UpdateAnnotation(), DeleteAnnotation(), DeleteSequenceFromAnnotation() and AddAnnotationParents()),
+before and after the commit. Each invalidation is recorded with an increasing change id. Readers get the last change id
+(get_change_id()) before reading the values from the database, and put() does not store values of annotations
+changed since, so a value read before a commit is not stored after the commit invalidated it.
+A failed invalidation is retried, and then returned as an error (the writers abort if it fails before the commit).
+Entries older than MAX_AGE are not used, which bounds how long a stale entry can be served.
+
+Reads do not write to the cache file: the last used times and the hit/miss counters are kept in the process memory
+and written at most once every FLUSH_INTERVAL seconds.
+
+The cache also keeps per-experiment bundles of all the public annotations of the experiment (with their parents),
+stored as zlib compressed json (see dbannotations.GetExpAnnotationBundles()). Changing an annotation records the
+change for its experiment, and the next bundle fetch updates only the changed annotations in the bundle.
+
+The cache is enabled by setting the DBBACT_ANNOTATION_CACHE environment variable to the sqlite file path
+(the same file for all the workers), and its size by DBBACT_ANNOTATION_CACHE_SIZE (number of entries).
+'''
+
+import os
+import json
+import time
+import sqlite3
+import zlib
+from contextlib import contextmanager
+
+from .utils import debug
+
+# the sqlite cache file (None to disable the cache)
+CACHE_FILE = os.environ.get('DBBACT_ANNOTATION_CACHE')
+
+# maximal number of cached entries (each annotation can have an 'annotation' and a 'parents' entry)
+MAX_ENTRIES = int(os.environ.get('DBBACT_ANNOTATION_CACHE_SIZE', 200000))
+
+# maximal number of cached experiment bundles
+MAX_BUNDLES = int(os.environ.get('DBBACT_ANNOTATION_CACHE_BUNDLES', 20000))
+
+# maximal age (seconds) of a cached entry / bundle (limits how long a stale value is served if an invalidation is lost)
+MAX_AGE = int(os.environ.get('DBBACT_ANNOTATION_CACHE_MAX_AGE', 86400))
+
+# check if entries need to be evicted every EVICT_INTERVAL puts
+EVICT_INTERVAL = 100
+
+# changes are kept for CHANGE_TIMEOUT seconds (for values / bundles being read from the database during the change)
+CHANGE_TIMEOUT = 3600
+
+# the usage (last used times and hit/miss counters) is kept in the process memory and written to the cache file
+# at most once every FLUSH_INTERVAL seconds (so reads do not write to the cache file)
+FLUSH_INTERVAL = 60
+
+# number of attempts for an invalidation (waiting INVALIDATE_RETRY_WAIT * attempt number seconds between the attempts)
+INVALIDATE_RETRIES = 5
+INVALIDATE_RETRY_WAIT = 1
+
+# the version of the cache file tables (the tables are recreated if the file has a different version)
+SCHEMA_VERSION = 2
+
+# the entry kinds stored in the cache
+KINDS = ['annotation', 'parents']
+
+# the sqlite connection of this process (and the pid it was opened in, since workers are forked)
+_con = None
+_con_pid = None
+_num_puts = 0
+
+# the usage not yet written to the cache file
+# dict of {(kind, annotationid): time last used}
+_used = {}
+# dict of {expid: time last used}
+_used_bundles = {}
+# dict of {counter name: number to add}
+_stats = {'hits': 0, 'misses': 0, 'bundle_hits': 0, 'bundle_misses': 0}
+_last_flush = 0
+
+
+def enabled():
+    '''Check if the cache is enabled
+
+    Returns
+    -------
+    bool
+    '''
+    return CACHE_FILE is not None
+
+
+@contextmanager
+def _write_transaction(con):
+    '''Run the statements in the with block in one sqlite write transaction (rolled back on error)
+    '''
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('COMMIT')
+
+
+def _get_con():
+    '''Get the sqlite connection of this process (opening and initializing the cache file if needed)
+
+    Returns
+    -------
+    sqlite3.Connection or None if the cache is disabled
+    '''
+    global _con, _con_pid
+
+    if CACHE_FILE is None:
+        return None
+    if _con is not None and _con_pid == os.getpid():
+        return _con
+    debug(2, 'opening annotation cache %s' % CACHE_FILE)
+    con = sqlite3.connect(CACHE_FILE, timeout=5, isolation_level=None, check_same_thread=False)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=OFF')
+    with _write_transaction(con):
+        if con.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            debug(2, 'creating annotation cache tables (version %d)' % SCHEMA_VERSION)
+            for ctable in ['AnnotationCache', 'ExpAnnotationBundles', 'ExpBundleChanges', 'AnnotationChanges', 'CacheStats']:
+                con.execute('DROP TABLE IF EXISTS %s' % ctable)
+            con.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+        con.execute('CREATE TABLE IF NOT EXISTS AnnotationCache (kind TEXT NOT NULL, annotationid INTEGER NOT NULL, value TEXT NOT NULL, added REAL NOT NULL, lastused REAL NOT NULL, PRIMARY KEY (kind, annotationid))')
+        con.execute('CREATE INDEX IF NOT EXISTS AnnotationCacheLastUsed ON AnnotationCache (lastused)')
+        con.execute('CREATE TABLE IF NOT EXISTS AnnotationChanges (id INTEGER PRIMARY KEY AUTOINCREMENT, annotationid INTEGER NOT NULL, changetime REAL NOT NULL)')
+        con.execute('CREATE INDEX IF NOT EXISTS AnnotationChangesAnnotationId ON AnnotationChanges (annotationid)')
+        con.execute('CREATE TABLE IF NOT EXISTS ExpAnnotationBundles (expid INTEGER PRIMARY KEY, value BLOB NOT NULL, added REAL NOT NULL, lastused REAL NOT NULL)')
+        con.execute('CREATE INDEX IF NOT EXISTS ExpAnnotationBundlesLastUsed ON ExpAnnotationBundles (lastused)')
+        con.execute('CREATE TABLE IF NOT EXISTS ExpBundleChanges (id INTEGER PRIMARY KEY AUTOINCREMENT, expid INTEGER NOT NULL, annotationid INTEGER NOT NULL, changetime REAL NOT NULL)')
+        con.execute('CREATE INDEX IF NOT EXISTS ExpBundleChangesExpId ON ExpBundleChanges (expid)')
+        con.execute('CREATE TABLE IF NOT EXISTS CacheStats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        con.execute("INSERT OR IGNORE INTO CacheStats (name, value) VALUES ('hits', 0), ('misses', 0), ('bundle_hits', 0), ('bundle_misses', 0)")
+    _con = con
+    _con_pid = os.getpid()
+    return _con
+
+
+def _flush_usage(con, force=False):
+    '''Write the usage kept in the process memory (last used times and hit/miss counters) to the cache file.
+    Done at most once every FLUSH_INTERVAL seconds (unless forced), and skipped if the cache file is locked
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+    force : bool (optional)
+        True to write even if the last write was less than FLUSH_INTERVAL seconds ago
+    '''
+    global _last_flush
+
+    ctime = time.time()
+    if not force and ctime - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = ctime
+    if len(_used) == 0 and len(_used_bundles) == 0 and not any(_stats.values()):
+        return
+    try:
+        # do not wait for the lock - the usage is written on the next flush
+        con.execute('PRAGMA busy_timeout=100')
+        with _write_transaction(con):
+            con.executemany('UPDATE AnnotationCache SET lastused=? WHERE kind=? AND annotationid=?', [(cused, ckind, cid) for (ckind, cid), cused in _used.items()])
+            con.executemany('UPDATE ExpAnnotationBundles SET lastused=? WHERE expid=?', [(cused, cid) for cid, cused in _used_bundles.items()])
+            con.executemany('UPDATE CacheStats SET value=value+? WHERE name=?', [(cval, cname) for cname, cval in _stats.items() if cval > 0])
+    except sqlite3.Error as e:
+        debug(4, 'annotation cache usage not written: %s' % e)
+        # do not keep more usage info than the cache size
+        if len(_used) > MAX_ENTRIES:
+            _used.clear()
+        return
+    finally:
+        con.execute('PRAGMA busy_timeout=5000')
+    _used.clear()
+    _used_bundles.clear()
+    for cname in _stats:
+        _stats[cname] = 0
+
+
+def get_change_id():
+    '''Get the id of the last annotation change (invalidation).
+    Call before reading the values to store with put() from the database, so values changed during the read are not stored
+
+    Returns
+    -------
+    int or None if the cache is disabled or the id could not be read
+    '''
+    try:
+        con = _get_con()
+        if con is None:
+            return None
+        return con.execute('SELECT COALESCE(MAX(id), 0) FROM AnnotationChanges').fetchone()[0]
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+        return None
+
+
+def get(kind, annotationids):
+    '''Get the cached values for a list of annotations.
+    Does not write to the cache file (the usage is kept in memory and written by _flush_usage())
+
+    Parameters
+    ----------
+    kind : str
+        the entry kind (one of KINDS)
+    annotationids : list of int
+
+    Returns
+    -------
+    dict of {annotationid(int): value}
+        the cached values (annotations not in the cache are not included)
+    '''
+    res = {}
+    annotationids = list(set(annotationids))
+    if len(annotationids) == 0:
+        return res
+    try:
+        con = _get_con()
+        if con is None:
+            return res
+        min_added = time.time() - MAX_AGE
+        # no ANY() in sqlite, so get in chunks below the sqlite variable limit
+        for cstart in range(0, len(annotationids), 500):
+            cids = annotationids[cstart:cstart + 500]
+            cur = con.execute('SELECT annotationid, value FROM AnnotationCache WHERE kind=? AND added>? AND annotationid IN (%s)' % ','.join('?' * len(cids)), [kind, min_added] + cids)
+            for cres in cur:
+                res[cres[0]] = json.loads(cres[1])
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+        return {}
+    ctime = time.time()
+    for cid in res:
+        _used[(kind, cid)] = ctime
+    _stats['hits'] += len(res)
+    _stats['misses'] += len(annotationids) - len(res)
+    _flush_usage(con)
+    return res
+
+
+def put(kind, values, change_id):
+    '''Store values in the cache.
+    Values of annotations changed since change_id are not stored (they may have been read before the change)
+
+    Parameters
+    ----------
+    kind : str
+        the entry kind (one of KINDS)
+    values : dict of {annotationid(int): value}
+        the values to store (must be json serializable)
+    change_id : int or None
+        the last change id before the values were read from the database (from get_change_id()). None to not store
+    '''
+    global _num_puts
+
+    if len(values) == 0 or change_id is None:
+        return
+    try:
+        con = _get_con()
+        if con is None:
+            return
+        ctime = time.time()
+        annotationids = list(values.keys())
+        changed = set()
+        with _write_transaction(con):
+            for cstart in range(0, len(annotationids), 500):
+                cids = annotationids[cstart:cstart + 500]
+                for cres in con.execute('SELECT annotationid FROM AnnotationChanges WHERE id>? AND annotationid IN (%s)' % ','.join('?' * len(cids)), [change_id] + cids):
+                    changed.add(cres[0])
+            con.executemany('INSERT OR REPLACE INTO AnnotationCache (kind, annotationid, value, added, lastused) VALUES (?, ?, ?, ?, ?)',
+                            [(kind, cid, json.dumps(cval), ctime, ctime) for cid, cval in values.items() if cid not in changed])
+        if len(changed) > 0:
+            debug(2, 'not caching %d annotations changed while reading them' % len(changed))
+        _num_puts += 1
+        if _num_puts % EVICT_INTERVAL == 0:
+            _evict(con)
+        _flush_usage(con)
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+
+
+def _evict(con):
+    '''Remove the expired entries / bundles, the least recently used entries / bundles above the maximal number,
+    and the old changes
+    '''
+    ctime = time.time()
+    _flush_usage(con, force=True)
+    with _write_transaction(con):
+        con.execute('DELETE FROM AnnotationCache WHERE added<?', [ctime - MAX_AGE])
+        con.execute('DELETE FROM ExpAnnotationBundles WHERE added<?', [ctime - MAX_AGE])
+        numentries = con.execute('SELECT COUNT(*) FROM AnnotationCache').fetchone()[0]
+        if numentries > MAX_ENTRIES:
+            debug(2, 'evicting %d entries from annotation cache' % (numentries - MAX_ENTRIES))
+            con.execute('DELETE FROM AnnotationCache WHERE rowid IN (SELECT rowid FROM AnnotationCache ORDER BY lastused LIMIT ?)', [numentries - MAX_ENTRIES])
+        numbundles = con.execute('SELECT COUNT(*) FROM ExpAnnotationBundles').fetchone()[0]
+        if numbundles > MAX_BUNDLES:
+            debug(2, 'evicting %d experiment bundles from annotation cache' % (numbundles - MAX_BUNDLES))
+            con.execute('DELETE FROM ExpAnnotationBundles WHERE expid IN (SELECT expid FROM ExpAnnotationBundles ORDER BY lastused LIMIT ?)', [numbundles - MAX_BUNDLES])
+        con.execute('DELETE FROM AnnotationChanges WHERE changetime<?', [ctime - CHANGE_TIMEOUT])
+        con.execute('DELETE FROM ExpBundleChanges WHERE changetime<? AND expid NOT IN (SELECT expid FROM ExpAnnotationBundles)', [ctime - CHANGE_TIMEOUT])
+
+
+def invalidate(annotationids, expid=None):
+    '''Remove all the cache entries of the annotations, and record the change (so values read before the change are not stored,
+    and the experiment bundle is updated).
+    Retried INVALIDATE_RETRIES times if the cache file is locked
+
+    Parameters
+    ----------
+    annotationids : int or list of int
+    expid : int or None (optional)
+        the experiment of the annotations (to update in the experiment bundle), or None to skip
+
+    Returns
+    -------
+    err : str
+        the error encountered or '' if ok (or the cache is disabled)
+    '''
+    if isinstance(annotationids, int):
+        annotationids = [annotationids]
+    if len(annotationids) == 0:
+        return ''
+    err = ''
+    for cattempt in range(INVALIDATE_RETRIES):
+        try:
+            con = _get_con()
+            if con is None:
+                return ''
+            ctime = time.time()
+            with _write_transaction(con):
+                con.executemany('DELETE FROM AnnotationCache WHERE annotationid=?', [(cid,) for cid in annotationids])
+                con.executemany('INSERT INTO AnnotationChanges (annotationid, changetime) VALUES (?, ?)', [(cid, ctime) for cid in annotationids])
+                if expid is not None:
+                    con.executemany('INSERT INTO ExpBundleChanges (expid, annotationid, changetime) VALUES (?, ?, ?)', [(expid, cid, ctime) for cid in annotationids])
+            debug(1, 'invalidated %d annotations in annotation cache' % len(annotationids))
+            return ''
+        except sqlite3.Error as e:
+            err = 'annotation cache invalidation failed: %s' % e
+            debug(7, '%s (attempt %d)' % (err, cattempt + 1))
+            time.sleep(INVALIDATE_RETRY_WAIT * (cattempt + 1))
+    debug(9, 'could not invalidate annotations %s in annotation cache: %s' % (annotationids, err))
+    return err
+
+
+def get_bundles(expids):
+    '''Get the cached experiment bundles and the annotations changed since each bundle was stored.
+    Does not write to the cache file (the usage is kept in memory and written by _flush_usage())
+
+    Parameters
+    ----------
+    expids : list of int
+
+    Returns
+    -------
+    bundles : dict of {expid(int): bundle(dict)}
+        the cached bundles (experiments without a cached bundle are not included)
+    changes : dict of {expid(int): set of int}
+        the ids of the annotations changed in each experiment since the bundle was stored
+    last_change : int
+        the id of the last change read (pass to put_bundles())
+    '''
+    bundles = {}
+    changes = {}
+    last_change = 0
+    expids = list(set(expids))
+    if len(expids) == 0:
+        return bundles, changes, last_change
+    try:
+        con = _get_con()
+        if con is None:
+            return bundles, changes, last_change
+        min_added = time.time() - MAX_AGE
+        # read the changes before the bundles, so changes recorded later are not lost
+        last_change = con.execute('SELECT COALESCE(MAX(id), 0) FROM ExpBundleChanges').fetchone()[0]
+        for cstart in range(0, len(expids), 500):
+            cids = expids[cstart:cstart + 500]
+            for cres in con.execute('SELECT expid, annotationid FROM ExpBundleChanges WHERE id<=? AND expid IN (%s)' % ','.join('?' * len(cids)), [last_change] + cids):
+                changes.setdefault(cres[0], set()).add(cres[1])
+            for cres in con.execute('SELECT expid, value FROM ExpAnnotationBundles WHERE added>? AND expid IN (%s)' % ','.join('?' * len(cids)), [min_added] + cids):
+                bundles[cres[0]] = json.loads(zlib.decompress(cres[1]).decode())
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+        return {}, {}, 0
+    ctime = time.time()
+    for cid in bundles:
+        _used_bundles[cid] = ctime
+    _stats['bundle_hits'] += len(bundles)
+    _stats['bundle_misses'] += len(expids) - len(bundles)
+    _flush_usage(con)
+    return bundles, changes, last_change
+
+
+def put_bundles(bundles, last_change):
+    '''Store experiment bundles in the cache (and remove the changes they include)
+
+    Parameters
+    ----------
+    bundles : dict of {expid(int): bundle(dict)}
+        the bundles to store (must be json serializable)
+    last_change : int
+        the last change included in the bundles (from get_bundles())
+    '''
+    global _num_puts
+
+    if len(bundles) == 0:
+        return
+    try:
+        con = _get_con()
+        if con is None:
+            return
+        ctime = time.time()
+        with _write_transaction(con):
+            con.executemany('INSERT OR REPLACE INTO ExpAnnotationBundles (expid, value, added, lastused) VALUES (?, ?, ?, ?)',
+                            [(cid, zlib.compress(json.dumps(cbundle).encode()), ctime, ctime) for cid, cbundle in bundles.items()])
+            con.executemany('DELETE FROM ExpBundleChanges WHERE expid=? AND id<=?', [(cid, last_change) for cid in bundles])
+        _num_puts += 1
+        if _num_puts % EVICT_INTERVAL == 0:
+            _evict(con)
+        _flush_usage(con)
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+
+
+def get_stats():
+    '''Get the cache statistics
+
+    Returns
+    -------
+    dict of {str: int}
+        'enabled' : bool
+        'hits' : int
+            number of entries found in the cache (since the cache file was created. includes the usage of this process
+            not yet written to the cache file, but not of the other processes)
+        'misses' : int
+            number of entries not found in the cache
+        'entries' : int
+            number of entries currently in the cache
+        'max_entries' : int
+        'bundle_hits', 'bundle_misses' : int
+            number of experiment bundles found / not found in the cache
+        'bundles' : int
+            number of experiment bundles currently in the cache
+    '''
+    stats = {'enabled': CACHE_FILE is not None, 'hits': 0, 'misses': 0, 'entries': 0, 'max_entries': MAX_ENTRIES, 'bundle_hits': 0, 'bundle_misses': 0, 'bundles': 0}
+    try:
+        con = _get_con()
+        if con is None:
+            return stats
+        for cres in con.execute('SELECT name, value FROM CacheStats'):
+            stats[cres[0]] = cres[1] + _stats.get(cres[0], 0)
+        stats['entries'] = con.execute('SELECT COUNT(*) FROM AnnotationCache').fetchone()[0]
+        stats['bundles'] = con.execute('SELECT COUNT(*) FROM ExpAnnotationBundles').fetchone()[0]
+    except sqlite3.Error as e:
+        debug(7, 'annotation cache error %s' % e)
+    return stats
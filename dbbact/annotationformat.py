@@ -0,0 +1,150 @@
+'''Compact (columnar) encodings of the fast annotations response (see Seq_Flask.get_fast_annotations()).
+
+Instead of a dict per annotation, the annotation fields are returned as parallel arrays (one entry per annotation),
+the annotation details / parents as CSR lists (indptr into the type/term arrays), and the
+sequence x annotation relation as a CSR matrix (seq_indptr / seq_indices / seq_counts, with the indices
+being positions in the annotation arrays).
+
+Available encodings:
+    'columnar' - json
+    'msgpack' - msgpack, with the numeric arrays as raw little-endian buffers (so clients can use numpy.frombuffer()).
+                requires the msgpack package
+    'npz' - uncompressed numpy .npz file (all arrays, strings as unicode arrays. no pickle needed for loading)
+'''
+
+import io
+import json
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# the supported formats (in addition to the default 'json')
+FORMATS = ['columnar', 'msgpack', 'npz']
+
+# the annotation fields returned as arrays (annotation dict key, array name)
+ANNOTATION_FIELDS = [('annotationid', 'annotationid'), ('expid', 'expid'), ('userid', 'userid'), ('num_sequences', 'num_sequences'),
+                     ('description', 'description'), ('private', 'private'), ('method', 'method'), ('agent', 'agent'),
+                     ('annotationtype', 'annotationtype'), ('username', 'username'), ('date', 'date')]
+
+# the integer arrays (encoded as buffers in msgpack)
+INT_ARRAYS = ['annotationid', 'expid', 'userid', 'num_sequences', 'details_indptr', 'parents_indptr',
+              'seq_indptr', 'seq_indices', 'seq_counts', 'term_total_annotations', 'term_total_experiments', 'distances']
+
+
+def fast_annotations_to_columnar(annotations, seqannotations, term_info, taxonomy, num_sequences):
+    '''Convert the GetFastAnnotations() results to parallel arrays
+
+    Parameters
+    ----------
+    annotations, seqannotations, term_info, taxonomy :
+        the results of dbannotations.GetFastAnnotations()
+    num_sequences : int
+        the number of query sequences
+
+    Returns
+    -------
+    dict of {str: list}
+        the arrays. ints are lists of int, strings are lists of str.
+        annotation fields (see ANNOTATION_FIELDS) - one entry per annotation (missing values are -1 for the integer fields, '' for the strings)
+        'details_indptr', 'details_type', 'details_term' - the details of annotation i are details_type/details_term[details_indptr[i]:details_indptr[i+1]]
+        'parents_indptr', 'parents_type', 'parents_term' - the parents of each annotation (same as details)
+        'seq_indptr', 'seq_indices', 'seq_counts' - the annotations of query sequence i are at positions seq_indices[seq_indptr[i]:seq_indptr[i+1]]
+            in the annotation arrays, and seq_counts is the number of database sequences matching the query in each annotation
+        'term', 'term_total_annotations', 'term_total_experiments' - the term info
+        'taxonomy' - the taxonomy of each query sequence
+    '''
+    cols = {cname: [] for ckey, cname in ANNOTATION_FIELDS}
+    for cname in ['details_type', 'details_term', 'parents_type', 'parents_term']:
+        cols[cname] = []
+    cols['details_indptr'] = [0]
+    cols['parents_indptr'] = [0]
+    annotation_pos = {}
+    for cpos, (cid, cann) in enumerate(annotations.items()):
+        annotation_pos[cid] = cpos
+        for ckey, cname in ANNOTATION_FIELDS:
+            cval = cann.get(ckey)
+            if cval is None:
+                # missing values are -1 in the integer arrays (so they can be encoded as int64) and '' in the string arrays
+                cval = -1 if cname in INT_ARRAYS else ''
+            cols[cname].append(cval)
+        for cdetailtype, cterm in cann.get('details', []):
+            cols['details_type'].append(cdetailtype)
+            cols['details_term'].append(cterm)
+        cols['details_indptr'].append(len(cols['details_term']))
+        for cdetailtype, cterms in cann.get('parents', {}).items():
+            for cterm in cterms:
+                cols['parents_type'].append(cdetailtype)
+                cols['parents_term'].append(cterm)
+        cols['parents_indptr'].append(len(cols['parents_term']))
+
+    # the sequence x annotation CSR matrix (annotations not returned, i.e. private, are skipped)
+    seq_annotations = {}
+    for cseqpos, cannotationids in seqannotations:
+        counts = {}
+        for cid in cannotationids:
+            if cid in annotation_pos:
+                counts[annotation_pos[cid]] = counts.get(annotation_pos[cid], 0) + 1
+        seq_annotations[cseqpos] = counts
+    cols['seq_indptr'] = [0]
+    cols['seq_indices'] = []
+    cols['seq_counts'] = []
+    for cseqpos in range(num_sequences):
+        counts = seq_annotations.get(cseqpos, {})
+        for cpos in sorted(counts):
+            cols['seq_indices'].append(cpos)
+            cols['seq_counts'].append(counts[cpos])
+        cols['seq_indptr'].append(len(cols['seq_indices']))
+
+    cols['term'] = list(term_info.keys())
+    cols['term_total_annotations'] = [cinfo.get('total_annotations', 0) for cinfo in term_info.values()]
+    cols['term_total_experiments'] = [cinfo.get('total_experiments', 0) for cinfo in term_info.values()]
+    cols['taxonomy'] = list(taxonomy)
+    return cols
+
+
+def encode_columnar(cols, fmt):
+    '''Encode the columnar arrays
+
+    Parameters
+    ----------
+    cols : dict of {str: list}
+        the arrays (from fast_annotations_to_columnar())
+    fmt : str
+        the encoding (one of FORMATS)
+
+    Returns
+    -------
+    err : str
+        the error encountered or '' if ok
+    data : str or bytes
+        the encoded arrays
+    mimetype : str
+        the mimetype of the encoded data
+    '''
+    if fmt == 'columnar':
+        return '', json.dumps(cols), 'application/json'
+    if fmt == 'msgpack':
+        if msgpack is None:
+            return 'msgpack format not supported (msgpack package not installed on server)', None, None
+        res = {}
+        for cname, cvals in cols.items():
+            if cname in INT_ARRAYS:
+                res[cname] = {'dtype': '<i8', 'data': np.asarray(cvals, dtype='<i8').tobytes()}
+            else:
+                res[cname] = cvals
+        return '', msgpack.packb(res, use_bin_type=True), 'application/x-msgpack'
+    if fmt == 'npz':
+        arrays = {}
+        for cname, cvals in cols.items():
+            if cname in INT_ARRAYS:
+                arrays[cname] = np.asarray(cvals, dtype=np.int64)
+            else:
+                arrays[cname] = np.asarray([str(x) for x in cvals], dtype=np.str_)
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        return '', buf.getvalue(), 'application/octet-stream'
+    return 'format %s not supported. options are: json, %s' % (fmt, ', '.join(FORMATS)), None, None
@@ -1,6 +1,7 @@
 import os
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 
 from .utils import debug
@@ -82,3 +83,25 @@ def connect_db(schema='AnnotationSchemaTest'):
         print(msg)
         raise SystemError(msg)
         return None
+
+
+def has_pending_writes(con, cur):
+    """
+    Check if the current transaction of the connection changed the database (and was not committed yet).
+    Used to avoid storing uncommitted data in the worker / shared caches
+
+    input:
+    con,cur
+
+    output:
+    bool
+        True if the transaction wrote to the database (or is in error state), False if not
+    """
+    status = con.get_transaction_status()
+    if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+        return True
+    # a transaction id is assigned only when the transaction writes
+    cur.execute('SELECT txid_current_if_assigned()')
+    return cur.fetchone()[0] is not None
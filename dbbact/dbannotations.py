@@ -1,14 +1,30 @@
 import datetime
+import io
 import psycopg2
+import psycopg2.extras
 from collections import defaultdict
 
 from . import dbsequences
 from . import dbexperiments
 from . import dbidval
 from . import dbontology
-from .dbontology import GetParents
+from . import annotationcache
+from . import db_access
 from .utils import debug
 
+# number of annotations to fetch from the server-side cursor (and get the details for) at a time in iter_annotations()
+ANNOTATION_BATCH_SIZE = 1000
+
+# number of sequences above which the sequence links of a new annotation are inserted using COPY (instead of a multi-row INSERT)
+COPY_MIN_LINKS = 5000
+
+# counter for the names of the server-side cursors
+_num_named_cursors = 0
+
+# the annotation visibility condition for the annotation queries (takes the querying userid as parameter).
+# private annotations are visible only to the user who created them (see the annotationstable_private_idx partial index)
+VISIBLE_ANNOTATION_SQL = "(AnnotationsTable.isPrivate = 'n' OR AnnotationsTable.idUser = %s)"
+
 
 def AddSequenceAnnotations(con, cur, sequences, primer, expid, annotationtype, annotationdetails, method='',
                            description='', agenttype='', private='n', userid=None, commit=True):
@@ -56,14 +72,117 @@ def AddSequenceAnnotations(con, cur, sequences, primer, expid, annotationtype, a
     err, annotationid = AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method, description, agenttype, private, userid, commit=False, numseqs=len(seqids))
     if err:
         return err, -1
-    for cseqid in seqids:
-        cur.execute('INSERT INTO SequencesAnnotationTable (seqId,annotationId) VALUES (%s,%s)', [cseqid, annotationid])
+    try:
+        _insert_sequence_links(con, cur, annotationid, seqids)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, -1
     debug(2, "Added %d sequence annotations" % len(seqids))
     if commit:
         con.commit()
+        _invalidate_cache(con, cur, annotationid, expid=expid)
     return '', annotationid
 
 
+def _insert_sequence_links(con, cur, annotationid, seqids):
+    """
+    Link sequences to an annotation (in SequencesAnnotationTable) using a fixed number of statements.
+    Uses a multi-row INSERT for up to COPY_MIN_LINKS sequences, and COPY for larger sets. Does not commit
+
+    input:
+    con,cur
+    annotationid : int
+        the annotation to link the sequences to
+    seqids : list of int
+        the dbbact ids of the sequences to link
+    """
+    if len(seqids) == 0:
+        return
+    if len(seqids) < COPY_MIN_LINKS:
+        psycopg2.extras.execute_values(cur, 'INSERT INTO SequencesAnnotationTable (seqId,annotationId) VALUES %s',
+                                       [(cseqid, annotationid) for cseqid in seqids], page_size=1000)
+        return
+    debug(2, 'copying %d sequence links for annotation %d' % (len(seqids), annotationid))
+    data = io.StringIO()
+    for cseqid in seqids:
+        data.write('%d\t%d\n' % (cseqid, annotationid))
+    data.seek(0)
+    cur.copy_expert('COPY SequencesAnnotationTable (seqId, annotationId) FROM STDIN', data)
+
+
+def _invalidate_cache(con, cur, annotationid, expid=None):
+    """
+    Remove the annotation from the annotation cache and record the change for its experiment bundle (see annotationcache.py)
+
+    input:
+    con,cur
+    annotationid : int
+        the annotation that changed
+    expid : int or None (optional)
+        the experiment of the annotation, or None to get it from the database
+
+    output:
+    err : str
+        the error encountered or '' if ok. Writers should abort if the invalidation before the commit fails
+    """
+    if not annotationcache.enabled():
+        return ''
+    if expid is None:
+        cur.execute('SELECT idExp FROM AnnotationsTable WHERE id=%s', [annotationid])
+        if cur.rowcount > 0:
+            expid = cur.fetchone()[0]
+    return annotationcache.invalidate(annotationid, expid=expid)
+
+
+def _put_cache(con, cur, kind, values, change_id):
+    """
+    Store annotation values read from the database in the annotation cache (see annotationcache.put()).
+    Not stored if the current transaction changed the database (the values may include uncommitted changes)
+
+    input:
+    con,cur
+    kind : str
+        the entry kind (see annotationcache.KINDS)
+    values : dict of {annotationid(int): value}
+    change_id : int or None
+        the annotation cache change id before the values were read (from annotationcache.get_change_id())
+    """
+    if change_id is None or len(values) == 0:
+        return
+    if db_access.has_pending_writes(con, cur):
+        debug(1, 'not caching %d annotations read in a transaction with uncommitted changes' % len(values))
+        return
+    annotationcache.put(kind, values, change_id)
+
+
+def InvalidateCachedAnnotations(con, cur, annotationids):
+    """
+    Remove annotations from the annotation cache and record the changes for their experiment bundles (see annotationcache.py).
+    Used by scripts changing the annotations directly in the database (call before and after committing the changes)
+
+    input:
+    con,cur
+    annotationids : list of int
+        the annotations that changed
+
+    output:
+    err : str
+        the error encountered or '' if ok
+    """
+    if not annotationcache.enabled() or len(annotationids) == 0:
+        return ''
+    exp_annotations = defaultdict(list)
+    cur.execute('SELECT id,idExp FROM AnnotationsTable WHERE id=ANY(%s)', [list(annotationids)])
+    for cid, cexpid in cur:
+        exp_annotations[cexpid].append(cid)
+    for cexpid, cids in exp_annotations.items():
+        err = annotationcache.invalidate(cids, expid=cexpid)
+        if err:
+            return err
+    debug(2, 'invalidated %d annotations in the annotation cache' % len(annotationids))
+    return ''
+
+
 def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdetails=None, method=None,
                      description=None, agenttype=None, private=None, userid=None,
                      commit=True, numseqs=None):
@@ -104,6 +223,9 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         the annotationid or <0 if failed
     '''
     debug(1, 'UpdateAnnotation for annotationID %d' % annotationid)
+    err = _invalidate_cache(con, cur, annotationid)
+    if err:
+        return err, -1
 
     # verify the user can update the annotation
     err, origuser = GetAnnotationUser(con, cur, annotationid)
@@ -154,14 +276,16 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
 
     debug(2, "updated annotation id %d." % (annotationid))
 
+    # the current number of sequences (the ontology term counts of the current parents were updated with it)
+    cur.execute('SELECT seqCount FROM AnnotationsTable WHERE id = %s LIMIT 1', [annotationid])
+    if cur.rowcount == 0:
+        debug(3, 'seqCount for annotationid %d not found' % annotationid)
+        oldnumseqs = 0
+    else:
+        res = cur.fetchone()
+        oldnumseqs = res[0]
     if numseqs is None:
-        cur.execute('SELECT seqCount FROM AnnotationsTable WHERE id = %s LIMIT 1', [annotationid])
-        if cur.rowcount == 0:
-            debug(3, 'seqCount for annotationid %d not found' % annotationid)
-            numseqs = 0
-        else:
-            res = cur.fetchone()
-            numseqs = res[0]
+        numseqs = oldnumseqs
 
     # update the annotation details if needed
     if annotationdetails is not None:
@@ -176,6 +300,10 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
             return err, -1
         debug(2, "%d annotationdetails added" % numadded)
         # and update the annotationParentsTable (ontology terms per annotation)
+        # remove the old entries from the ontology term counts
+        err, oldparents = GetAnnotationParents(con, cur, annotationid)
+        if not err:
+            _update_term_counts(con, cur, oldparents, -oldnumseqs, -1)
         # delete the old entry
         cur.execute('DELETE FROM AnnotationParentsTable WHERE idAnnotation=%s', [annotationid])
         debug(1, 'deleted from annotationParentsTable')
@@ -188,6 +316,8 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
 
     if commit:
         con.commit()
+        # invalidate again in case another worker cached the annotation before the commit
+        _invalidate_cache(con, cur, annotationid)
     return '', annotationid
 
 
@@ -274,6 +404,7 @@ def AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method='',
 
     if commit:
         con.commit()
+        _invalidate_cache(con, cur, cid, expid=expid)
     return '', cid
 
 
@@ -344,38 +475,71 @@ def AddAnnotationParents(con, cur, annotationid, annotationdetails, commit=True,
         Number of annotations added to the AnnotationListTable or -1 if error
     """
     try:
-        numadded = 0
+        # get the parents of all the terms at once
+        err, termparents = dbontology.GetTermsParents(con, cur, [contologyterm for cdetailtype, contologyterm in annotationdetails])
+        if err:
+            debug(6, 'error getting parents for annotation %d: %s' % (annotationid, err))
+            return err, -2
         parentsdict = {}
         for (cdetailtype, contologyterm) in annotationdetails:
-            err, parents = GetParents(con, cur, contologyterm)
-            if err:
-                debug(6, 'error getting parents for term %s: %s' % (contologyterm, err))
+            contologyterm = contologyterm.lower()
+            if contologyterm not in termparents:
+                debug(6, 'error getting parents for term %s: term not found' % contologyterm)
                 continue
-            debug(2, 'term %s parents %s' % (contologyterm, parents))
+            debug(2, 'term %s parents %s' % (contologyterm, termparents[contologyterm]))
+            cdetailtype = cdetailtype.lower()
             if cdetailtype not in parentsdict:
-                parentsdict[cdetailtype] = parents
-            else:
-                parentsdict[cdetailtype].extend(parents)
-
-        for cdetailtype, parents in parentsdict.items():
-            parents = list(set(parents))
-            for cpar in parents:
-                cpar = cpar.lower()
-                cdetailtype = cdetailtype.lower()
-                debug(2, 'adding parent %s' % cpar)
-                cur.execute('INSERT INTO AnnotationParentsTable (idAnnotation,annotationDetail,ontology) VALUES (%s,%s,%s)', [annotationid, cdetailtype, cpar])
-                numadded += 1
-                # add the number of sequences and one more annotation to all the terms in this annotation
-                cur.execute('UPDATE OntologyTable SET seqCount = seqCount+%s, annotationCount=annotationCount+1 WHERE description = %s', [numseqs, cpar])
+                parentsdict[cdetailtype] = {}
+            for cpar in termparents[contologyterm]:
+                parentsdict[cdetailtype][cpar] = True
+        parentsdict = {cdetailtype: list(parents.keys()) for cdetailtype, parents in parentsdict.items()}
+
+        rows = [(annotationid, cdetailtype, cpar) for cdetailtype, parents in parentsdict.items() for cpar in parents]
+        numadded = len(rows)
+        if numadded > 0:
+            psycopg2.extras.execute_values(cur, 'INSERT INTO AnnotationParentsTable (idAnnotation,annotationDetail,ontology) VALUES %s', rows, page_size=numadded)
+        # add the number of sequences and one more annotation to all the terms in this annotation
+        _update_term_counts(con, cur, parentsdict, numseqs, 1)
         debug(1, "Added %d annotationparents items" % numadded)
+        err = _invalidate_cache(con, cur, annotationid)
+        if err:
+            return err, -1
         if commit:
             con.commit()
+            _invalidate_cache(con, cur, annotationid)
         return '', numadded
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in AddAnnotationParents" % e)
         return e, -2
 
 
+def _update_term_counts(con, cur, parents, numseqs, numannotations):
+    """
+    Update the sequence and annotation counts in OntologyTable for the parent terms of an annotation (in one statement).
+    Each annotation parent entry (detail type, term) changes the term counts by numseqs sequences and numannotations annotations.
+    Does not commit
+
+    input:
+    con,cur
+    parents : dict of {str:list of str} {detail type (i.e. 'higher in'): list of ontology terms}
+        the annotation parents (see GetAnnotationParents())
+    numseqs : int
+        the change in the sequence count for each entry (negative to decrease)
+    numannotations : int
+        the change in the annotation count for each entry (i.e. 1 when adding an annotation, -1 when deleting, 0 when only the sequences change)
+    """
+    counts = defaultdict(int)
+    for cterms in parents.values():
+        for cterm in cterms:
+            counts[cterm] += 1
+    if len(counts) == 0:
+        return
+    values = [(cterm, ccount * numseqs, ccount * numannotations) for cterm, ccount in counts.items()]
+    psycopg2.extras.execute_values(cur, 'UPDATE OntologyTable SET seqCount = seqCount + v.seqs, annotationCount = annotationCount + v.annotations '
+                                   'FROM (VALUES %s) AS v(term, seqs, annotations) WHERE OntologyTable.description = v.term', values, page_size=len(values))
+    debug(1, 'updated the counts of %d ontology terms' % len(counts))
+
+
 def GetAnnotationParents(con, cur, annotationid):
     '''
     Get the ontology parents list for the annotation
@@ -391,24 +555,85 @@ def GetAnnotationParents(con, cur, annotationid):
     parents : dict of {str:list of str} {detail type (i.e. 'higher in'): list of ontology terms}
     '''
     debug(1, 'GetAnnotationParents for id %d' % annotationid)
-    cur.execute('SELECT annotationdetail,ontology FROM AnnotationParentsTable WHERE idannotation=%s', [annotationid])
-    if cur.rowcount == 0:
+    change_id = annotationcache.get_change_id()
+    parents = annotationcache.get('parents', [annotationid]).get(annotationid)
+    if parents is None:
+        cur.execute('SELECT annotationdetail,ontology FROM AnnotationParentsTable WHERE idannotation=%s', [annotationid])
+        parents = {}
+        res = cur.fetchall()
+        for cres in res:
+            cdetail = cres[0]
+            conto = cres[1]
+            if cdetail in parents:
+                parents[cdetail].append(conto)
+            else:
+                parents[cdetail] = [conto]
+        _put_cache(con, cur, 'parents', {annotationid: parents}, change_id)
+    if len(parents) == 0:
         errmsg = 'No Annotation Parents found for annotationid %d in AnnotationParentsTable' % annotationid
         debug(3, errmsg)
         return(errmsg, {})
-    parents = {}
-    res = cur.fetchall()
-    for cres in res:
-        cdetail = cres[0]
-        conto = cres[1]
-        if cdetail in parents:
-            parents[cdetail].append(conto)
-        else:
-            parents[cdetail] = [conto]
     debug(1, 'found %d detail types' % len(parents))
     return '', parents
 
 
+def GetAnnotationsParents(con, cur, annotationids):
+    '''
+    Get the ontology parents list for each annotation in a list of annotations (in one query)
+
+    input:
+    con,cur
+    annotationids : list of int
+        the annotationids for which to get the list of ontology terms
+
+    output:
+    err: str
+        error encountered or '' if ok
+    parents : dict of {annotationid(int): dict of {str:list of str}}
+        the parents for each annotation (see GetAnnotationParents()). {} for annotations with no parents
+    '''
+    debug(1, 'GetAnnotationsParents for %d annotations' % len(annotationids))
+    change_id = annotationcache.get_change_id()
+    parents = annotationcache.get('parents', annotationids)
+    missing = [cid for cid in annotationids if cid not in parents]
+    if len(missing) == 0:
+        return '', parents
+    try:
+        fetched = _get_parents_from_db(con, cur, missing)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, {}
+    _put_cache(con, cur, 'parents', fetched, change_id)
+    parents.update(fetched)
+    return '', parents
+
+
+def _get_parents_from_db(con, cur, annotationids):
+    '''
+    Get the ontology parents list for each annotation in a list of annotations from the database
+
+    input:
+    con,cur
+    annotationids : list of int
+
+    output:
+    parents : dict of {annotationid(int): dict of {str:list of str}}
+        the parents for each annotation (see GetAnnotationParents()). {} for annotations with no parents
+    '''
+    parents = {cid: {} for cid in annotationids}
+    if len(parents) == 0:
+        return parents
+    cur.execute('SELECT idannotation,annotationdetail,ontology FROM AnnotationParentsTable WHERE idannotation=ANY(%s)', [list(parents.keys())])
+    for cres in cur:
+        cparents = parents[cres[0]]
+        cdetail = cres[1]
+        if cdetail in cparents:
+            cparents[cdetail].append(cres[2])
+        else:
+            cparents[cdetail] = [cres[2]]
+    return parents
+
+
 def GetAnnotationDetails(con, cur, annotationid):
     """
     Get the annotation details list for annotationid
@@ -473,51 +698,108 @@ def GetAnnotationsFromID(con, cur, annotationid, userid=0):
         'details' : list of (str,str) of type (i.e. 'higher in') and value (i.e. 'homo sapiens')
     """
     debug(1, 'get annotation from id %d' % annotationid)
-    cur.execute('SELECT AnnotationsTable.*,userstable.username FROM AnnotationsTable,userstable WHERE AnnotationsTable.iduser = userstable.id and AnnotationsTable.id=%s', [annotationid])
-    if cur.rowcount == 0:
-        debug(3, 'annotationid %d not found' % annotationid)
-        return 'Annotationid %d not found' % annotationid, None
-    res = cur.fetchone()
-    debug(1, res)
-    if res['isprivate'] == 'y':
-        if res['iduser'] != userid:
-            debug(3, 'cannot view annotation %d (created by user %d), request from used %d' % (annotationid, res['iduser'], userid))
-            return 'Annotationid %d is private. Cannot view' % annotationid, None
-
-    data = {}
-    data['id'] = annotationid
-    data['description'] = res['description']
-    data['private'] = res['isprivate']
-    err, method = dbidval.GetDescriptionFromId(con, cur, 'MethodTypesTable', res['idmethod'])
-    if err:
-        return err, None
-    data['method'] = method
-    err, agent = dbidval.GetDescriptionFromId(con, cur, 'AgentTypesTable', res['idagenttype'])
+    err, annotations = GetAnnotationsFromIDs(con, cur, [annotationid], userid=userid)
     if err:
         return err, None
-    data['agent'] = agent
-    err, annotationtype = dbidval.GetDescriptionFromId(con, cur, 'AnnotationTypesTable', res['idannotationtype'])
-    if err:
-        return err, None
-    data['annotationtype'] = annotationtype
-    data['expid'] = res['idexp']
-    data['userid'] = res['iduser']
-    data['username'] = res['username']
-    data['date'] = res['addeddate'].isoformat()
-    data['annotationid'] = annotationid
-    data['num_sequences'] = res['seqcount']
-
-    if res['isprivate'] == 'y':
-        if userid != data['userid']:
-            debug(6, 'Trying to view private annotation id %d from different user (orig user %d, current user %d)' % (annotationid, data['userid'], userid))
-            return 'Annotation not found', None
-
-    err, details = GetAnnotationDetails(con, cur, annotationid)
-    if err:
-        return err, None
-    data['details'] = details
+    if annotationid not in annotations:
+        debug(3, 'annotationid %d not found (or private annotation of a different user than %d)' % (annotationid, userid))
+        return 'Annotationid %d not found' % annotationid, None
+    return '', annotations[annotationid]
+
 
-    return '', data
+def GetAnnotationsFromIDs(con, cur, annotationids, userid=0):
+    """
+    get annotation details for a list of annotation ids (using a fixed number of queries).
+
+    input:
+    con,cur
+    annotationids : list of int
+        the annotationids to get
+    userid : int (optional)
+        used to check if to return a private annotation
+
+    output:
+    err : str
+        the error encountered or '' if ok
+    annotations : dict of {annotationid(int): data(dict)}
+        the annotation data (see GetAnnotationsFromID()) for each annotation found.
+        annotations not found (or private annotations of other users) are not included
+    """
+    annotationids = list(set(annotationids))
+    debug(1, 'get annotations from %d ids' % len(annotationids))
+    change_id = annotationcache.get_change_id()
+    annotations = annotationcache.get('annotation', annotationids)
+    missing = [cid for cid in annotationids if cid not in annotations]
+    try:
+        if len(missing) > 0:
+            # private annotations of other users are filtered in the query
+            fetched = _get_annotations_from_db(con, cur, missing, userid=userid)
+            _put_cache(con, cur, 'annotation', fetched, change_id)
+            annotations.update(fetched)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, {}
+    # the cached annotations are stored regardless of the user, so check them
+    for cid, data in list(annotations.items()):
+        if data['private'] == 'y':
+            if data['userid'] != userid:
+                debug(3, 'cannot view annotation %d (created by user %d), request from used %d' % (cid, data['userid'], userid))
+                del annotations[cid]
+    debug(1, 'found %d annotations' % len(annotations))
+    return '', annotations
+
+
+def _get_annotations_from_db(con, cur, annotationids, userid=None):
+    """
+    get the annotation data for a list of annotation ids from the database
+
+    input:
+    con,cur
+    annotationids : list of int
+    userid : int or None (optional)
+        None (default) to get all the annotations, or the querying userid to skip the private annotations of other users
+
+    output:
+    annotations : dict of {annotationid(int): data(dict)}
+        the annotation data (see GetAnnotationsFromID()) for each annotation found.
+    """
+    annotations = {}
+    if len(annotationids) == 0:
+        return annotations
+    cur.execute('SELECT AnnotationsTable.*, userstable.username, MethodTypesTable.description AS method, AgentTypesTable.description AS agent, AnnotationTypesTable.description AS annotationtype '
+                'FROM AnnotationsTable '
+                'JOIN userstable ON userstable.id = AnnotationsTable.iduser '
+                'JOIN MethodTypesTable ON MethodTypesTable.id = AnnotationsTable.idmethod '
+                'JOIN AgentTypesTable ON AgentTypesTable.id = AnnotationsTable.idagenttype '
+                'JOIN AnnotationTypesTable ON AnnotationTypesTable.id = AnnotationsTable.idannotationtype '
+                'WHERE AnnotationsTable.id = ANY(%s)' + ('' if userid is None else ' AND ' + VISIBLE_ANNOTATION_SQL),
+                [annotationids] + ([] if userid is None else [userid]))
+    for res in cur:
+        data = {}
+        data['id'] = res['id']
+        data['description'] = res['description']
+        data['private'] = res['isprivate']
+        data['method'] = res['method']
+        data['agent'] = res['agent']
+        data['annotationtype'] = res['annotationtype']
+        data['expid'] = res['idexp']
+        data['userid'] = res['iduser']
+        data['username'] = res['username']
+        data['date'] = res['addeddate'].isoformat()
+        data['annotationid'] = res['id']
+        data['num_sequences'] = res['seqcount']
+        data['details'] = []
+        annotations[res['id']] = data
+    if len(annotations) == 0:
+        return annotations
+    cur.execute('SELECT AnnotationListTable.idannotation, AnnotationDetailsTypesTable.description, OntologyTable.description '
+                'FROM AnnotationListTable '
+                'JOIN AnnotationDetailsTypesTable ON AnnotationDetailsTypesTable.id = AnnotationListTable.idannotationdetail '
+                'JOIN OntologyTable ON OntologyTable.id = AnnotationListTable.idontology '
+                'WHERE AnnotationListTable.idannotation = ANY(%s)', [list(annotations.keys())])
+    for res in cur:
+        annotations[res[0]]['details'].append([res[1], res[2]])
+    return annotations
 
 
 def IsAnnotationVisible(con, cur, annotationid, userid=0):
@@ -567,23 +849,72 @@ def GetUserAnnotations(con, cur, foruserid, userid=0):
     details: list of dict
         a list of all the info about each annotation (see GetAnnotationsFromID())
     '''
-    details = []
     debug(1, 'GetUserAnnotations userid %d' % userid)
-    cur.execute('SELECT id FROM AnnotationsTable WHERE iduser=%s', [foruserid])
-    if cur.rowcount == 0:
-        debug(3, 'no annotations for userid %d' % foruserid)
-        return '', []
-    res = cur.fetchall()
-    for cres in res:
-        err, cdetails = GetAnnotationsFromID(con, cur, cres[0], userid=userid)
-        if err:
-            debug(6, err)
-            return err, None
-        details.append(cdetails)
+    try:
+        details = list(iter_annotations(con, cur, foruserid=foruserid, userid=userid))
+    except psycopg2.DatabaseError as e:
+        debug(6, e)
+        return 'database error %s' % e, None
     debug(3, 'found %d annotations' % len(details))
     return '', details
 
 
+def iter_annotations(con, cur, foruserid=None, userid=0, batch_size=ANNOTATION_BATCH_SIZE, expid=None):
+    '''
+    Iterate over the details of all the annotations (or all the annotations created by a user / of an experiment), ordered by annotation id.
+    The annotation ids are read using a server-side cursor, and the details are fetched in bulk for batch_size annotations
+    at a time (see GetAnnotationsFromIDs()), so the results can be streamed without keeping all the annotations in memory.
+    Raises psycopg2.DatabaseError if an error is encountered
+
+    input:
+    con,cur :
+    foruserid : int or None (optional)
+        None (default) to get all the annotations, or the userid to get the annotations generated by
+    userid : int (optional)
+        the current (querying) userid (private annotations of other users are skipped)
+    batch_size : int (optional)
+        the number of annotations to get the details for in each query
+    expid : int or None (optional)
+        None (default) to not filter by experiment, or the experiment id to get the annotations of
+        (note: does not test if the experiment is private, see dbexperiments.TestExpIdExists())
+
+    output:
+    yields dict
+        the info about each annotation (see GetAnnotationsFromID())
+    '''
+    global _num_named_cursors
+
+    _num_named_cursors += 1
+    idcur = con.cursor('iter_annotations_%d' % _num_named_cursors)
+    idcur.itersize = batch_size
+    try:
+        conditions = []
+        params = []
+        if foruserid is not None:
+            conditions.append('iduser=%s')
+            params.append(foruserid)
+        if expid is not None:
+            conditions.append('idExp=%s')
+            params.append(expid)
+        if len(conditions) > 0:
+            idcur.execute('SELECT id FROM AnnotationsTable WHERE %s ORDER BY id' % ' AND '.join(conditions), params)
+        else:
+            idcur.execute('SELECT id FROM AnnotationsTable ORDER BY id')
+        while True:
+            res = idcur.fetchmany(batch_size)
+            if len(res) == 0:
+                break
+            cids = [cres[0] for cres in res]
+            err, details = GetAnnotationsFromIDs(con, cur, cids, userid=userid)
+            if err:
+                raise psycopg2.DatabaseError(err)
+            for cid in cids:
+                if cid in details:
+                    yield details[cid]
+    finally:
+        idcur.close()
+
+
 def GetSequenceAnnotations(con, cur, sequence, region=None, userid=0):
     """
     Get all annotations for a sequence. Returns a list of annotations (empty list if sequence is not found)
@@ -615,17 +946,20 @@ def GetSequenceAnnotations(con, cur, sequence, region=None, userid=0):
         debug(6, 'Sequence %s not found for GetSequenceAnnotations. error : %s' % (sequence, err))
         return err, None
     debug(1, 'sequenceid=%s' % sid)
-    cur.execute('SELECT annotationId FROM SequencesAnnotationTable WHERE seqId IN %s', [tuple(sid)])
+    cur.execute('SELECT SequencesAnnotationTable.annotationId FROM SequencesAnnotationTable '
+                'JOIN AnnotationsTable ON AnnotationsTable.id = SequencesAnnotationTable.annotationId '
+                'WHERE SequencesAnnotationTable.seqId IN %s AND ' + VISIBLE_ANNOTATION_SQL, [tuple(sid), userid])
     if cur.rowcount == 0:
         debug(3, 'no annotations for sequenceid %s' % sid)
         return '', []
-    res = cur.fetchall()
-    for cres in res:
-        err, cdetails = GetAnnotationsFromID(con, cur, cres[0])
-        if err:
-            debug(6, err)
-            return err, None
-        details.append(cdetails)
+    annotationids = [cres[0] for cres in cur.fetchall()]
+    err, annotations = GetAnnotationsFromIDs(con, cur, annotationids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, None
+    for cid in annotationids:
+        if cid in annotations:
+            details.append(annotations[cid])
     debug(3, 'found %d annotations' % len(details))
     return '', details
 
@@ -652,23 +986,105 @@ def GetAnnotationsFromExpId(con, cur, expid, userid=0):
     if not dbexperiments.TestExpIdExists(con, cur, expid, userid):
         debug(3, 'experiment %d does not exist' % expid)
         return '', []
-    cur.execute('SELECT id from AnnotationsTable WHERE idExp=%s', [expid])
-    res = cur.fetchall()
-    debug(1, 'found %d annotations for expid %d' % (len(res), expid))
-    annotations = []
-    for cres in res:
-        # test if annotation is private - don't show it
-        err, canview = IsAnnotationVisible(con, cur, cres[0], userid)
-        if err:
-            return err, None
-        if not canview:
-            continue
+    # get the annotations (the private annotations of other users are not returned)
+    err, expannotations = GetExpAnnotationBundles(con, cur, [expid], userid=userid)
+    if err:
+        debug(3, 'error encountered for expid %d : %s' % (expid, err))
+        return err, None
+    annotations = [cannotation for cannotation, cparents in expannotations[expid]]
+    debug(1, 'found %d annotations for expid %d' % (len(annotations), expid))
+    return '', annotations
+
 
-        err, cannotation = GetAnnotationsFromID(con, cur, cres[0], userid)
+def GetExpAnnotationBundles(con, cur, expids, userid=0):
+    """
+    Get all the annotations (with their parents) of each experiment in a list of experiments.
+    The public annotations of each experiment are kept in a cached bundle (see annotationcache.py), and only
+    the annotations changed since the bundle was stored are read from the database.
+    Note: does not test if the experiments are private (see dbexperiments.GetVisibleExpIds())
+
+    input:
+    con,cur
+    expids : list of int
+        the experiments to get the annotations for
+    userid : int (optional)
+        the user requesting the info (private annotations of this user are also returned)
+
+    output:
+    err : str
+        The error encountered or '' if ok
+    annotations : dict of {expid(int): list of (annotation(dict), parents(dict))}
+        the annotations of each experiment (sorted by annotation id).
+        annotation is the annotation data (see GetAnnotationsFromID()) and parents are the annotation parents (see GetAnnotationParents())
+    """
+    expids = list(set(expids))
+    debug(1, 'GetExpAnnotationBundles for %d experiments' % len(expids))
+    bundles, changes, last_change = annotationcache.get_bundles(expids)
+    rebuild = [cexpid for cexpid in expids if cexpid not in bundles]
+    changed = set()
+    for cexpid in bundles:
+        changed.update(changes.get(cexpid, set()))
+    try:
+        # get the current state of the annotations of the bundles to build and of the changed annotations
+        rows = []
+        if len(rebuild) > 0:
+            cur.execute('SELECT id,idExp,isPrivate,idUser FROM AnnotationsTable WHERE idExp=ANY(%s)', [rebuild])
+            rows.extend(cur.fetchall())
+        if len(changed) > 0:
+            cur.execute('SELECT id,idExp,isPrivate,idUser FROM AnnotationsTable WHERE id=ANY(%s)', [list(changed)])
+            rows.extend(cur.fetchall())
+        # the bundles are stored, so read the annotations from the database (and not from the annotation cache)
+        public_ids = [cres[0] for cres in rows if cres[2] != 'y']
+        details = _get_annotations_from_db(con, cur, public_ids)
+        parents = _get_parents_from_db(con, cur, public_ids)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, {}
+
+    # update the bundles - remove the changed annotations and add their current version
+    for cexpid in rebuild:
+        bundles[cexpid] = {'annotations': [], 'private': []}
+    for cexpid, cbundle in bundles.items():
+        cchanged = changes.get(cexpid, set())
+        if len(cchanged) > 0:
+            cbundle['annotations'] = [cann for cann in cbundle['annotations'] if cann[0]['annotationid'] not in cchanged]
+            cbundle['private'] = [cann for cann in cbundle['private'] if cann[0] not in cchanged]
+    for cid, cexpid, cprivate, cuserid in rows:
+        if cexpid not in bundles:
+            continue
+        if cprivate == 'y':
+            bundles[cexpid]['private'].append([cid, cuserid])
+        elif cid in details:
+            bundles[cexpid]['annotations'].append([details[cid], parents[cid]])
+    updated = {cexpid: bundles[cexpid] for cexpid in rebuild}
+    for cexpid in bundles:
+        if len(changes.get(cexpid, set())) > 0:
+            bundles[cexpid]['annotations'].sort(key=lambda x: x[0]['annotationid'])
+            updated[cexpid] = bundles[cexpid]
+    for cexpid in rebuild:
+        bundles[cexpid]['annotations'].sort(key=lambda x: x[0]['annotationid'])
+    # do not store bundles that may include uncommitted changes of this transaction
+    if len(updated) > 0 and not db_access.has_pending_writes(con, cur):
+        annotationcache.put_bundles(updated, last_change)
+
+    # add the private annotations of the user
+    private_ids = [cid for cbundle in bundles.values() for cid, cuserid in cbundle['private'] if cuserid == userid]
+    private_details = {}
+    private_parents = {}
+    if len(private_ids) > 0:
+        err, private_details = GetAnnotationsFromIDs(con, cur, private_ids, userid=userid)
         if err:
-            debug(3, 'error encountered for annotationid %d : %s' % (cres[0], err))
-            return err, None
-        annotations.append(cannotation)
+            return err, {}
+        err, private_parents = GetAnnotationsParents(con, cur, private_ids)
+        if err:
+            return err, {}
+    annotations = {}
+    for cexpid, cbundle in bundles.items():
+        cannotations = [(cdetails, cparents) for cdetails, cparents in cbundle['annotations']]
+        cprivate = [(private_details[cid], private_parents[cid]) for cid, cuserid in cbundle['private'] if cid in private_details]
+        if len(cprivate) > 0:
+            cannotations = sorted(cannotations + cprivate, key=lambda x: x[0]['annotationid'])
+        annotations[cexpid] = cannotations
     return '', annotations
 
 
@@ -794,33 +1210,34 @@ def DeleteAnnotation(con, cur, annotationid, userid=0, commit=True):
             debug(6, 'cannot delete. annotation %d was created by user %d but delete request was from user %d' % (annotationid, origuser, userid))
             return 'Cannot delete. Annotation was created by a different user'
 
-    # find how many sequences are in the annotations
-    cur.execute('SELECT seqCount FROM AnnotationsTable WHERE id=%s', [annotationid])
-    res = cur.fetchone()
-    num_seqs = res[0]
-
-    # update the ontology term sequence counts
-    err, parents = GetAnnotationParents(con, cur, annotationid)
+    try:
+        # delete the annotation parents entries, and remove them from the ontology term counts
+        cur.execute('DELETE FROM AnnotationParentsTable WHERE idAnnotation=%s RETURNING annotationDetail,ontology', [annotationid])
+        parents = defaultdict(list)
+        for cres in cur:
+            parents[cres[0]].append(cres[1])
+        debug(1, 'deleted from annotationParentsTable')
+        cur.execute('DELETE FROM AnnotationListTable WHERE idannotation=%s', [annotationid])
+        debug(1, 'deleted from annotationliststable')
+        cur.execute('DELETE FROM SequencesAnnotationTable WHERE annotationid=%s', [annotationid])
+        debug(1, 'deleted %d from sequencesannotationtable' % cur.rowcount)
+        cur.execute('DELETE FROM AnnotationsTable WHERE id=%s RETURNING seqCount,idExp', [annotationid])
+        res = cur.fetchone()
+        num_seqs = res[0]
+        expid = res[1]
+        debug(1, 'deleted from annotationstable')
+        _update_term_counts(con, cur, parents, -num_seqs, -1)
+        debug(3, 'fixed ontologytable counts')
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e
+    err = _invalidate_cache(con, cur, annotationid, expid=expid)
     if err:
-        msg = 'Could not find ontology parents. Delete aborted'
-        debug(3, msg)
-        return msg
-    for cterm in parents:
-        cur.execute('UPDATE OntologyTable SET seqCount = seqCount-%s, annotationCount=annotationCount-1 WHERE description = %s', [num_seqs, cterm])
-    debug(3, 'fixed ontologytable counts')
-
-    cur.execute('DELETE FROM AnnotationsTable WHERE id=%s', [annotationid])
-    debug(1, 'deleted from annotationstable')
-    cur.execute('DELETE FROM AnnotationListTable WHERE idannotation=%s', [annotationid])
-    debug(1, 'deleted from annotationliststable')
-    cur.execute('DELETE FROM SequencesAnnotationTable WHERE annotationid=%s', [annotationid])
-    debug(1, 'deleted from sequencesannotationtable')
-    # delete the annotation parents entries
-    cur.execute('DELETE FROM AnnotationParentsTable WHERE idAnnotation=%s', [annotationid])
-    debug(1, 'deleted from annotationParentsTable')
+        return err
 
     if commit:
         con.commit()
+        _invalidate_cache(con, cur, annotationid, expid=expid)
     return('')
 
 
@@ -845,7 +1262,9 @@ def DeleteSequenceFromAnnotation(con, cur, sequences, annotationid, userid=0, co
         the error string or '' if no error encountered
     '''
     debug(1, 'DeleteSequenceFromAnnotation for %d sequences, annotationid %d, userid %d' % (len(sequences), annotationid, userid))
-    origuser = GetAnnotationUser(con, cur, annotationid)
+    err, origuser = GetAnnotationUser(con, cur, annotationid)
+    if err:
+        return err
     if origuser != 0:
         if userid == 0:
             debug(6, 'cannot delete non-anonymous annotation with default userid=0')
@@ -856,32 +1275,42 @@ def DeleteSequenceFromAnnotation(con, cur, sequences, annotationid, userid=0, co
 
     # remove duplicate sequences for the delete
     sequences = list(set(sequences))
-    seqids = dbsequences.GetSequencesId(con, cur, sequences)
-    for cseqid in seqids:
-        cur.execute('DELETE FROM SequencesAnnotationTable WHERE annotationid=%s AND seqId=%s', (annotationid, cseqid))
-    debug(3, 'deleted %d sequences from from sequencesannotationtable annotationid=%d' % (len(sequences), annotationid))
-
-    # remove the count of these sequences for the annotation
-    numseqs = len(sequences)
-    cur.execute('UPDATE AnnotationsTable SET seqCount = seqCount-%s', [numseqs])
-    debug(3, 'removed %d from the annotationstable seq count' % numseqs)
-
-    # update the ontology term sequence counts
-    err, parents = GetAnnotationParents(con, cur, annotationid)
+    err, seqids = dbsequences.GetSequencesId(con, cur, sequences)
     if err:
-        msg = 'Could not find ontology parents. Delete aborted'
-        debug(3, msg)
-        return msg
-    for cterm in parents:
-        cur.execute('UPDATE OntologyTable SET seqCount = seqCount-%s WHERE description = %s', [numseqs, cterm])
-    debug(3, 'fixed ontologytable counts')
+        return err
+    try:
+        # remove all the sequences in one statement (the number of sequences removed is the number of deleted rows)
+        cur.execute('DELETE FROM SequencesAnnotationTable WHERE annotationid=%s AND seqId = ANY(%s)', [annotationid, list(set(seqids))])
+        numseqs = cur.rowcount
+        debug(3, 'deleted %d sequences from from sequencesannotationtable annotationid=%d' % (numseqs, annotationid))
+
+        # remove the count of these sequences for the annotation
+        cur.execute('UPDATE AnnotationsTable SET seqCount = seqCount-%s WHERE id=%s RETURNING idExp', [numseqs, annotationid])
+        expid = cur.fetchone()[0]
+        debug(3, 'removed %d from the annotationstable seq count' % numseqs)
+
+        # update the ontology term sequence counts
+        err, parents = GetAnnotationParents(con, cur, annotationid)
+        if err:
+            msg = 'Could not find ontology parents. Delete aborted'
+            debug(3, msg)
+            return msg
+        _update_term_counts(con, cur, parents, -numseqs, 0)
+        debug(3, 'fixed ontologytable counts')
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e
+    err = _invalidate_cache(con, cur, annotationid, expid=expid)
+    if err:
+        return err
 
     if commit:
         con.commit()
+        _invalidate_cache(con, cur, annotationid, expid=expid)
     return('')
 
 
-def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info=True, get_all_exp_annotations=True, get_taxonomy=True, get_parents=True):
+def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info=True, get_all_exp_annotations=True, get_taxonomy=True, get_parents=True, kmer_search=False, sids=None):
     """
     Get annotations for a list of sequences in a compact form
 
@@ -902,6 +1331,11 @@ def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info
         True to get the taxonomy for each sequence (returned in the 'taxonomy' field)
     get_parents: bool, True
         True to get the parent terms for each annotation term, False to just get the annotation terms
+    kmer_search: bool, False
+        True to use the kmer index for matching the sequences (see dbsequences.get_sequences_ids_bulk())
+    sids: list of list of int or None (optional)
+        the dbbact ids matching each sequence (i.e. from dbsequences.get_sequences_ids_approx()), or None (default) to look them up.
+        if supplied, the taxonomy is of the first matching dbbact sequence
 
     output:
     err : str
@@ -921,82 +1355,97 @@ def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info
             'total_sequences' : int
                 total number of sequences in annotations where this term appears (as a parent)
     taxonomy : list of str
-        the dbbact taxonomy string for each supplied sequence (order similar to query sequences)
+        the dbbact taxonomy string for each supplied sequence (order similar to query sequences). 'NA' if not found
     """
     debug(2, 'GetFastAnnotations for %d sequences' % len(sequences))
+    # all the data is fetched for the whole set of sequences / annotations at once, so the number of queries does not depend on the number of sequences
     annotations = {}
     seqannotations = []
     all_terms = set()
     term_info = {}
 
-    # set of experients we already processed (so no need to re-look at the annotations from the experiment
-    # in case get_all_exp_annotations=True)
-    experiments_added = set()
+    # get the sequenceids for all the sequences
+    if sids is None:
+        err, all_sids = dbsequences.get_sequences_ids_bulk(con, cur, sequences, idprimer=region, kmer_search=kmer_search)
+        if err:
+            return err, {}, [], {}, []
+    else:
+        all_sids = sids
 
-    for cseqpos, cseq in enumerate(sequences):
-        cseqannotationids = []
-        # get the sequenceid
-        err, sid = dbsequences.GetSequenceId(con, cur, cseq, region)
+    # get the annotations for all the sequences
+    seqid_annotations = defaultdict(list)
+    unique_sids = list(set([cid for csid in all_sids for cid in csid]))
+    if len(unique_sids) > 0:
+        try:
+            # private annotations of other users are skipped in the query
+            cur.execute('SELECT SequencesAnnotationTable.seqid, SequencesAnnotationTable.annotationid FROM SequencesAnnotationTable '
+                        'JOIN AnnotationsTable ON AnnotationsTable.id = SequencesAnnotationTable.annotationid '
+                        'WHERE SequencesAnnotationTable.seqid = ANY(%s) AND ' + VISIBLE_ANNOTATION_SQL, [unique_sids, userid])
+            for cres in cur:
+                seqid_annotations[cres[0]].append(cres[1])
+        except psycopg2.DatabaseError as e:
+            debug(7, 'database error %s' % e)
+            return 'database error %s' % e, {}, [], {}, []
+    # the annotation ids in the order they are first encountered
+    linked_annotations = {}
+    for cseqpos, sid in enumerate(all_sids):
         # if not in database - no annotations
         if len(sid) == 0:
             continue
-        # get annotations for the sequence
-        cur.execute('SELECT annotationid FROM SequencesAnnotationTable WHERE seqid IN %s', [tuple(sid)])
-        res = cur.fetchall()
-        # go over all annotations
-        for cres in res:
-            current_annotation = cres[0]
-            # add the sequence annotation link
-            cseqannotationids.append(current_annotation)
-
-            # if annotation is already in list - move to next
-            if current_annotation in annotations:
-                continue
-
-            # we don't need the term info since we do it once for all terms
-            err, cdetails = GetAnnotationsFromID(con, cur, current_annotation, userid=userid)
-            # if we didn't get annotation details, probably they are private - just ignore
-            if cdetails is None:
-                continue
+        cseqannotationids = []
+        for cid in sid:
+            cseqannotationids.extend(seqid_annotations[cid])
+        for cannotationid in cseqannotationids:
+            linked_annotations[cannotationid] = True
+        seqannotations.append((cseqpos, cseqannotationids))
 
-            annotations_to_process = [cdetails]
-            if get_all_exp_annotations:
-                debug(2, 'getting all exp annotations')
-                if 'expid' in cdetails:
-                    expid = cdetails['expid']
-                    # if we already added this experiment - finished
-                    if expid in experiments_added:
-                        continue
-                    err, annotations_to_process = GetAnnotationsFromExpId(con, cur, expid, userid=userid)
-                    experiments_added.add(expid)
-
-            for cdetails in annotations_to_process:
-                cannotationid = cdetails['annotationid']
-                # if annotation not in annotations list - add it
-                if cannotationid not in annotations:
-                    # if we didn't get annotation details, probably they are private - just ignore
-                    if cdetails is None:
-                        continue
-                    # if we need to get the parents, add all the parent terms
-                    if get_parents:
-                        err, parents = GetAnnotationParents(con, cur, cannotationid)
-                    else:
-                        # otherwise, just keep the annotation terms
-                        parents = defaultdict(list)
-                        for cdetailtype, cterm in cdetails['details']:
-                                parents[cdetailtype].append(cterm)
-                    cdetails['parents'] = parents
-                    # add to the set of all terms to get the info for
-                    # note we add a "-" for terms that have a "low" annotation type
-                    for ctype, cterms in parents.items():
-                        for cterm in cterms:
-                            if ctype == 'low':
-                                cterm = '-' + cterm
-                            all_terms.add(cterm)
-                    # and add the annotation
-                    annotations[cannotationid] = cdetails
+    # get the details of the annotations
+    err, linked_details = GetAnnotationsFromIDs(con, cur, list(linked_annotations.keys()), userid=userid)
+    if err:
+        return err, {}, [], {}, []
+    annotations_to_process = [linked_details[cid] for cid in linked_annotations if cid in linked_details]
+    all_parents = {}
+    if get_all_exp_annotations:
+        debug(2, 'getting all exp annotations')
+        # the experiments of the annotations (in the order they are first encountered)
+        expids = list(dict.fromkeys([cdetails['expid'] for cdetails in annotations_to_process]))
+        visible_expids = dbexperiments.GetVisibleExpIds(con, cur, expids, userid=userid)
+        # get all the annotations of the experiments from the experiment bundles
+        err, exp_annotations = GetExpAnnotationBundles(con, cur, list(visible_expids), userid=userid)
+        if err:
+            return err, {}, [], {}, []
+        annotations_to_process = []
+        for cexpid in expids:
+            for cdetails, cparents in exp_annotations.get(cexpid, []):
+                annotations_to_process.append(cdetails)
+                all_parents[cdetails['annotationid']] = cparents
+
+    # if we need to get the parents, add all the parent terms
+    if get_parents:
+        err, missing_parents = GetAnnotationsParents(con, cur, [cdetails['annotationid'] for cdetails in annotations_to_process if cdetails['annotationid'] not in all_parents])
+        if err:
+            return err, {}, [], {}, []
+        all_parents.update(missing_parents)
+    for cdetails in annotations_to_process:
+        cannotationid = cdetails['annotationid']
+        if get_parents:
+            parents = all_parents[cannotationid]
+        else:
+            # otherwise, just keep the annotation terms
+            parents = defaultdict(list)
+            for cdetailtype, cterm in cdetails['details']:
+                    parents[cdetailtype].append(cterm)
+        cdetails['parents'] = parents
+        # add to the set of all terms to get the info for
+        # note we add a "-" for terms that have a "low" annotation type
+        for ctype, cterms in parents.items():
+            for cterm in cterms:
+                if ctype == 'low':
+                    cterm = '-' + cterm
+                all_terms.add(cterm)
+        # and add the annotation
+        annotations[cannotationid] = cdetails
 
-        seqannotations.append((cseqpos, cseqannotationids))
     debug(2, 'got annotations. found %d unique terms' % len(all_terms))
     if get_term_info:
         term_info = dbontology.get_term_counts(con, cur, all_terms)
@@ -1005,12 +1454,24 @@ def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info
     debug(2, 'found %d annotations, %d annotated sequences. %d term_info' % (len(annotations), len(seqannotations), len(term_info)))
     taxonomy = []
     if get_taxonomy:
-        for cseq in sequences:
-            cerr, ctax = dbsequences.GetSequenceTaxonomy(con, cur, cseq)
-            if cerr == '':
-                taxonomy.append(ctax)
-            else:
-                taxonomy.append('na')
+        # 'NA' for sequences without a taxonomy (same as GetSequencesTaxonomy() for sequences not in the database)
+        if sids is None:
+            cerr, taxonomy = dbsequences.GetSequencesTaxonomy(con, cur, sequences)
+            if cerr:
+                taxonomy = ['NA'] * len(sequences)
+        else:
+            # the query sequences may not be in the database (i.e. hashes or approximate matches), so use the matched sequence
+            cerr, cinfo = dbsequences.SeqFromID(con, cur, [csid[0] for csid in all_sids if len(csid) > 0])
+            cinfo = iter(cinfo)
+            for csid in all_sids:
+                if len(csid) == 0:
+                    taxonomy.append('NA')
+                    continue
+                ctax = next(cinfo, {})
+                if cerr == '' and 'taxonomy' in ctax:
+                    taxonomy.append(ctax['taxonomy'])
+                else:
+                    taxonomy.append('NA')
         debug(2, 'got taxonomies')
     return '', annotations, seqannotations, term_info, taxonomy
 
@@ -1032,18 +1493,11 @@ def GetAllAnnotations(con, cur, userid=0):
         list of all annotations (see GetAnnotationsFromID)
     '''
     debug(1, 'GetAllAnnotations for user %d' % userid)
-
-    annotations = []
-    cur.execute('SELECT id from AnnotationsTable')
-    res = cur.fetchall()
-    debug(1, 'Found %d annotations in dbBact' % len(res))
-    for cres in res:
-        cannotationid = cres[0]
-        err, cannotation = GetAnnotationsFromID(con, cur, cannotationid, userid=userid)
-        if err:
-            debug(2, 'error for annotationid %d: %s' % (cannotationid, err))
-            continue
-        annotations.append(cannotation)
+    try:
+        annotations = list(iter_annotations(con, cur, userid=userid))
+    except psycopg2.DatabaseError as e:
+        debug(6, e)
+        return 'database error %s' % e, []
     debug(1, 'Got details for %d annotations' % len(annotations))
     return '', annotations
 
@@ -1286,7 +1740,7 @@ def get_fast_annotations_gg_silva(con, cur, seq_db_ids, db_name='silva', userid=
     # get the annotations for all the sequences
     all_seqs = list(all_seqs)
     debug(2, 'got %d unique sequences for all db_ids' % len(all_seqs))
-    err, annotations, seqannotations, term_info = GetFastAnnotations(con, cur, all_seqs, region=None, userid=userid, get_term_info=get_term_info, get_all_exp_annotations=get_all_exp_annotations)
+    err, annotations, seqannotations, term_info, taxonomy = GetFastAnnotations(con, cur, all_seqs, region=None, userid=userid, get_term_info=get_term_info, get_all_exp_annotations=get_all_exp_annotations, get_taxonomy=False)
     if err:
         return err, {}, [], {}, []
 
@@ -199,6 +199,30 @@ def TestExpIdExists(con, cur, expid, userid=None):
     return False
 
 
+def GetVisibleExpIds(con, cur, expids, userid=None):
+    """
+    Get which of the expids exist and are visible to the user (same test as TestExpIdExists(), in one query)
+
+    input:
+    expids : list of int
+    userid : int (optional)
+
+    output:
+    set of int
+        the expids which exist and are not private or (private and userid match)
+    """
+    debug(1, "GetVisibleExpIds for %d expids userid %s" % (len(expids), userid))
+    visible = set()
+    if len(expids) == 0:
+        return visible
+    cur.execute('SELECT DISTINCT ON (expId) expId,private,userId from ExperimentsTable where expId=ANY(%s)', [list(expids)])
+    for cres in cur:
+        if cres[1] == 'n' or cres[2] == userid:
+            visible.add(cres[0])
+    debug(1, "%d of %d expids visible" % (len(visible), len(expids)))
+    return visible
+
+
 def GetDetailsFromExpId(con, cur, expid, userid=None):
     """
     get the details of an experiment with id expid
@@ -1,5 +1,64 @@
+import time
+
 import psycopg2
 from .utils import debug
+from . import dbversions
+
+# the (small, rarely changing) tables kept in the per-worker id <-> description cache (lowercase)
+CACHED_TABLES = ['methodtypestable', 'agenttypestable', 'annotationtypestable', 'annotationdetailstypestable', 'ontologynamestable']
+
+# the name of the version counter in CacheVersionsTable (bumped by AddItem() for the cached tables)
+VERSION_NAME = 'dbidval'
+
+# minimal time (seconds) between two checks of the version
+VERSION_CHECK_INTERVAL = 10
+
+# the cached tables - dict of {table(str): (dict of {id(int): description(str)}, dict of {description(str): id(int)})}
+_tables = {}
+# the version of the cached tables
+_version = 0
+_last_version_check = 0
+
+
+def _get_cached_table(con, cur, table):
+    """
+    Get the cached id <-> description dicts of a table (loading it on first use, and clearing the cache if the version changed)
+
+    input:
+    con,cur
+    table : str
+        Name of the table
+
+    output:
+    ids : dict of {id(int): description(str)} or None if the table is not cached
+    descriptions : dict of {description(str): id(int)} or None if the table is not cached
+    """
+    global _version, _last_version_check
+
+    table = table.lower()
+    if table not in CACHED_TABLES:
+        return None, None
+    ctime = time.time()
+    if ctime - _last_version_check >= VERSION_CHECK_INTERVAL:
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        if version < 0:
+            return None, None
+        _last_version_check = ctime
+        if version != _version:
+            debug(2, 'dbidval version changed from %s to %d. clearing cache' % (_version, version))
+            _tables.clear()
+            _version = version
+    if table not in _tables:
+        debug(2, 'loading table %s to the dbidval cache' % table)
+        ids = {}
+        descriptions = {}
+        cur.execute('SELECT id, description FROM %s ORDER BY id' % table)
+        for cid, cdescription in cur:
+            ids[cid] = cdescription
+            # keep the first id for replicate descriptions
+            descriptions.setdefault(cdescription, cid)
+        _tables[table] = (ids, descriptions)
+    return _tables[table]
 
 
 def GetIdFromDescription(con, cur, table, description, noneok=False, addifnone=False, commit=True):
@@ -30,6 +89,9 @@ def GetIdFromDescription(con, cur, table, description, noneok=False, addifnone=F
             else:
                 return -1
         description = description.lower()
+        ids, descriptions = _get_cached_table(con, cur, table)
+        if descriptions is not None and description in descriptions:
+            return descriptions[description]
         cur.execute('SELECT id from %s WHERE description=%s LIMIT 1' % (table, '%s'), [description])
         if cur.rowcount == 0:
             if not addifnone:
@@ -86,8 +148,14 @@ def AddItem(con, cur, table, description, allowreplicate=False, commit=True):
         cur.execute('INSERT INTO %s (description) VALUES (%s) RETURNING id' % (table, '%s'), [description])
         sid = cur.fetchone()[0]
         debug(2, 'AddItem - added new item %s. id is %d' % (description, sid))
+        if table.lower() in CACHED_TABLES:
+            # make the other workers reload the table (when the item is committed)
+            dbversions.bump_version(con, cur, VERSION_NAME)
         if commit:
             con.commit()
+            # add to the cache of this worker only after the commit, so a rolled back item is not cached
+            if table.lower() in CACHED_TABLES:
+                _add_cached_item(table, sid, description)
         return '', sid
     except psycopg2.DatabaseError as e:
         debug(8, "error %s in AddItem" % e)
@@ -113,6 +181,9 @@ def GetDescriptionFromId(con, cur, table, cid):
         the description of the id
     """
     try:
+        ids, descriptions = _get_cached_table(con, cur, table)
+        if ids is not None and cid in ids:
+            return '', ids[cid]
         cur.execute('SELECT description FROM %s WHERE id=%s LIMIT 1' % (table, '%s'), [cid])
         if cur.rowcount == 0:
             debug(2, 'id not found in table %s' % table)
@@ -123,3 +194,23 @@ def GetDescriptionFromId(con, cur, table, cid):
     except psycopg2.DatabaseError as e:
         debug(8, "error %s in GetDescriptionFromId" % e)
         return 'Error %s in GetDescriptionFromId' % e, ''
+
+
+def _add_cached_item(table, cid, description):
+    """
+    Add a new (committed) item to the cache of this worker (write-through)
+
+    input:
+    table : str
+        Name of the table
+    cid : int
+        the id of the added item
+    description : str
+        the description of the added item
+    """
+    table = table.lower()
+    if table not in _tables:
+        return
+    ids, descriptions = _tables[table]
+    ids[cid] = description
+    descriptions.setdefault(description, cid)
@@ -2,6 +2,9 @@ import psycopg2
 from .utils import debug, tolist
 from . import dbidval
 from . import dbannotations
+from . import ontodag
+from . import terminfo
+from . import termpairs
 
 
 def AddTerm(con, cur, term, parent='na', ontologyname='scdb', synonyms=[], commit=True):
@@ -41,6 +44,8 @@ def AddTerm(con, cur, term, parent='na', ontologyname='scdb', synonyms=[], commi
             for csyn in synonyms:
                 err, cid = AddSynonym(con, cur, termid, csyn, commit=False)
         debug(2, 'added ontology term %s. id is %d' % (term, termid))
+        # refresh the worker ontology DAG on its next use without pending writes (after the commit or rollback)
+        ontodag.invalidate()
         if commit:
             con.commit()
         return '', termid
@@ -81,12 +86,94 @@ def AddTreeTerm(con, cur, termid, parentid, ontologynameid, commit=True):
         # does not exist - lets add it
         cur.execute('INSERT INTO OntologyTreeStructureTable (ontologyId,ontologyParentId,ontologyNameId) VALUES (%s,%s,%s) RETURNING uniqueId', [termid, parentid, ontologynameid])
         sid = cur.fetchone()[0]
+        AddClosureEdge(con, cur, termid, parentid)
         return '', sid
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in ontology.AddTreeTerm" % e)
         return "error %s enountered in ontology.AddTreeTerm" % e, -2
 
 
+def AddClosureEdge(con, cur, termid, parentid):
+    """
+    Update the OntologyClosureTable for a new tree entry (termid is a child of parentid).
+    Every ancestor of parentid (including itself) becomes an ancestor of every descendant of termid (including itself).
+    A term is in the closure table only if it has a depth 0 row. If termid or parentid is not in it but has other tree parents
+    (i.e. the table was not built yet by dbutils/build_ontology_closure.py), the table is not updated, so the closure rows of a term are never partial.
+    Does not commit. Errors (i.e. OntologyClosureTable does not exist) do not abort the transaction
+
+    input:
+    con,cur
+    termid : int
+        the ontology term id (from OntologyTable)
+    parentid : int
+        the parent ontology term id (from OntologyTable)
+
+    output:
+    updated : bool
+        True if the closure table was updated, False if not
+    """
+    # use a savepoint so a failure (i.e. table does not exist) does not abort the transaction of the tree entry
+    cur.execute('SAVEPOINT add_closure_edge')
+    try:
+        cur.execute('SELECT t.id FROM unnest(%s::integer[]) AS t(id) '
+                    'WHERE NOT EXISTS (SELECT 1 FROM OntologyClosureTable WHERE ancestor_id = t.id AND descendant_id = t.id) '
+                    'AND EXISTS (SELECT 1 FROM OntologyTreeStructureTable WHERE ontologyId = t.id AND NOT (ontologyId = %s AND ontologyParentId = %s))',
+                    [[termid, parentid], termid, parentid])
+        if cur.rowcount > 0:
+            debug(3, 'terms %s not in the ontology closure table. not updating it' % [cres[0] for cres in cur])
+            cur.execute('RELEASE SAVEPOINT add_closure_edge')
+            return False
+        cur.execute('INSERT INTO OntologyClosureTable (ancestor_id, descendant_id, depth) VALUES (%s, %s, 0), (%s, %s, 0) ON CONFLICT DO NOTHING',
+                    [termid, termid, parentid, parentid])
+        cur.execute('INSERT INTO OntologyClosureTable (ancestor_id, descendant_id, depth) '
+                    'SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1 FROM OntologyClosureTable a, OntologyClosureTable d '
+                    'WHERE a.descendant_id = %s AND d.ancestor_id = %s '
+                    'ON CONFLICT (ancestor_id, descendant_id) DO UPDATE SET depth = LEAST(OntologyClosureTable.depth, EXCLUDED.depth)',
+                    [parentid, termid])
+        debug(1, 'updated %d closure entries for term %d parent %d' % (cur.rowcount, termid, parentid))
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when updating ontology closure for term %d parent %d' % (e, termid, parentid))
+        cur.execute('ROLLBACK TO SAVEPOINT add_closure_edge')
+        return False
+    cur.execute('RELEASE SAVEPOINT add_closure_edge')
+    return True
+
+
+def _get_closure_parents(con, cur, termids):
+    """
+    Get the ancestors of terms from the OntologyClosureTable.
+    Errors (i.e. OntologyClosureTable does not exist) do not abort the transaction
+
+    input:
+    con,cur
+    termids : list of int
+        the ontology term ids (from OntologyTable)
+
+    output:
+    parents : dict of {termid(int): list of str}
+        the ancestors of each term (without the term itself) ordered by depth. Only for the terms in the closure table
+        (with a depth 0 row) - terms not in it (i.e. the table was not built yet) are not included
+    """
+    parents = {}
+    cur.execute('SAVEPOINT get_closure_parents')
+    try:
+        cur.execute('SELECT OntologyClosureTable.descendant_id, OntologyClosureTable.depth, OntologyTable.description FROM OntologyClosureTable '
+                    'JOIN OntologyTable ON OntologyTable.id = OntologyClosureTable.ancestor_id '
+                    'WHERE OntologyClosureTable.descendant_id = ANY(%s) '
+                    'ORDER BY OntologyClosureTable.descendant_id, OntologyClosureTable.depth', [list(termids)])
+        for cid, cdepth, cdescription in cur:
+            if cdepth == 0:
+                parents[cid] = []
+            elif cid in parents:
+                parents[cid].append(cdescription)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when getting parents from the ontology closure table' % e)
+        cur.execute('ROLLBACK TO SAVEPOINT get_closure_parents')
+        return {}
+    cur.execute('RELEASE SAVEPOINT get_closure_parents')
+    return parents
+
+
 def AddSynonym(con, cur, termid, synonym, commit=True):
     """
     Add a synonym to OntologySynonymTable
@@ -164,6 +251,15 @@ def GetParents(con, cur, term):
     parents : list of str
         the parents of term
     """
+    # use the worker ontology DAG if the term is in it (terms added in the current transaction are looked up in the database)
+    dag = ontodag.get_ontology_dag(con, cur)
+    if dag is not None:
+        termid = dag.get_term_id(term.lower())
+        if termid is not None:
+            parents = [term] + dag.ancestor_terms(termid)
+            debug(2, 'found %d parents' % len(parents))
+            return '', parents
+
     termid = dbidval.GetIdFromDescription(con, cur, 'OntologyTable', term)
     if termid < 0:
         err, termid = GetSynonymTermId(con, cur, term)
@@ -171,6 +267,17 @@ def GetParents(con, cur, term):
             debug(3, 'ontology term not found for %s' % term)
             return 'ontolgy term %s not found' % term, []
         debug(2, 'converted synonym to termid')
+        if dag is not None and termid in dag.descriptions:
+            parents = [term] + dag.ancestor_terms(termid)
+            debug(2, 'found %d parents' % len(parents))
+            return '', parents
+    # get all the ancestors from the closure table
+    closure = _get_closure_parents(con, cur, [termid])
+    if termid in closure:
+        parents = [term] + closure[termid]
+        debug(2, 'found %d parents' % len(parents))
+        return '', parents
+    # not in the closure table (i.e. it was not built yet) - walk up the tree
     plist = [termid]
     parents = [term]
     while len(plist) > 0:
@@ -188,6 +295,88 @@ def GetParents(con, cur, term):
     return '', parents
 
 
+def GetTermsParents(con, cur, terms):
+    """
+    Get all the parents in the ontology tree of each term in a list of terms (using a fixed number of queries)
+    The parents are taken from the worker ontology DAG (see ontodag.py). Terms not in the DAG (i.e. added in the current
+    transaction) are looked up in the database (OntologyClosureTable, or the tree for terms not in it)
+
+    input:
+    con,cur
+    terms : list of str
+        The terms for which to look for parents (can also be synonyms)
+
+    output:
+    err : str
+        Error message or empty string if ok
+    parents : dict of {term(str): list of str}
+        the parents of each term (including the term itself, as the first item). terms not found are not included
+    """
+    terms = list(set([cterm.lower() for cterm in terms]))
+    if len(terms) == 0:
+        return '', {}
+    parents = {}
+    dag = ontodag.get_ontology_dag(con, cur)
+    if dag is not None:
+        for cterm in terms:
+            ctermid = dag.get_term_id(cterm)
+            if ctermid is not None:
+                parents[cterm] = [cterm] + dag.ancestor_terms(ctermid)
+    missing = [cterm for cterm in terms if cterm not in parents]
+    if len(missing) == 0:
+        debug(2, 'found parents for %d terms' % len(parents))
+        return '', parents
+    try:
+        # get the term ids (the first id if a term appears more than once, as in dbidval.GetIdFromDescription())
+        termids = {}
+        cur.execute('SELECT description, id FROM OntologyTable WHERE description = ANY(%s) ORDER BY id', [missing])
+        for cres in cur:
+            termids.setdefault(cres[0], cres[1])
+        # and the ids of the synonyms
+        synonyms = [cterm for cterm in missing if cterm not in termids]
+        if len(synonyms) > 0:
+            cur.execute('SELECT synonym, idOntology FROM OntologySynonymTable WHERE synonym = ANY(%s)', [synonyms])
+            for cres in cur:
+                termids.setdefault(cres[0], cres[1])
+        for cterm in missing:
+            if cterm not in termids:
+                debug(3, 'ontology term not found for %s' % cterm)
+        # synonyms of terms in the DAG
+        if dag is not None:
+            for cterm, ctermid in list(termids.items()):
+                if ctermid in dag.descriptions:
+                    parents[cterm] = [cterm] + dag.ancestor_terms(ctermid)
+                    del termids[cterm]
+        if len(termids) > 0:
+            # get the ancestors of all the remaining terms from the closure table
+            closure = _get_closure_parents(con, cur, set(termids.values()))
+            for cterm, ctermid in list(termids.items()):
+                if ctermid in closure:
+                    parents[cterm] = [cterm] + closure[ctermid]
+                    del termids[cterm]
+        if len(termids) > 0:
+            # walk up the tree for the terms not in the closure table (i.e. it was not built yet)
+            cur.execute('WITH RECURSIVE ancestors(termid, id) AS ('
+                        'SELECT t.termid, t.termid FROM unnest(%s::bigint[]) AS t(termid) '
+                        'UNION '
+                        'SELECT ancestors.termid, OntologyTreeStructureTable.ontologyParentId FROM ancestors '
+                        'JOIN OntologyTreeStructureTable ON OntologyTreeStructureTable.ontologyId = ancestors.id) '
+                        'SELECT ancestors.termid, OntologyTable.description FROM ancestors JOIN OntologyTable ON OntologyTable.id = ancestors.id '
+                        'WHERE ancestors.id <> ancestors.termid', [list(set(termids.values()))])
+            idparents = {}
+            for cres in cur:
+                if cres[0] not in idparents:
+                    idparents[cres[0]] = []
+                idparents[cres[0]].append(cres[1])
+            for cterm, ctermid in termids.items():
+                parents[cterm] = [cterm] + idparents.get(ctermid, [])
+    except psycopg2.DatabaseError as e:
+        debug(7, "error %s enountered in GetTermsParents" % e)
+        return "error %s enountered in GetTermsParents" % e, {}
+    debug(2, 'found parents for %d terms' % len(parents))
+    return '', parents
+
+
 def GetSynonymTermId(con, cur, synonym):
     """
     Get the term id for which the synonym is
@@ -243,7 +432,7 @@ def GetSynonymTerm(con, cur, synonym):
     return '', term
 
 
-def GetTermAnnotations(con, cur, terms, use_synonyms=True):
+def GetTermAnnotations(con, cur, terms, use_synonyms=True, userid=0):
     '''
     Get details for all annotations which contain the ontology term "term" as a parent of (or exact) annotation detail
 
@@ -253,6 +442,8 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True):
         the ontology term to search. if list, retrieve only annotations containing all the terms in the list
     use_synonyms : bool (optional)
         True (default) to look in synonyms table if term is not found. False to look only for exact term
+    userid : int (optional)
+        the querying userid (private annotations of other users are not returned)
 
     output:
     annotations : list of dict
@@ -261,9 +452,13 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True):
     terms = tolist(terms)
     debug(1, 'GetTermAnnotations for ontology terms %s' % terms)
     annotation_ids = None
+    # private annotations of other users are skipped in the query
+    term_query = ('SELECT AnnotationParentsTable.idannotation FROM AnnotationParentsTable '
+                  'JOIN AnnotationsTable ON AnnotationsTable.id = AnnotationParentsTable.idannotation '
+                  'WHERE AnnotationParentsTable.ontology=%s AND ' + dbannotations.VISIBLE_ANNOTATION_SQL)
     for cterm in terms:
         cterm = cterm.lower()
-        cur.execute('SELECT idannotation FROM AnnotationParentsTable WHERE ontology=%s', [cterm])
+        cur.execute(term_query, [cterm, userid])
         if cur.rowcount == 0:
             if use_synonyms:
                 err, cterm = GetSynonymTerm(con, cur, cterm)
@@ -271,7 +466,7 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True):
                     debug(3, 'no annotations or synonyms for term %s' % cterm)
                     return '', []
                 debug(1, 'found original ontology term %s' % cterm)
-                cur.execute('SELECT idannotation FROM AnnotationParentsTable WHERE ontology=%s', [cterm])
+                cur.execute(term_query, [cterm, userid])
             else:
                     debug(3, 'no annotations for term %s' % cterm)
                     return '', []
@@ -283,17 +478,102 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True):
             annotation_ids = cannotation_ids
         annotation_ids = annotation_ids.intersection(cannotation_ids)
 
-    annotations = []
-    for cannotation_id in annotation_ids:
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cannotation_id)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append(cdetails)
+    err, details = dbannotations.GetAnnotationsFromIDs(con, cur, list(annotation_ids), userid=userid)
+    if err:
+        debug(6, err)
+        return err, []
+    annotations = list(details.values())
     debug(3, 'found %d annotations' % len(annotations))
     return '', annotations
 
 
+def GetTermDescendantAnnotations(con, cur, terms, userid=0, offset=0, limit=None, count_only=False):
+    '''
+    Get details for all annotations with an annotation detail which is the ontology term or any of its descendants
+    (using the OntologyClosureTable). The matching annotations are found (and paged) in one query
+
+    input:
+    con, cur
+    terms : str or list of str
+        the ontology terms to search (can also be synonyms). if list, retrieve only annotations matching all the terms in the list
+    userid : int (optional)
+        the querying userid (private annotations of other users are not returned)
+    offset : int (optional)
+        the number of matching annotations (ordered by annotation id) to skip
+    limit : int or None (optional)
+        the maximal number of annotations to return, or None (default) to return all
+    count_only : bool (optional)
+        True to return only the number of matching annotations (no annotation details)
+
+    output:
+    err : str
+        Error message or empty string if ok
+    count : int
+        the total number of matching annotations (regardless of offset/limit)
+    annotations : list of dict
+        list of annotation details (see dbannotations.GetAnnotationsFromID()) ordered by annotation id. empty if count_only is True
+    '''
+    terms = list(set([cterm.lower() for cterm in tolist(terms)]))
+    debug(1, 'GetTermDescendantAnnotations for ontology terms %s' % terms)
+    try:
+        # get the term ids (from the worker ontology DAG if possible)
+        termids = {}
+        dag = ontodag.get_ontology_dag(con, cur)
+        if dag is not None:
+            for cterm in terms:
+                ctermid = dag.get_term_id(cterm)
+                if ctermid is not None:
+                    termids[cterm] = ctermid
+        missing = [cterm for cterm in terms if cterm not in termids]
+        if len(missing) > 0:
+            cur.execute('SELECT description, id FROM OntologyTable WHERE description = ANY(%s) ORDER BY id', [missing])
+            for cres in cur:
+                termids.setdefault(cres[0], cres[1])
+            synonyms = [cterm for cterm in missing if cterm not in termids]
+            if len(synonyms) > 0:
+                cur.execute('SELECT synonym, idOntology FROM OntologySynonymTable WHERE synonym = ANY(%s)', [synonyms])
+                for cres in cur:
+                    termids.setdefault(cres[0], cres[1])
+        if len(termids) < len(terms):
+            debug(3, 'ontology terms %s not found' % [cterm for cterm in terms if cterm not in termids])
+            return '', 0, []
+        # the annotations with at least one detail under each of the terms
+        ids = list(set(termids.values()))
+        query = ('SELECT AnnotationListTable.idAnnotation FROM AnnotationListTable '
+                 'JOIN OntologyClosureTable ON OntologyClosureTable.descendant_id = AnnotationListTable.idOntology '
+                 'JOIN AnnotationsTable ON AnnotationsTable.id = AnnotationListTable.idAnnotation '
+                 'WHERE OntologyClosureTable.ancestor_id = ANY(%s) AND ' + dbannotations.VISIBLE_ANNOTATION_SQL + ' '
+                 'GROUP BY AnnotationListTable.idAnnotation HAVING COUNT(DISTINCT OntologyClosureTable.ancestor_id) = %s')
+        params = [ids, userid, len(ids)]
+        if count_only or limit is not None or offset > 0:
+            cur.execute('SELECT COUNT(*) FROM (' + query + ') AS matches', params)
+            count = cur.fetchone()[0]
+            if count_only:
+                debug(3, 'found %d annotations' % count)
+                return '', count, []
+        query += ' ORDER BY AnnotationListTable.idAnnotation'
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit)
+        if offset > 0:
+            query += ' OFFSET %s'
+            params.append(offset)
+        cur.execute(query, params)
+        annotation_ids = [cres[0] for cres in cur]
+        if limit is None and offset == 0:
+            count = len(annotation_ids)
+    except psycopg2.DatabaseError as e:
+        debug(7, "error %s enountered in GetTermDescendantAnnotations" % e)
+        return "error %s enountered in GetTermDescendantAnnotations" % e, 0, []
+    err, details = dbannotations.GetAnnotationsFromIDs(con, cur, annotation_ids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, 0, []
+    annotations = [details[cid] for cid in annotation_ids if cid in details]
+    debug(3, 'found %d annotations (returning %d)' % (count, len(annotations)))
+    return '', count, annotations
+
+
 def get_term_counts(con, cur, terms, term_types=('single'), ignore_lower=False):
     '''Get the number of annotations and experiments containing each term in terms.
     NOTE: terms can be also term pairs (term1+term2)
@@ -311,18 +591,14 @@ def get_term_counts(con, cur, terms, term_types=('single'), ignore_lower=False):
     '''
     debug(1, 'get_term_counts for %d terms' % len(terms))
     terms = list(set(terms))
+    cache = terminfo.get_term_info_cache(con, cur)
+    if cache is None:
+        counts = terminfo.fetch_term_counts(cur, terms)
+    else:
+        counts = cache.get_counts(cur, terms)
     term_info = {}
-    for cterm in terms:
-        cur.execute('SELECT TotalExperiments, TotalAnnotations from TermInfoTable WHERE term=%s LIMIT 1', [cterm])
-        # cur.execute('SELECT seqCount, annotationCount, exp_count from OntologyTable WHERE description=%s LIMIT 1', [cterm])
-        if cur.rowcount == 0:
-            debug(2, 'Term %s not found in ontology table' % cterm)
-            continue
-        res = cur.fetchone()
-        term_info[cterm] = {}
-        # term_info[cterm]['total_sequences'] = 0
-        term_info[cterm]['total_experiments'] = res[0]
-        term_info[cterm]['total_annotations'] = res[1]
+    for cterm, (cexperiments, cannotations) in counts.items():
+        term_info[cterm] = {'total_experiments': cexperiments, 'total_annotations': cannotations}
     debug(1, 'found info for %d terms' % len(term_info))
     return term_info
 
@@ -480,14 +756,14 @@ def get_term_pairs_count(con, cur, term_pairs):
     -------
     term_count: dict of {term(str): count(float)}
     '''
-    term_count = {}
-    for cterm in term_pairs:
-        cur.execute("SELECT AnnotationCount from TermPairsTable WHERE TermPair=%s", [cterm])
-        if cur.rowcount == 0:
-            debug(5, 'term pair %s not found' % cterm)
-            term_count[cterm] = 0
-            continue
-        res = cur.fetchone()
-        term_count[cterm] = res[0]
+    index = termpairs.get_term_pair_index(con, cur)
+    if index is not None:
+        term_count = dict(zip(term_pairs, index.lookup(term_pairs)))
+    else:
+        term_count = {cterm: 0 for cterm in term_pairs}
+        if len(term_count) > 0:
+            cur.execute("SELECT DISTINCT ON (TermPair) TermPair, AnnotationCount from TermPairsTable WHERE TermPair = ANY(%s)", [list(term_count.keys())])
+            for cterm, ccount in cur:
+                term_count[cterm] = ccount
     debug(2, 'Found term pairs for %d terms' % len(term_count))
     return term_count
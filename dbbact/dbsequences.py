@@ -1,14 +1,29 @@
 from collections import defaultdict
+import hashlib
+import io
 import psycopg2
 
 import dbbact.primers
 from dbbact.utils import debug
 from . import dbannotations
+from . import seqindex
+from . import kmerindex
+from . import taxindex
+from . import dbversions
 
 # length for the seed sequence
 # used for fast searching of sub sequences
 SEED_SEQ_LEN = 100
 
+# the SequencesTable md5 hash column for each hash type
+HASH_COLUMNS = {'full': 'hashfull', '150': 'hash150', '100': 'hash100'}
+
+# number of ids to get in each query in iter_seq_info()
+SEQ_INFO_BATCH_SIZE = 5000
+
+# minimal number of new sequences for using COPY (instead of separate INSERTs) in AddSequences()
+BULK_INSERT_MIN_SEQS = 20
+
 
 def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4', commit=True):
     """
@@ -34,35 +49,45 @@ def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4',
     """
     # get the primer region id
     seqids = []
-    numadded = 0
     idprimer = dbbact.primers.GetIdFromName(con, cur, primer)
     if idprimer < 0:
         debug(2, 'primer %s not found' % primer)
         return "primer %s not found" % primer, None
     debug(1, 'primerid %s' % idprimer)
+    for cseq in sequences:
+        if len(cseq) < SEED_SEQ_LEN:
+            errmsg = 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq)
+            debug(4, errmsg)
+            return errmsg, None
     try:
+        # get the ids of all the sequences already in the database
+        # (make sure the sequence index contains all the sequences added so far)
+        seqindex.get_index(con, cur, force_refresh=True)
+        err, existing_ids = get_sequences_ids_bulk(con, cur, sequences, idprimer=idprimer, no_shorter=True, no_longer=True)
+        if err:
+            return err, None
+        # the new sequences (each one only once, in case a new sequence appears twice in the list)
+        new_sequences = {}
+        for idx, cseq in enumerate(sequences):
+            cseq = cseq.lower()
+            if len(existing_ids[idx]) > 0 or cseq in new_sequences:
+                continue
+            if taxonomies is None:
+                ctax = 'na'
+            else:
+                ctax = taxonomies[idx].lower()
+            if ggids is None:
+                cggid = 0
+            else:
+                cggid = ggids[idx]
+            new_sequences[cseq] = (ctax, cggid)
+        added_ids = _insert_sequences(con, cur, new_sequences, idprimer)
+        numadded = len(added_ids)
         for idx, cseq in enumerate(sequences):
-            if len(cseq) < SEED_SEQ_LEN:
-                errmsg = 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq)
-                debug(4, errmsg)
-                return errmsg, None
-            # test if already exists, skip it
-            err, cseqid = GetSequenceId(con, cur, sequence=cseq, idprimer=idprimer, no_shorter=True, no_longer=True)
+            cseqid = existing_ids[idx]
+            cseq = cseq.lower()
             if len(cseqid) == 0:
-                # not found, so need to add this sequence
-                if taxonomies is None:
-                    ctax = 'na'
-                else:
-                    ctax = taxonomies[idx].lower()
-                if ggids is None:
-                    cggid = 0
-                else:
-                    cggid = ggids[idx]
-                cseq = cseq.lower()
-                cseedseq = cseq[:SEED_SEQ_LEN]
-                cur.execute('INSERT INTO SequencesTable (idPrimer,sequence,length,taxonomy,ggid,seedsequence) VALUES (%s,%s,%s,%s,%s,%s) RETURNING id', [idprimer, cseq, len(cseq), ctax, cggid, cseedseq])
-                cseqid = cur.fetchone()
-                numadded += 1
+                cseqid = [added_ids[cseq]]
             if len(cseqid) > 1:
                 debug(8, 'AddSequences - Same sequence appears twice in database: %s' % cseq)
             seqids.append(cseqid[0])
@@ -99,29 +124,140 @@ def SeqFromID(con, cur, seqids):
     '''
     if isinstance(seqids, int):
         seqids = [seqids]
-    sequences = []
-    for cseqid in seqids:
-        cur.execute("SELECT sequence,coalesce(taxdomain,''),coalesce(taxphylum,''),  coalesce(taxclass,''),coalesce(taxorder,''),coalesce(taxfamily,''), coalesce(taxgenus,'') as taxonomy_str, total_annotations, total_experiments FROM SequencesTable WHERE id=%s", [cseqid])
-
-        if cur.rowcount == 0:
-            sequences.append({'seq': ''})
-            continue
-        res = cur.fetchone()
-        firstTax = True
-        taxStr = ''
-        list_of_pre_str = ["d__", "p__", "c__", "o__", "f__", "g__"]
-        for idx, val in enumerate(list_of_pre_str):
-            if res[idx + 1]:
-                if firstTax is False:
-                    taxStr += ';'
-                taxStr += val + res[idx + 1]
-                firstTax = False
-
-        cseqinfo = {'seq': res[0], 'taxonomy': taxStr, 'seqid': cseqid, 'total_annotations': res['total_annotations'], 'total_experiments': res['total_experiments']}
-        sequences.append(cseqinfo)
+    try:
+        sequences = list(iter_seq_info(con, cur, seqids))
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return "database error %s" % e, []
     return '', sequences
 
 
+def iter_seq_info(con, cur, seqids, batch_size=SEQ_INFO_BATCH_SIZE):
+    '''Iterate over the information about each sequence id (see SeqFromID()).
+    The ids are fetched from the database in batches of batch_size ids (one query per batch),
+    so the results can be streamed for long id lists
+
+    Parameters
+    ----------
+    con, cur
+    seqids : list of int
+        the ids to get the sequences for
+    batch_size : int (optional)
+        the number of ids to get in each query
+
+    Yields
+    ------
+    dict
+        the information about each sequence (see SeqFromID()), in the order of seqids.
+        {'seq': ''} if the id is not in the database
+    '''
+    # get the sequences from the worker sequence index when possible (so we don't need to transfer them from the database)
+    index = seqindex.get_index(con, cur)
+    for cstart in range(0, len(seqids), batch_size):
+        cids = [int(x) for x in seqids[cstart:cstart + batch_size]]
+        index_seqs = {}
+        if index is not None:
+            for cseqid in cids:
+                cseq, cprimer = index.get_sequence(cseqid)
+                if cseq is not None:
+                    index_seqs[cseqid] = cseq
+        # the taxonomy string (d__XXX;p__YYY;...) skipping the empty levels is built in the query
+        cur.execute("SELECT id, CASE WHEN id = ANY(%s) THEN '' ELSE sequence END AS sequence, "
+                    "concat_ws(';', 'd__' || NULLIF(taxdomain, ''), 'p__' || NULLIF(taxphylum, ''), 'c__' || NULLIF(taxclass, ''), "
+                    "'o__' || NULLIF(taxorder, ''), 'f__' || NULLIF(taxfamily, ''), 'g__' || NULLIF(taxgenus, '')) AS taxonomy_str, "
+                    "total_annotations, total_experiments FROM SequencesTable WHERE id = ANY(%s)", [list(index_seqs.keys()), cids])
+        res = {cres['id']: cres for cres in cur.fetchall()}
+        for cseqid in cids:
+            if cseqid not in res:
+                yield {'seq': ''}
+                continue
+            cres = res[cseqid]
+            yield {'seq': index_seqs.get(cseqid, cres['sequence']), 'taxonomy': cres['taxonomy_str'], 'seqid': cseqid, 'total_annotations': cres['total_annotations'], 'total_experiments': cres['total_experiments']}
+
+
+def get_sequence_hashes(sequence):
+    '''Get the md5 hashes of the sequence (as stored in the hashfull, hash150, hash100 columns of SequencesTable)
+    The hashes are calculated on the upper case sequence
+
+    Parameters
+    ----------
+    sequence : str
+        the sequence (ACGT)
+
+    Returns
+    -------
+    hash_full, hash_150, hash_100 : str
+        the md5 hex digest of the sequence, and of the first 150 / 100 bases ('na' if the sequence is shorter)
+    '''
+    sequence = sequence.upper()
+    hash_full = 'na'
+    hash_150 = 'na'
+    hash_100 = 'na'
+    if len(sequence) > 0:
+        hash_full = hashlib.md5(sequence.encode('utf-8')).hexdigest()
+    if len(sequence) >= 150:
+        hash_150 = hashlib.md5(sequence[:150].encode('utf-8')).hexdigest()
+    if len(sequence) >= 100:
+        hash_100 = hashlib.md5(sequence[:100].encode('utf-8')).hexdigest()
+    return hash_full, hash_150, hash_100
+
+
+def _insert_sequences(con, cur, new_sequences, idprimer):
+    '''Insert new sequences into SequencesTable (together with the seed sequence and the md5 hashes)
+    Large batches are staged with COPY into a temporary table and inserted with one INSERT ... SELECT
+    (skipping sequences already in the table). Does not commit.
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    new_sequences : dict of {sequence(str): (taxonomy(str), ggid(int))}
+        the sequences (lower case) to insert
+    idprimer : int
+        the primer region id of the sequences
+
+    Returns
+    -------
+    dict of {sequence(str): id(int)}
+        the dbbact ids of the sequences
+    '''
+    added_ids = {}
+    if len(new_sequences) == 0:
+        return added_ids
+    if len(new_sequences) < BULK_INSERT_MIN_SEQS:
+        for cseq, (ctax, cggid) in new_sequences.items():
+            hash_full, hash_150, hash_100 = get_sequence_hashes(cseq)
+            cur.execute('INSERT INTO SequencesTable (idPrimer,sequence,length,taxonomy,ggid,seedsequence,hashfull,hash150,hash100) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id',
+                        [idprimer, cseq, len(cseq), ctax, cggid, cseq[:SEED_SEQ_LEN], hash_full, hash_150, hash_100])
+            added_ids[cseq] = cur.fetchone()[0]
+        return added_ids
+
+    debug(2, 'bulk inserting %d sequences' % len(new_sequences))
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS TempNewSequencesTable (pos integer, sequence text, length integer, taxonomy text, ggid integer, seedsequence text, hashfull text, hash150 text, hash100 text) ON COMMIT DROP')
+    cur.execute('TRUNCATE TempNewSequencesTable')
+    data = io.StringIO()
+    for cpos, (cseq, (ctax, cggid)) in enumerate(new_sequences.items()):
+        hash_full, hash_150, hash_100 = get_sequence_hashes(cseq)
+        data.write('\t'.join([str(cpos), _copy_escape(cseq), str(len(cseq)), _copy_escape(ctax), str(cggid), _copy_escape(cseq[:SEED_SEQ_LEN]), hash_full, hash_150, hash_100]) + '\n')
+    data.seek(0)
+    cur.copy_expert('COPY TempNewSequencesTable (pos, sequence, length, taxonomy, ggid, seedsequence, hashfull, hash150, hash100) FROM STDIN', data)
+    # insert only the sequences not already in the database (i.e. added by another request since we checked)
+    cur.execute('INSERT INTO SequencesTable (idPrimer, sequence, length, taxonomy, ggid, seedsequence, hashfull, hash150, hash100) '
+                'SELECT %s, t.sequence, t.length, t.taxonomy, t.ggid, t.seedsequence, t.hashfull, t.hash150, t.hash100 FROM TempNewSequencesTable t '
+                'WHERE NOT EXISTS (SELECT 1 FROM SequencesTable s WHERE s.seedsequence = t.seedsequence AND s.sequence = t.sequence AND s.idPrimer = %s) ORDER BY t.pos',
+                [idprimer, idprimer])
+    debug(2, 'inserted %d new sequences' % cur.rowcount)
+    cur.execute('SELECT s.sequence, min(s.id) FROM TempNewSequencesTable t JOIN SequencesTable s ON s.seedsequence = t.seedsequence AND s.sequence = t.sequence AND s.idPrimer = %s GROUP BY s.sequence', [idprimer])
+    for cres in cur:
+        added_ids[cres[0]] = cres[1]
+    return added_ids
+
+
+def _copy_escape(value):
+    '''Escape a text value for the COPY text format
+    '''
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
 def GetSequencesId(con, cur, sequences, no_shorter=False, no_longer=False):
     """
     Get sequence ids for a sequence or list of sequences
@@ -140,16 +276,213 @@ def GetSequencesId(con, cur, sequences, no_shorter=False, no_longer=False):
     ids : ilist of int
         the list of ids for each sequence (-1 for sequences which were not found)
     """
+    err, seqids = get_sequences_ids_bulk(con, cur, sequences, no_shorter=no_shorter, no_longer=no_longer)
+    if err:
+        return err, []
+    ids = []
+    for cid in seqids:
+        ids.extend(cid)
+    return "", ids
+
+
+def get_sequences_ids_bulk(con, cur, sequences, idprimer=None, no_shorter=False, no_longer=False, kmer_search=False):
+    '''Get the dbbact ids matching each sequence in a list of sequences.
+    Same matching as GetSequenceId(), but all the sequences are resolved together using
+    one query for the seed sequences (and one for the greengenes ids, if any are supplied)
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    sequences : str or list of str (ACGT sequences)
+        the sequences to look for. sequences made only of digits are treated as greengenes ids
+    idprimer : int (optional)
+        if supplied, verify the sequences are from this idPrimer
+    no_shorter : bool (optional)
+        False (default) to enable shorter db sequences matching sequence, True to require at least length of query sequence
+    no_longer : bool (optional)
+        False (default) to enable longer db sequences matching sequence, True to require at least length of database sequence
+    kmer_search : bool (optional)
+        False (default) to match only sequences sharing the prefix with the query.
+        True to use the kmer index (see kmerindex.py) to also match sequences shorter than SEED_SEQ_LEN
+        or trimmed at a different position (no_shorter and no_longer are ignored)
+
+    Returns
+    -------
+    errmsg : str
+        "" if ok, error msg if error encountered
+    ids : list of list of int
+        the ids of the database sequences matching each query sequence (same order as sequences).
+        empty list for sequences which were not found (or are shorter than SEED_SEQ_LEN)
+    '''
     if isinstance(sequences, str):
         sequences = [sequences]
+    if kmer_search:
+        return _get_sequences_ids_kmer(con, cur, sequences, idprimer=idprimer)
+    ids = [[] for cseq in sequences]
+    # the query positions for each seed sequence / greengenes id
+    seed_pos = defaultdict(list)
+    gg_pos = defaultdict(list)
+    for idx, cseq in enumerate(sequences):
+        if cseq.isdigit():
+            gg_pos[int(cseq)].append(idx)
+            continue
+        if len(cseq) < SEED_SEQ_LEN:
+            debug(4, 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq))
+            continue
+        seed_pos[cseq[:SEED_SEQ_LEN].lower()].append(idx)
+    debug(1, 'get_sequences_ids_bulk for %d sequences (%d unique seeds, %d ggids)' % (len(sequences), len(seed_pos), len(gg_pos)))
+
+    try:
+        index = seqindex.get_index(con, cur)
+        if index is not None:
+            for cpos in seed_pos.values():
+                for idx in cpos:
+                    ids[idx] = index.lookup(sequences[idx], idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer)
+        elif len(seed_pos) > 0:
+            candidates = defaultdict(list)
+            cur.execute('SELECT id, sequence, idPrimer, seedsequence FROM SequencesTable WHERE seedsequence = ANY(%s)', [list(seed_pos.keys())])
+            for cres in cur:
+                candidates[cres[3]].append((cres[0], cres[1], cres[2]))
+            for cseed, cpos in seed_pos.items():
+                for idx in cpos:
+                    ids[idx] = _match_seed_candidates(sequences[idx].lower(), candidates[cseed], idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer)
+        if len(gg_pos) > 0:
+            cur.execute('SELECT id, ggid FROM SequencesTable WHERE ggid = ANY(%s)', [list(gg_pos.keys())])
+            for cres in cur:
+                for idx in gg_pos[cres[1]]:
+                    ids[idx].append(cres[0])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return "database error %s" % e, None
+    debug(1, 'found %d out of %d sequences' % (len([x for x in ids if len(x) > 0]), len(sequences)))
+    return '', ids
+
+
+def _get_sequences_ids_kmer(con, cur, sequences, idprimer=None):
+    '''Get the dbbact ids matching each sequence using the kmer index.
+    A database sequence matches if it has an exact overlap with the query, containing the whole query,
+    the whole database sequence or at least SEED_SEQ_LEN bases
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    sequences : list of str (ACGT sequences)
+        the sequences to look for. sequences made only of digits are treated as greengenes ids
+    idprimer : int (optional)
+        if supplied, verify the sequences are from this idPrimer
+
+    Returns
+    -------
+    errmsg : str
+        "" if ok, error msg if error encountered
+    ids : list of list of int
+        the ids of the database sequences matching each query sequence (same order as sequences).
+    '''
+    kindex, index = kmerindex.get_kmer_index(con, cur)
+    if kindex is None:
+        return 'kmer search not available (sequence index disabled)', None
     ids = []
     for cseq in sequences:
-        err, cid = GetSequenceId(con, cur, cseq, no_shorter=no_shorter, no_longer=no_longer)
-        if err:
-            # skip - or should we abort and return an error?
+        if cseq.isdigit():
+            err, cids = GetSequenceIdFromGG(con, cur, int(cseq))
+            if err:
+                debug(3, err)
+                cids = []
+            ids.append(cids)
             continue
-        ids.extend(cid)
-    return "", ids
+        if len(cseq) < kmerindex.MIN_QUERY_LEN:
+            debug(4, 'sequence too short (<%d) for sequence %s' % (kmerindex.MIN_QUERY_LEN, cseq))
+        ids.append(kindex.find(cseq, index, idprimer=idprimer, min_overlap=SEED_SEQ_LEN))
+    debug(1, 'kmer search found %d out of %d sequences' % (len([x for x in ids if len(x) > 0]), len(sequences)))
+    return '', ids
+
+
+def get_sequences_ids_approx(con, cur, sequences, max_mismatches, idprimer=None):
+    '''Get the closest dbbact sequences for each sequence in a list, allowing mismatches.
+    Uses the kmer index for the candidates (see kmerindex.KmerIndex.find_approx())
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    sequences : str or list of str (ACGT sequences)
+        the sequences to look for. sequences made only of digits are treated as greengenes ids
+    max_mismatches : int
+        the maximal number of mismatches between the query and the database sequence (on their overlap)
+    idprimer : int (optional)
+        if supplied, verify the sequences are from this idPrimer
+
+    Returns
+    -------
+    errmsg : str
+        "" if ok, error msg if error encountered
+    ids : list of list of int
+        the ids of the closest database sequences for each query sequence (same order as sequences).
+        empty list for sequences which were not found
+    distances : list of int or None
+        the number of mismatches of the closest database sequences for each query sequence (None if not found)
+    '''
+    if isinstance(sequences, str):
+        sequences = [sequences]
+    try:
+        max_mismatches = int(max_mismatches)
+    except (TypeError, ValueError):
+        return 'max_mismatches must be an int (got %s)' % max_mismatches, None, None
+    if max_mismatches < 0:
+        return 'max_mismatches must be >= 0', None, None
+    kindex, index = kmerindex.get_kmer_index(con, cur)
+    if kindex is None:
+        return 'approximate search not available (sequence index disabled)', None, None
+    ids = []
+    distances = []
+    for cseq in sequences:
+        if cseq.isdigit():
+            err, cids = GetSequenceIdFromGG(con, cur, int(cseq))
+            if err:
+                debug(3, err)
+                cids = []
+            ids.append(cids)
+            distances.append(0 if len(cids) > 0 else None)
+            continue
+        cids, cdist = kindex.find_approx(cseq, index, max_mismatches, idprimer=idprimer, min_overlap=SEED_SEQ_LEN)
+        ids.append(cids)
+        distances.append(cdist)
+    debug(1, 'approximate search found %d out of %d sequences' % (len([x for x in ids if len(x) > 0]), len(sequences)))
+    return '', ids, distances
+
+
+def _match_seed_candidates(cseq, candidates, idprimer=None, no_shorter=False, no_longer=False):
+    '''Get the ids of the candidate database sequences (sharing the seed sequence) matching the query sequence
+
+    Parameters
+    ----------
+    cseq : str
+        the query sequence (lower case)
+    candidates : list of (int, str, int)
+        the (id, sequence, idprimer) of the database sequences sharing the seed sequence with cseq
+    idprimer, no_shorter, no_longer :
+        see GetSequenceId()
+
+    Returns
+    -------
+    list of int
+        the ids of the matching candidates
+    '''
+    sid = []
+    cseqlen = len(cseq)
+    for resid, resseq, resprimer in candidates:
+        if no_shorter:
+            if len(resseq) < cseqlen:
+                continue
+            comparelen = cseqlen
+        else:
+            comparelen = min(len(resseq), cseqlen)
+        if no_longer:
+            if len(resseq) > cseqlen:
+                continue
+        if cseq[:comparelen] == resseq[:comparelen]:
+            if idprimer is None or resprimer == idprimer:
+                sid.append(resid)
+    return sid
 
 
 def GetSequenceIdFromGG(con, cur, ggid):
@@ -188,7 +521,7 @@ def GetSequenceIdFromGG(con, cur, ggid):
     return '', sid
 
 
-def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer=False):
+def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer=False, kmer_search=False):
     """
     Get sequence ids for a sequence
 
@@ -201,6 +534,9 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
         False (default) to enable shorter db sequences matching sequence, True to require at least length of query sequence
     no_longer : bool (optional)
         False (default) to enable longer db sequences matching sequence, True to require at least length of database sequence
+    kmer_search : bool (optional)
+        False (default) to match only sequences sharing the prefix with the query.
+        True to use the kmer index to also match sequences shorter than SEED_SEQ_LEN or trimmed at a different position
 
     output:
     errmsg : str
@@ -216,40 +552,31 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
 
     sid = []
     cseq = sequence.lower()
+    if kmer_search:
+        err, sid = _get_sequences_ids_kmer(con, cur, [cseq], idprimer=idprimer)
+        if err:
+            return err, []
+        sid = sid[0]
+        if len(sid) == 0:
+            errmsg = 'sequence %s not found' % sequence
+            debug(1, errmsg)
+            return errmsg, sid
+        return '', sid
+
     if len(cseq) < SEED_SEQ_LEN:
         errmsg = 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq)
         debug(4, errmsg)
         return errmsg, sid
 
-    # look for all sequences matching the seed
-    cseedseq = cseq[:SEED_SEQ_LEN]
-    cur.execute('SELECT id,sequence FROM SequencesTable WHERE seedsequence=%s', [cseedseq])
-    if cur.rowcount == 0:
-        errmsg = 'sequence %s not found' % sequence
-        debug(1, errmsg)
-        return errmsg, sid
-
-    cseqlen = len(cseq)
-    res = cur.fetchall()
-    for cres in res:
-        resid = cres[0]
-        resseq = cres[1]
-        if no_shorter:
-            if len(resseq) < cseqlen:
-                continue
-            comparelen = cseqlen
-        else:
-            comparelen = min(len(resseq), cseqlen)
-        if no_longer:
-            if len(resseq) > cseqlen:
-                continue
-        if cseq[:comparelen] == resseq[:comparelen]:
-            if idprimer is None:
-                sid.append(resid)
-            cur.execute('SELECT idPrimer FROM SequencesTable WHERE id=%s LIMIT 1', [resid])
-            res = cur.fetchone()
-            if res[0] == idprimer:
-                sid.append(resid)
+    index = seqindex.get_index(con, cur)
+    if index is not None:
+        sid = index.lookup(cseq, idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer)
+    else:
+        # look for all sequences matching the seed
+        cseedseq = cseq[:SEED_SEQ_LEN]
+        cur.execute('SELECT id,sequence,idPrimer FROM SequencesTable WHERE seedsequence=%s', [cseedseq])
+        res = cur.fetchall()
+        sid = _match_seed_candidates(cseq, [(cres[0], cres[1], cres[2]) for cres in res], idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer)
     if len(sid) == 0:
         errmsg = 'sequence %s not found' % sequence
         debug(1, errmsg)
@@ -277,16 +604,88 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
     # return 'sequence %s not found with primer. non primer matches: %d' % (sequence,cur.rowcount),-1
 
 
-def get_taxonomy_seqids(con, cur, taxonomy, userid=None):
-    '''Get a list of all dbbact sequences containing the taxonomy as substring of the dbbact taxonomy
+def get_annotation_counts(con, cur, seqids, userid=None):
+    '''Get the annotations containing any of the sequences, and the number of sequences in each
+
+    Parameters
+    ----------
+    con,cur
+    seqids : list of int
+        the dbbact sequence ids
+    userid : int or None (optional)
+        the userid of the querying user (private annotations of other users are skipped). None for an anonymous user
+
+    Returns
+    -------
+    err : str
+        the error encountered or '' if ok
+    annotationids : list of (int, int) (annotationid, count)
+        the ids of all annotations containing at least one of the sequences, and the number of the sequences in the annotation
+    '''
+    if len(seqids) == 0:
+        return '', []
+    try:
+        cur.execute('SELECT SequencesAnnotationTable.annotationid, COUNT(*) FROM SequencesAnnotationTable '
+                    'JOIN AnnotationsTable ON AnnotationsTable.id = SequencesAnnotationTable.annotationid '
+                    'WHERE SequencesAnnotationTable.seqid = ANY(%s) AND ' + dbannotations.VISIBLE_ANNOTATION_SQL + ' '
+                    'GROUP BY SequencesAnnotationTable.annotationid ORDER BY SequencesAnnotationTable.annotationid', [list(seqids), userid])
+        annotationids = [(cres[0], cres[1]) for cres in cur]
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, []
+    return '', annotationids
+
+
+def get_annotations_with_counts(con, cur, annotationids, userid=0):
+    '''Get the annotation details for a list of (annotationid, count) (i.e. from get_annotation_counts())
+
+    Parameters
+    ----------
+    con,cur
+    annotationids : list of (int, int) (annotationid, count)
+    userid : int or None (optional)
+        the userid of the querying user (private annotations of other users are skipped). None for an anonymous user
+        (should be the userid used in get_annotation_counts())
+
+    Returns
+    -------
+    err : str
+        the error encountered or '' if ok
+    annotations : list of tuples (annotation, counts)
+        annotation - (see dbannotations.GetAnnotationsFromID() )
+        counts - the count supplied for the annotation
+    '''
+    if userid is None:
+        # GetAnnotationsFromIDs() uses userid None to skip the private annotation filtering
+        userid = 0
+    err, details = dbannotations.GetAnnotationsFromIDs(con, cur, [cres[0] for cres in annotationids], userid=userid)
+    if err:
+        return err, []
+    annotations = []
+    for cid, ccount in annotationids:
+        if cid not in details:
+            debug(3, 'annotation %d not found or private' % cid)
+            continue
+        annotations.append((details[cid], ccount))
+    return '', annotations
+
+
+def get_taxonomy_seqids(con, cur, taxonomy, userid=None, rank=None, match='exact'):
+    '''Get a list of all dbbact sequences matching the taxonomy in the dbbact taxonomy
 
     Parameters
     ----------
     con,cur
     taxonomy : str
-        the taxonomy substring to look for
+        the taxonomy name to look for (case insensitive)
     userid : int (optional)
         the userid of the querying user (to enable searching private annotations)
+    rank : str or None (optional)
+        None (default) to look in all the ranks, or the rank to look in (one of taxindex.RANKS, i.e. 'genus')
+    match : str (optional)
+        'exact' (default) to match the whole taxonomy name
+        'prefix' to match taxonomy names starting with taxonomy
+        'substring' to match taxonomy names containing taxonomy
 
     Returns
     -------
@@ -294,9 +693,29 @@ def get_taxonomy_seqids(con, cur, taxonomy, userid=None):
         The sequenceids for all sequences containing the taxonomy
     '''
     taxonomy = taxonomy.lower()
-    taxStr = taxonomy
-    debug(1, 'GetTaxonomyAnnotationIDS for taxonomy %s' % taxonomy)
-    cur.execute('SELECT id from SequencesTable where (taxrootrank ILIKE %s OR taxdomain ILIKE %s OR taxphylum ILIKE %s OR taxclass ILIKE %s OR taxfamily ILIKE %s OR taxgenus ILIKE %s OR taxorder ILIKE %s)', [taxStr, taxStr, taxStr, taxStr, taxStr, taxStr, taxStr])
+    debug(1, 'GetTaxonomyAnnotationIDS for taxonomy %s (rank %s, match %s)' % (taxonomy, rank, match))
+    if rank is not None and rank not in taxindex.RANKS:
+        debug(3, 'rank %s not supported' % rank)
+        return []
+    if match not in taxindex.MATCH_TYPES:
+        debug(3, 'match type %s not supported' % match)
+        return []
+    index = taxindex.get_taxonomy_index(con, cur)
+    if index is not None:
+        seqids = index.lookup(taxonomy, rank=rank, match=match)
+        debug(1, 'found %d matching sequences for the taxonomy' % len(seqids))
+        return seqids
+    if match == 'exact':
+        taxStr = taxonomy
+    else:
+        taxStr = taxonomy.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if match == 'substring':
+            taxStr = '%' + taxStr
+    if rank is None:
+        ranks = taxindex.RANKS
+    else:
+        ranks = [rank]
+    cur.execute('SELECT id from SequencesTable where (%s)' % ' OR '.join(['tax%s ILIKE %%s' % crank for crank in ranks]), [taxStr] * len(ranks))
     res = cur.fetchall()
     seqids = []
     for cres in res:
@@ -305,7 +724,7 @@ def get_taxonomy_seqids(con, cur, taxonomy, userid=None):
     return seqids
 
 
-def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None):
+def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None, rank=None, match='exact'):
     '''
     Get annotationids for all annotations containing any sequence matching the taxonomy (substring)
 
@@ -316,6 +735,10 @@ def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None):
         the taxonomy substring to look for
     userid : int (optional)
         the userid of the querying user (to enable searching private annotations)
+    rank : str or None (optional)
+        None (default) to look in all the ranks, or the rank to look in (see get_taxonomy_seqids())
+    match : str (optional)
+        the taxonomy match type - 'exact' (default), 'prefix' or 'substring' (see get_taxonomy_seqids())
 
     Returns
     -------
@@ -324,7 +747,7 @@ def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None):
     seqids : list of int
         list of the sequenceids that have this annotation
     '''
-    seqids = get_taxonomy_seqids(con, cur, taxonomy=taxonomy, userid=userid)
+    seqids = get_taxonomy_seqids(con, cur, taxonomy=taxonomy, userid=userid, rank=rank, match=match)
     # taxonomy = taxonomy.lower()
     # taxStr = taxonomy
     # debug(1, 'GetTaxonomyAnnotationIDS for taxonomy %s' % taxonomy)
@@ -334,21 +757,14 @@ def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None):
     # for cres in res:
     #     seqids.append(cres[0])
     # debug(1, 'found %d matching sequences for the taxonomy' % len(seqids))
-    annotationids_dict = defaultdict(int)
-    for cseq in seqids:
-        cur.execute('SELECT annotationid from sequencesAnnotationTable where seqid=%s', [cseq])
-        res = cur.fetchall()
-        for cres in res:
-            annotationids_dict[cres[0]] += 1
-    # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the taxonomy' % len(annotationids_dict))
-    annotationids = []
-    for k, v in annotationids_dict.items():
-        annotationids.append((k, v))
+    err, annotationids = get_annotation_counts(con, cur, seqids, userid=userid)
+    if err:
+        return err, [], []
+    debug(1, 'found %d unique annotations for the taxonomy' % len(annotationids))
     return '', annotationids, seqids
 
 
-def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None):
+def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None, rank=None, match='exact'):
     '''
     Get annotations for all annotations containing any sequence matching the taxonomy (substring)
 
@@ -359,6 +775,10 @@ def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None):
         the taxonomy substring to look for
     userid : int (optional)
         the userid of the querying user (to enable searching private annotations)
+    rank : str or None (optional)
+        None (default) to look in all the ranks, or the rank to look in (see get_taxonomy_seqids())
+    match : str (optional)
+        the taxonomy match type - 'exact' (default), 'prefix' or 'substring' (see get_taxonomy_seqids())
 
     Returns
     -------
@@ -371,21 +791,16 @@ def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None):
     '''
     debug(1, 'GetTaxonomyAnnotations for taxonomy %s' % taxonomy)
     # get the annotation ids
-    err, annotationids, seqids = GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid)
+    err, annotationids, seqids = GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid, rank=rank, match=match)
     if err:
         errmsg = 'Failed to get annotationIDs for taxonomy %s: %s' % (taxonomy, err)
         debug(6, errmsg)
-        return errmsg, None
-    # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbbact.dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
+        return errmsg, None, None
+    # and get the annotation details for all of them
+    err, annotations = get_annotations_with_counts(con, cur, annotationids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, None, None
     debug(1, 'got %d details' % len(annotations))
     return '', annotations, seqids
 
@@ -410,9 +825,8 @@ def GetHashAnnotationIDs(con, cur, hash_str, userid=None):
         list of the sequenceids that have this annotation
     '''
     hash_str = hash_str.lower()
-    taxStr = hash_str
     debug(1, 'GetHashAnnotationIDS for Hash %s' % hash_str)
-    cur.execute('SELECT id,sequence from SequencesTable where (hashfull ILIKE %s or hash150 ILIKE %s or hash100 ILIKE %s)', [hash_str, hash_str, hash_str])
+    cur.execute('SELECT id,sequence from SequencesTable where (hashfull=%s or hash150=%s or hash100=%s)', [hash_str, hash_str, hash_str])
     res = cur.fetchall()
     seqids = []
     seqnames = []
@@ -420,20 +834,83 @@ def GetHashAnnotationIDs(con, cur, hash_str, userid=None):
         seqids.append(cres[0])
         seqnames.append(cres[1])
     debug(1, 'found %d matching sequences for the Hash' % len(seqids))
-    annotationids_dict = defaultdict(int)
-    for cseq in seqids:
-        cur.execute('SELECT annotationid from sequencesAnnotationTable where seqid=%s', [cseq])
-        res = cur.fetchall()
-        for cres in res:
-            annotationids_dict[cres[0]] += 1
-    # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the Hash' % len(annotationids_dict))
-    annotationids = []
-    for k, v in annotationids_dict.items():
-        annotationids.append((k, v))
+    err, annotationids = get_annotation_counts(con, cur, seqids, userid=userid)
+    if err:
+        return err, [], [], []
+    debug(1, 'found %d unique annotations for the Hash' % len(annotationids))
     return '', annotationids, seqids, seqnames
 
 
+def get_sequences_ids_from_hashes(con, cur, hashes, hash_type=None, idprimer=None):
+    '''Get the dbbact ids matching each md5 hash in a list of hashes (exact match on the indexed hash columns)
+    The hashes are of the upper case sequence (see get_sequence_hashes())
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    hashes : str or list of str
+        the md5 hex digests to look for
+    hash_type : str or None (optional)
+        the hash column to search: 'full' (the whole sequence), '150' or '100' (the first 150/100 bases),
+        or None (default) to search all three
+    idprimer : int (optional)
+        if supplied, return only sequences from this idPrimer
+
+    Returns
+    -------
+    errmsg : str
+        "" if ok, error msg if error encountered
+    ids : list of list of int
+        the ids of the database sequences matching each hash (same order as hashes)
+    '''
+    if isinstance(hashes, str):
+        hashes = [hashes]
+    if hash_type is None:
+        columns = ['hashfull', 'hash150', 'hash100']
+    elif hash_type in HASH_COLUMNS:
+        columns = [HASH_COLUMNS[hash_type]]
+    else:
+        return 'hash_type %s not supported. options are: %s' % (hash_type, list(HASH_COLUMNS.keys())), None
+    hashes = [chash.lower() for chash in hashes]
+    hash_pos = defaultdict(list)
+    for idx, chash in enumerate(hashes):
+        hash_pos[chash].append(idx)
+    debug(1, 'get_sequences_ids_from_hashes for %d hashes (%d unique)' % (len(hashes), len(hash_pos)))
+    ids = [[] for chash in hashes]
+    try:
+        uniquehashes = list(hash_pos.keys())
+        # each column has its own index, so OR of the = ANY() conditions is a bitmap OR of index scans
+        cur.execute('SELECT id, idPrimer, %s FROM SequencesTable WHERE %s' % (', '.join(columns), ' OR '.join(['%s = ANY(%%s)' % ccol for ccol in columns])), [uniquehashes] * len(columns))
+        for cres in cur:
+            if idprimer is not None and cres[1] != idprimer:
+                continue
+            # the same sequence can match a hash in more than one column (i.e. a 100bp sequence has hashfull=hash100)
+            for chash in set(cres[2:]):
+                for idx in hash_pos.get(chash, []):
+                    ids[idx].append(cres[0])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return "database error %s" % e, None
+    debug(1, 'found %d out of %d hashes' % (len([x for x in ids if len(x) > 0]), len(hashes)))
+    return '', ids
+
+
+def get_exact_distances(ids):
+    '''Get the number of mismatches for exact matches (i.e. from get_sequences_ids_from_hashes()), in the format of get_sequences_ids_approx()
+
+    Parameters
+    ----------
+    ids : list of list of int
+        the ids of the database sequences matching each query sequence
+
+    Returns
+    -------
+    list of int or None
+        0 for each query sequence with a match, None if not found
+    '''
+    return [0 if len(cids) > 0 else None for cids in ids]
+
+
 def get_seqs_from_db_id(con, cur, db_name, db_seq_id):
     '''Get all sequences that match the db_seq_id supplied for silva/greengenes
 
@@ -508,17 +985,10 @@ def GetGgAnnotationIDs(con, cur, gg_str, userid=None):
     if err != '':
         return err, [], [], []
 
-    annotationids_dict = defaultdict(int)
-    for cseq in seqids:
-        cur.execute('SELECT annotationid from sequencesAnnotationTable where seqid=%s', [cseq])
-        res = cur.fetchall()
-        for cres in res:
-            annotationids_dict[cres[0]] += 1
-    # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the gg' % len(annotationids_dict))
-    annotationids = []
-    for k, v in annotationids_dict.items():
-        annotationids.append((k, v))
+    err, annotationids = get_annotation_counts(con, cur, seqids, userid=userid)
+    if err:
+        return err, [], [], []
+    debug(1, 'found %d unique annotations for the gg' % len(annotationids))
     return '', annotationids, seqids, seqnames
 
 
@@ -558,17 +1028,10 @@ def GetSilvaAnnotationIDs(con, cur, silva_str, userid=None):
     #     seqids.append(cres[0])
     #     seqnames.append(cres[1])
     debug(1, 'found %d matching sequences for the silva' % len(seqids))
-    annotationids_dict = defaultdict(int)
-    for cseq in seqids:
-        cur.execute('SELECT annotationid from sequencesAnnotationTable where seqid=%s', [cseq])
-        res = cur.fetchall()
-        for cres in res:
-            annotationids_dict[cres[0]] += 1
-    # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the Silva' % len(annotationids_dict))
-    annotationids = []
-    for k, v in annotationids_dict.items():
-        annotationids.append((k, v))
+    err, annotationids = get_annotation_counts(con, cur, seqids, userid=userid)
+    if err:
+        return err, [], [], []
+    debug(1, 'found %d unique annotations for the Silva' % len(annotationids))
     return '', annotationids, seqids, seqnames
 
 
@@ -600,17 +1063,12 @@ def GetHashAnnotations(con, cur, hash_str, userid=None):
     if err:
         errmsg = 'Failed to get annotationIDs for hash_str %s: %s' % (hash_str, err)
         debug(6, errmsg)
-        return errmsg, None
-    # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbbact.dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
+        return errmsg, None, None, None
+    # and get the annotation details for all of them
+    err, annotations = get_annotations_with_counts(con, cur, annotationids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, None, None, None
     debug(1, 'got %d details' % len(annotations))
     return '', annotations, seqids, seqnames
 
@@ -643,17 +1101,12 @@ def GetGgAnnotations(con, cur, gg_str, userid=None):
     if err:
         errmsg = 'Failed to get annotationIDs for gg_str %s: %s' % (gg_str, err)
         debug(6, errmsg)
-        return errmsg, None
-    # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
+        return errmsg, None, None, None
+    # and get the annotation details for all of them
+    err, annotations = get_annotations_with_counts(con, cur, annotationids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, None, None, None
     debug(1, 'got %d details' % len(annotations))
     return '', annotations, seqids, seqnames
 
@@ -686,17 +1139,12 @@ def GetSilvaAnnotations(con, cur, silva_str, userid=None):
     if err:
         errmsg = 'Failed to get annotationIDs for silva_str %s: %s' % (silva_str, err)
         debug(6, errmsg)
-        return errmsg, None
-    # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
+        return errmsg, None, None, None
+    # and get the annotation details for all of them
+    err, annotations = get_annotations_with_counts(con, cur, annotationids, userid=userid)
+    if err:
+        debug(6, err)
+        return err, None, None, None
     debug(1, 'got %d details' % len(annotations))
     return '', annotations, seqids, seqnames
 
@@ -922,6 +1370,8 @@ def AddSequenceTax(con, cur, seq_id, col, value):
 
     try:
         cur.execute("update annotationschematest.sequencestable set %s='%s' where id=%s" % (col, value, seq_id))
+        # invalidate the worker taxonomy indices (see taxindex.py)
+        dbversions.bump_version(con, cur, taxindex.VERSION_NAME)
         con.commit()
         return True
     except:
@@ -977,6 +1427,37 @@ def GetSequenceTaxonomy(con, cur, sequence, region=None, userid=0):
     return '', taxStr
 
 
+def GetSequencesTaxonomy(con, cur, sequences):
+    """
+    Get taxonomy str for each sequence in a list of sequences (in one query)
+
+    Parameters
+    ----------
+    con,cur :
+    sequences : list of str ('ACGT')
+        the sequences to search for in the database
+
+    Returns
+    -------
+    err : str
+        The error encountered or '' if ok
+    taxonomy: list of str
+        The taxonomy string (of format d__XXX;p__YYYY;...) for each sequence (same order as sequences). 'NA' for sequences not in the database
+    """
+    debug(1, 'GetSequencesTaxonomy for %d sequences' % len(sequences))
+    seqs = [cseq.lower() for cseq in sequences]
+    try:
+        cur.execute("SELECT DISTINCT ON (sequence) sequence, "
+                    "concat_ws(';', 'd__' || NULLIF(taxdomain, ''), 'p__' || NULLIF(taxphylum, ''), 'c__' || NULLIF(taxclass, ''), "
+                    "'o__' || NULLIF(taxorder, ''), 'f__' || NULLIF(taxfamily, ''), 'g__' || NULLIF(taxgenus, '')) AS taxonomy_str "
+                    "FROM SequencesTable WHERE sequence = ANY(%s)", [list(set(seqs))])
+        seq_tax = {cres[0]: cres[1] for cres in cur}
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return "database error %s" % e, []
+    return '', [seq_tax.get(cseq, 'NA') for cseq in seqs]
+
+
 def get_primers(con, cur):
     '''Get information about all the sequencing primers used in dbbact
 
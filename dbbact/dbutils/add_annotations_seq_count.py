@@ -9,7 +9,7 @@ import argparse
 import psycopg2
 import psycopg2.extras
 
-from dbbact import dbannotations
+from dbbact import dbannotations, annotationcache
 
 __version__ = "0.9"
 
@@ -74,7 +74,7 @@ def connect_db(servertype='main', schema='AnnotationSchemaTest'):
         return None
 
 
-def fill_annotation_seqcount(servertype='develop', overwrite=False):
+def fill_annotation_seqcount(servertype='develop', overwrite=False, annotation_cache=None):
     '''
     Fill the database AnnotationsTable seqCount field
 
@@ -85,10 +85,15 @@ def fill_annotation_seqcount(servertype='develop', overwrite=False):
 
     overwrite : bool (optional)
         False (default) to not overwrite existing (non-zero) seqCounts, True to delete all
+    annotation_cache : str or None (optional)
+        the server annotation cache file (DBBACT_ANNOTATION_CACHE) to invalidate the changed annotations in, or None to skip
     '''
+    if annotation_cache is not None:
+        annotationcache.CACHE_FILE = annotation_cache
     con, cur = connect_db(servertype=servertype)
     skipped = 0
     added = 0
+    changed = []
     cur.execute('SELECT id,seqCount from AnnotationsTable')
     annotations = cur.fetchall()
     for cres in annotations:
@@ -106,8 +111,18 @@ def fill_annotation_seqcount(servertype='develop', overwrite=False):
         if numseqs != len(set(annotationdetails)):
             debug(3, 'WARNING: duplicate seqids for annotation %d' % cid)
         cur.execute('UPDATE AnnotationsTable SET seqCount = %s WHERE id = %s', [numseqs, cid])
+        if numseqs != cseqcount:
+            changed.append(cid)
         added += 1
+    # the cached annotations (num_sequences) of the changed annotations are invalidated before and after the commit
+    err = dbannotations.InvalidateCachedAnnotations(con, cur, changed)
+    if err:
+        print('annotation cache error: %s. changes not committed' % err)
+        return
     con.commit()
+    err = dbannotations.InvalidateCachedAnnotations(con, cur, changed)
+    if err:
+        print('annotation cache error after commit: %s. delete the annotation cache file %s' % (err, annotationcache.CACHE_FILE))
     print('added %d, skipped %d' % (added, skipped))
 
 
@@ -115,8 +130,9 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Fill seqCount field in AnnotationsTable. version ' + __version__)
     parser.add_argument('--db', help='name of database to connect to (main/develop/local)', default='develop')
     parser.add_argument('--overwrite', help='delete current numbers', action='store_true')
+    parser.add_argument('--annotation-cache', help='the server annotation cache file to update (default is the DBBACT_ANNOTATION_CACHE environment variable)', default=os.environ.get('DBBACT_ANNOTATION_CACHE'))
     args = parser.parse_args(argv)
-    fill_annotation_seqcount(servertype=args.db, overwrite=args.overwrite)
+    fill_annotation_seqcount(servertype=args.db, overwrite=args.overwrite, annotation_cache=args.annotation_cache)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
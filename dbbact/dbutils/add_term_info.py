@@ -11,6 +11,7 @@ from collections import defaultdict
 import psycopg2.extras
 
 from dbbact.utils import SetDebugLevel, debug
+from dbbact import dbversions, terminfo
 
 __version__ = "0.9"
 
@@ -219,6 +220,8 @@ def add_term_info(servertype='develop', overwrite=False, add_pairs=True, add_sin
                 num_pairs += 1
 
     debug(6, 'updated %d single, %d pairs' % (num_single, num_pairs))
+    # invalidate the dbbact worker term info caches (committed together with the new counts)
+    dbversions.bump_version(con, cur, terminfo.VERSION_NAME)
     debug(6, 'commiting')
     con.commit()
     debug(6, 'done')
@@ -14,12 +14,18 @@ Adding is based on complete match of dbbact sequence to database (as a subsequen
 '''
 
 import sys
-from collections import defaultdict
+import os
+
+sys.path.append(os.getcwd())
 
 import argparse
+import numpy as np
 import psycopg2
 import psycopg2.extras
 
+from dbbact import seqindex
+from dbbact import seqstore
+
 __version__ = "0.1"
 
 
@@ -90,51 +96,29 @@ def connect_db(servertype='main', schema='AnnotationSchemaTest'):
 		return None
 
 
-def dbbact_seqs_to_fasta(output_file='dbbact_seqs.fa', servertype='main'):
-	con, cur = connect_db(servertype=servertype)
-	print('getting sequences from database')
-	cur.execute('SELECT id,sequence,ggid FROM SequencesTable')
-	seq_count = 0
-	with open(output_file, 'w') as fl:
-		for cres in cur:
-			fl.write('>%s\n%s\n' % (cres[0], cres[1]))
-			seq_count += 1
-	print('got %d sequences' % seq_count)
-
-
-def hash_sequences(filename, short_len=100):
-	'''hash all the sequences in a fasta file
+def get_short_hashes(store, short_len=150):
+	'''hash the first short_len bases of all the sequences in the packed sequence store
 
 	Parameters
 	----------
-	filename: str
-		the fasta file
+	store: seqstore.PackedSequenceStore
+		the dbbact sequences
+	short_len: int
+		the prefix length to hash (shorter sequences are skipped)
 
 	Returns
 	-------
-	seq_hash: dict of {seq: seqid}
-	seq_lens : list of int
-		all the sequence lengths in the fasta file (so we can hash all the lengths in the queries)
-	short_hash: dict of {short_seq: seq_hash dict}
+	short_hashes: numpy array of uint64
+		the (sorted) hash of the first short_len bases of each sequence
+	short_entries: numpy array of int
+		the store entry for each hash
 	'''
-	num_too_short = 0
-	seq_hash = {}
-	seq_lens = set()
-	short_hash = defaultdict(dict)
-	for cseq, chead in iter_fasta_seqs(filename):
-		clen = len(cseq)
-		if clen < short_len:
-			num_too_short += 1
-			continue
-		short_seq = cseq[:short_len]
-		short_hash[short_seq][cseq] = chead
-		if clen not in seq_lens:
-			seq_lens.add(clen)
-		seq_hash[cseq] = chead
-	print('processed %d sequences.' % len(seq_hash))
-	print('lens: %s' % seq_lens)
-	print('num too short: %d' % num_too_short)
-	return seq_hash, seq_lens, short_hash
+	entries = np.flatnonzero(store.lengths >= short_len)
+	short_hashes = np.array([seqstore.prefix_hashes(store.get_codes(centry))[short_len] for centry in entries], dtype=np.uint64)
+	order = np.argsort(short_hashes)
+	print('processed %d sequences.' % len(entries))
+	print('num too short: %d' % (len(store) - len(entries)))
+	return short_hashes[order], entries[order]
 
 
 def iter_fasta_seqs(filename):
@@ -167,25 +151,28 @@ def iter_fasta_seqs(filename):
 
 
 def add_whole_seq_ids(filename, servertype='local', short_len=150, seqdbid='1'):
-	dbbact_seqs_to_fasta(output_file='dbbact_seqs.fa', servertype=servertype)
-	seq_hash, seq_lens, short_hash = hash_sequences(filename='dbbact_seqs.fa', short_len=short_len)
+	con, cur = connect_db(servertype=servertype)
+	print('getting sequences from database')
+	store = seqindex.build_store(cur)
+	short_hashes, short_entries = get_short_hashes(store, short_len=short_len)
 	idx = 0
 	num_matches = 0
-	con, cur = connect_db(servertype=servertype)
 	for cseq, chead in iter_fasta_seqs(filename):
 		idx += 1
 		if idx % 1000 == 0:
 			print(idx)
-		for cpos in range(len(cseq) - short_len):
-				ccseq = cseq[cpos:cpos + short_len]
-				if ccseq in short_hash:
-					# print('found short with %d sequences' % len(short_hash[ccseq]))
-					for k, v in short_hash[ccseq].items():
-						if k in cseq:
-							cid = chead.split(' ')[0]
-							cur.execute('INSERT INTO wholeSeqIDsTable (dbid, dbbactid, wholeseqid) VALUES (%s, %s, %s)', [seqdbid, v, cid])
-							num_matches += 1
-							# print('found %s' % v)
+		codes = seqstore.encode_sequence(cseq)
+		# hash all the windows of the whole sequence, and look for dbbact sequences starting there
+		whashes = seqstore.window_hashes(codes, short_len)
+		starts = np.searchsorted(short_hashes, whashes, side='left')
+		ends = np.searchsorted(short_hashes, whashes, side='right')
+		for cpos in np.flatnonzero(ends > starts):
+			for centry in short_entries[starts[cpos]:ends[cpos]]:
+				ccodes = store.get_codes(centry)
+				if np.array_equal(codes[cpos:cpos + len(ccodes)], ccodes):
+					cid = chead.split(' ')[0]
+					cur.execute('INSERT INTO wholeSeqIDsTable (dbid, dbbactid, wholeseqid) VALUES (%s, %s, %s)', [seqdbid, int(store.ids[centry]), cid])
+					num_matches += 1
 	print('found %d dbbact sequences in database' % num_matches)
 	con.commit()
 	print('done')
@@ -9,7 +9,7 @@ import argparse
 import psycopg2
 import psycopg2.extras
 
-from dbbact import dbannotations
+from dbbact import dbannotations, annotationcache
 
 __version__ = "1.1"
 
@@ -74,7 +74,7 @@ def connect_db(servertype='main', schema='AnnotationSchemaTest'):
         return None
 
 
-def fill_parents(servertype='develop', overwrite=False):
+def fill_parents(servertype='develop', overwrite=False, annotation_cache=None):
     '''
     Fill the database AnnotationParentsTable
 
@@ -85,10 +85,15 @@ def fill_parents(servertype='develop', overwrite=False):
 
     overwrite : bool (optional)
         False (default) to not overwrite existing annotation parents, True to delete all
+    annotation_cache : str or None (optional)
+        the server annotation cache file (DBBACT_ANNOTATION_CACHE) to invalidate the changed annotations in, or None to skip
     '''
+    if annotation_cache is not None:
+        annotationcache.CACHE_FILE = annotation_cache
     con, cur = connect_db(servertype=servertype)
     skipped = 0
     added = 0
+    changed = []
     if overwrite:
         # delete the current counts since we are updating all entries (and addparents adds 1 to the counts...)
         cur.execute('UPDATE OntologyTable SET seqCount=0, annotationCount=0')
@@ -109,9 +114,17 @@ def fill_parents(servertype='develop', overwrite=False):
         if err:
             print('error: %s' % err)
             continue
-        dbannotations.AddAnnotationParents(con, cur, cid, annotationdetails, commit=False, numseqs=cseqcount)
+        err, numadded = dbannotations.AddAnnotationParents(con, cur, cid, annotationdetails, commit=False, numseqs=cseqcount)
+        if err:
+            print('error: %s. changes not committed' % err)
+            return
+        changed.append(cid)
         added += 1
     con.commit()
+    # AddAnnotationParents() invalidates the annotations before the commit, so invalidate them (and their experiment bundles) again
+    err = dbannotations.InvalidateCachedAnnotations(con, cur, changed)
+    if err:
+        print('annotation cache error after commit: %s. delete the annotation cache file %s' % (err, annotationcache.CACHE_FILE))
     print('added %d, skipped %d' % (added, skipped))
 
 
@@ -119,8 +132,9 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Fill parents table in database. version ' + __version__)
     parser.add_argument('--db', help='name of database to connect to (main/develop/local)', default='develop')
     parser.add_argument('--overwrite', help='delete current annotations', action='store_true')
+    parser.add_argument('--annotation-cache', help='the server annotation cache file to update (default is the DBBACT_ANNOTATION_CACHE environment variable)', default=os.environ.get('DBBACT_ANNOTATION_CACHE'))
     args = parser.parse_args(argv)
-    fill_parents(servertype=args.db, overwrite=args.overwrite)
+    fill_parents(servertype=args.db, overwrite=args.overwrite, annotation_cache=args.annotation_cache)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import sys
+import os
+
+sys.path.append(os.getcwd())
+
+import argparse
+import psycopg2
+import psycopg2.extras
+
+from dbbact.utils import SetDebugLevel, debug
+from dbbact import kmerindex
+from dbbact import seqindex
+
+__version__ = "0.9"
+
+
+def connect_db(servertype='main', schema='AnnotationSchemaTest'):
+    """
+    connect to the postgres database and return the connection and cursor
+    input:
+    servertype : str (optional)
+        the database to access. options are:
+            'main' (default) - the main remote production database
+            'develop' - the remote development database
+            'local' - a local postgres instance of the database
+            'amnon' - the local mac installed veriosn of dbbact
+    schema : str (optional)
+        name of the schema containing the annotation database
+
+    output:
+    con : the database connection
+    cur : the database cursor
+    """
+    debug(1, 'connecting to database')
+    try:
+        database = 'scdb'
+        user = 'postgres'
+        password = 'admin123'
+        port = 5432
+        host = 'localhost'
+        if servertype == 'main':
+            debug(1, 'servertype is main')
+            database = 'scdb'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'develop':
+            debug(1, 'servertype is develop')
+            database = 'scdb_develop'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'local':
+            debug(1, 'servertype is local')
+            database = 'postgres'
+            user = 'postgres'
+            password = 'admin123'
+            port = 5432
+        elif servertype == 'amnon':
+            debug(1, 'servertype is amnon')
+            database = 'dbbact'
+            user = 'amnon'
+            password = 'magNiv'
+            port = 5432
+        elif servertype == 'openu':
+            debug(1, 'servertype is openu')
+            database = 'scdb'
+            user = 'postgres'
+            password = 'magNiv'
+            port = 5432
+        else:
+            debug(6, 'unknown server type %s' % servertype)
+            print('unknown server type %s' % servertype)
+        if servertype == 'openu':
+            debug(1, 'connecting database=%s, user=%s, port=%d' % (database, user, port))
+            con = psycopg2.connect(database=database, user=user, password=password, port=port)
+        else:
+            debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (host, database, user, port))
+            con = psycopg2.connect(host=host, database=database, user=user, password=password, port=port)
+        cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute('SET search_path to %s' % schema)
+        debug(1, 'connected to database')
+        return (con, cur)
+    except psycopg2.DatabaseError as e:
+        print('Cannot connect to database. Error %s' % e)
+        raise SystemError('Cannot connect to database. Error %s' % e)
+
+
+def build_kmer_index(servertype='develop', output='dbbact-kmer-index'):
+    '''Build the minimizer index of all the dbbact sequences and save it as .npy files
+    The server loads the index from these files if the DBBACT_KMER_INDEX environment variable is set to the output prefix
+
+    Parameters
+    ----------
+    servertype : str (optional)
+        the database to connect to (main/develop/local/amnon/openu)
+    output : str (optional)
+        the output file name prefix (creates output.hashes.npy, output.ids.npy, output.positions.npy)
+    '''
+    con, cur = connect_db(servertype=servertype)
+    debug(3, 'loading sequences')
+    index = seqindex.SequenceIndex()
+    index.load(cur)
+    debug(3, 'building kmer index for %d sequences' % index.num_ids())
+    hashes, ids, positions = kmerindex.build_arrays([(cid, index.get_codes(cid)[0]) for cid in index.ids_from(0)])
+    debug(3, 'saving %d minimizers to %s' % (len(hashes), output))
+    kmerindex.save_arrays(output, hashes, ids, positions)
+    debug(3, 'done')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the dbbact sequence kmer index. version ' + __version__)
+    parser.add_argument('--db', help='name of database to connect to (main/develop/local/amnon)', default='develop')
+    parser.add_argument('-o', '--output', help='output index file name prefix', default='dbbact-kmer-index')
+    parser.add_argument('--log-level', help='log level (1 is most detailed, 10 is only critical', default=1, type=int)
+    args = parser.parse_args(argv)
+    SetDebugLevel(args.log_level)
+    build_kmer_index(servertype=args.db, output=args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import sys
+import os
+
+sys.path.append(os.getcwd())
+
+import argparse
+import io
+import psycopg2
+import psycopg2.extras
+
+from dbbact.utils import SetDebugLevel, debug
+from dbbact import ontodag
+
+__version__ = "1.0"
+
+
+def connect_db(servertype='main', schema='AnnotationSchemaTest'):
+    """
+    connect to the postgres database and return the connection and cursor
+    input:
+    servertype : str (optional)
+        the database to access. options are:
+            'main' (default) - the main remote production database
+            'develop' - the remote development database
+            'local' - a local postgres instance of the database
+            'amnon' - the local mac installed veriosn of dbbact
+    schema : str (optional)
+        name of the schema containing the annotation database
+
+    output:
+    con : the database connection
+    cur : the database cursor
+    """
+    debug(1, 'connecting to database')
+    try:
+        database = 'scdb'
+        user = 'postgres'
+        password = 'admin123'
+        port = 5432
+        host = 'localhost'
+        if servertype == 'main':
+            debug(1, 'servertype is main')
+            database = 'scdb'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'develop':
+            debug(1, 'servertype is develop')
+            database = 'scdb_develop'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'local':
+            debug(1, 'servertype is local')
+            database = 'postgres'
+            user = 'postgres'
+            password = 'admin123'
+            port = 5432
+        elif servertype == 'amnon':
+            debug(1, 'servertype is amnon')
+            database = 'dbbact'
+            user = 'amnon'
+            password = 'magNiv'
+            port = 5432
+        elif servertype == 'openu':
+            debug(1, 'servertype is openu')
+            database = 'scdb'
+            user = 'postgres'
+            password = 'magNiv'
+            port = 5432
+        else:
+            debug(6, 'unknown server type %s' % servertype)
+            print('unknown server type %s' % servertype)
+        if servertype == 'openu':
+            debug(1, 'connecting database=%s, user=%s, port=%d' % (database, user, port))
+            con = psycopg2.connect(database=database, user=user, password=password, port=port)
+        else:
+            debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (host, database, user, port))
+            con = psycopg2.connect(host=host, database=database, user=user, password=password, port=port)
+        cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute('SET search_path to %s' % schema)
+        debug(1, 'connected to database')
+        return (con, cur)
+    except psycopg2.DatabaseError as e:
+        print('Cannot connect to database. Error %s' % e)
+        raise SystemError('Cannot connect to database. Error %s' % e)
+
+
+# number of closure entries to write in each COPY
+COPY_BATCH_SIZE = 1000000
+
+
+def get_ancestor_depths(dag, termid):
+    '''Get all the ancestors of a term and the length of the shortest path to each of them
+
+    Parameters
+    ----------
+    dag : ontodag.OntologyDAG
+    termid : int
+
+    Returns
+    -------
+    dict of {ancestor id(int): depth(int)}
+        including the term itself (depth 0)
+    '''
+    depths = {termid: 0}
+    plist = [termid]
+    pos = 0
+    while pos < len(plist):
+        cid = plist[pos]
+        for cparent in dag.parents(cid):
+            if cparent not in depths:
+                depths[cparent] = depths[cid] + 1
+                plist.append(cparent)
+        pos += 1
+    return depths
+
+
+def _copy_closure(cur, data):
+    data.seek(0)
+    cur.copy_expert('COPY OntologyClosureTable (ancestor_id, descendant_id, depth) FROM STDIN', data)
+
+
+def build_ontology_closure(servertype='develop'):
+    '''Rebuild the OntologyClosureTable (all the (ancestor, descendant, depth) pairs of the ontology tree) from the OntologyTreeStructureTable.
+    After the build, the table is maintained by dbontology.AddTreeTerm()
+
+    Parameters
+    ----------
+    servertype : str (optional)
+        the database to connect to (main/develop/local/amnon/openu)
+    '''
+    con, cur = connect_db(servertype=servertype)
+    debug(3, 'loading ontology tree')
+    dag = ontodag.OntologyDAG()
+    dag.load(cur)
+    termids = set(dag.descriptions.keys())
+    termids.update(range(len(dag.parent_indptr) - 1))
+    debug(3, 'building closure for %d terms' % len(termids))
+    cur.execute('TRUNCATE OntologyClosureTable')
+    data = io.StringIO()
+    numbatch = 0
+    numentries = 0
+    for ctermid in sorted(termids):
+        for cancestor, cdepth in get_ancestor_depths(dag, ctermid).items():
+            data.write('%d\t%d\t%d\n' % (cancestor, ctermid, cdepth))
+            numbatch += 1
+        if numbatch >= COPY_BATCH_SIZE:
+            _copy_closure(cur, data)
+            numentries += numbatch
+            debug(3, 'added %d closure entries' % numentries)
+            data = io.StringIO()
+            numbatch = 0
+    _copy_closure(cur, data)
+    numentries += numbatch
+    con.commit()
+    debug(3, 'done. added %d closure entries' % numentries)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the dbbact ontology closure table. version ' + __version__)
+    parser.add_argument('--db', help='name of database to connect to (main/develop/local/amnon)', default='develop')
+    parser.add_argument('--log-level', help='log level (1 is most detailed, 10 is only critical', default=1, type=int)
+    args = parser.parse_args(argv)
+    SetDebugLevel(args.log_level)
+    build_ontology_closure(servertype=args.db)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import sys
+import os
+
+sys.path.append(os.getcwd())
+
+import argparse
+import psycopg2
+import psycopg2.extras
+
+from dbbact.utils import SetDebugLevel, debug
+from dbbact import seqindex
+
+__version__ = "0.9"
+
+
+def connect_db(servertype='main', schema='AnnotationSchemaTest'):
+    """
+    connect to the postgres database and return the connection and cursor
+    input:
+    servertype : str (optional)
+        the database to access. options are:
+            'main' (default) - the main remote production database
+            'develop' - the remote development database
+            'local' - a local postgres instance of the database
+            'amnon' - the local mac installed veriosn of dbbact
+    schema : str (optional)
+        name of the schema containing the annotation database
+
+    output:
+    con : the database connection
+    cur : the database cursor
+    """
+    debug(1, 'connecting to database')
+    try:
+        database = 'scdb'
+        user = 'postgres'
+        password = 'admin123'
+        port = 5432
+        host = 'localhost'
+        if servertype == 'main':
+            debug(1, 'servertype is main')
+            database = 'scdb'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'develop':
+            debug(1, 'servertype is develop')
+            database = 'scdb_develop'
+            user = 'scdb'
+            password = 'magNiv'
+            port = 29546
+        elif servertype == 'local':
+            debug(1, 'servertype is local')
+            database = 'postgres'
+            user = 'postgres'
+            password = 'admin123'
+            port = 5432
+        elif servertype == 'amnon':
+            debug(1, 'servertype is amnon')
+            database = 'dbbact'
+            user = 'amnon'
+            password = 'magNiv'
+            port = 5432
+        elif servertype == 'openu':
+            debug(1, 'servertype is openu')
+            database = 'scdb'
+            user = 'postgres'
+            password = 'magNiv'
+            port = 5432
+        else:
+            debug(6, 'unknown server type %s' % servertype)
+            print('unknown server type %s' % servertype)
+        if servertype == 'openu':
+            debug(1, 'connecting database=%s, user=%s, port=%d' % (database, user, port))
+            con = psycopg2.connect(database=database, user=user, password=password, port=port)
+        else:
+            debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (host, database, user, port))
+            con = psycopg2.connect(host=host, database=database, user=user, password=password, port=port)
+        cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute('SET search_path to %s' % schema)
+        debug(1, 'connected to database')
+        return (con, cur)
+    except psycopg2.DatabaseError as e:
+        print('Cannot connect to database. Error %s' % e)
+        raise SystemError('Cannot connect to database. Error %s' % e)
+
+
+def build_seq_store(servertype='develop', output='dbbact-seq-store'):
+    '''Build the 2-bit packed store of all the dbbact sequences and save it as .npy files
+    The server memory-maps the store from these files if the DBBACT_SEQ_STORE environment variable is set to the output prefix
+
+    Parameters
+    ----------
+    servertype : str (optional)
+        the database to connect to (main/develop/local/amnon/openu)
+    output : str (optional)
+        the output file name prefix (creates output.packed.npy, output.offsets.npy etc.)
+    '''
+    con, cur = connect_db(servertype=servertype)
+    debug(3, 'building sequence store')
+    store = seqindex.build_store(cur)
+    debug(3, 'saving %d sequences (%d bytes) to %s' % (len(store), len(store.packed), output))
+    store.save(output)
+    debug(3, 'done')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the dbbact packed sequence store. version ' + __version__)
+    parser.add_argument('--db', help='name of database to connect to (main/develop/local/amnon)', default='develop')
+    parser.add_argument('-o', '--output', help='output store file name prefix', default='dbbact-seq-store')
+    parser.add_argument('--log-level', help='log level (1 is most detailed, 10 is only critical', default=1, type=int)
+    args = parser.parse_args(argv)
+    SetDebugLevel(args.log_level)
+    build_seq_store(servertype=args.db, output=args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,67 @@
+'''Version counters for the worker-resident caches.
+
+Processes that write data cached by the workers (i.e. Update_Tax.py for the taxonomy) bump the matching
+counter in CacheVersionsTable (in the same transaction as the write), and the workers compare the counter
+to the one they loaded to know when to invalidate the cache.
+'''
+
+import psycopg2
+
+from .utils import debug
+
+
+def get_version(con, cur, name):
+    '''Get the current version of a cache
+
+    Parameters
+    ----------
+    con, cur
+    name : str
+        the cache name (i.e. 'taxonomy')
+
+    Returns
+    -------
+    int
+        the version (0 if never bumped), or -1 if the version could not be read
+    '''
+    # use a savepoint so a failure (i.e. table does not exist) does not abort the request transaction
+    cur.execute('SAVEPOINT get_cache_version')
+    try:
+        cur.execute('SELECT version FROM CacheVersionsTable WHERE name=%s', [name])
+        if cur.rowcount == 0:
+            version = 0
+        else:
+            version = cur.fetchone()[0]
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when getting cache version for %s' % (e, name))
+        cur.execute('ROLLBACK TO SAVEPOINT get_cache_version')
+        return -1
+    cur.execute('RELEASE SAVEPOINT get_cache_version')
+    return version
+
+
+def bump_version(con, cur, name):
+    '''Increase the version of a cache (invalidating the worker caches). Does not commit
+
+    Parameters
+    ----------
+    con, cur
+    name : str
+        the cache name (i.e. 'taxonomy')
+
+    Returns
+    -------
+    bool
+        True if the version was increased, False if it could not be (i.e. CacheVersionsTable does not exist.
+        the workers then do not use the versioned caches, see get_version())
+    '''
+    # use a savepoint so a failure does not abort the transaction of the change
+    cur.execute('SAVEPOINT bump_cache_version')
+    try:
+        cur.execute('INSERT INTO CacheVersionsTable (name, version) VALUES (%s, 1) ON CONFLICT (name) DO UPDATE SET version = CacheVersionsTable.version + 1', [name])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when bumping cache version for %s' % (e, name))
+        cur.execute('ROLLBACK TO SAVEPOINT bump_cache_version')
+        return False
+    cur.execute('RELEASE SAVEPOINT bump_cache_version')
+    return True
@@ -0,0 +1,390 @@
+'''Minimizer (k-mer) index of the dbbact sequences.
+
+Used for finding dbbact sequences matching a query that is shorter than the seed sequence
+or that was trimmed at a different position than the database sequence (so the prefix
+matching of dbsequences.GetSequenceId() fails).
+Each database sequence is indexed by its (k, w) minimizers (the smallest hashed k-mer in each
+window of w consecutive k-mers). Two sequences sharing an exact overlap of at least k + w - 1 bases
+are guaranteed to share a minimizer, so the query minimizers give the candidate database sequences
+(and the offset of the query in each), which are then verified on the aligned overlap.
+
+The index is kept in 3 parallel numpy arrays sorted by the minimizer hash (hash, dbbact id, position).
+It can be built in bulk using dbutils/build_kmer_index.py and saved as .npy files, which the
+workers memory-map (so the pages are shared between the workers). Sequences added after the build
+are added from the worker sequence index (see seqindex.py).
+'''
+
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from .utils import debug
+from . import seqindex
+from .seqstore import encode_sequence
+
+# the k-mer length
+KMER_LEN = 15
+# the number of consecutive k-mers in each minimizer window
+WINDOW_LEN = 10
+# minimal query length (guarantees at least one minimizer in a full overlap)
+MIN_QUERY_LEN = KMER_LEN + WINDOW_LEN - 1
+# minimizers appearing more than this number of times in the index are not used for the lookup
+# (unless all the query minimizers are that frequent)
+MAX_OCCURRENCES = 5000
+
+# the prefix of the .npy index files (created by dbutils/build_kmer_index.py) to load
+# if not set (or the files do not exist), the index is built from the worker sequence index on first use
+INDEX_FILE_PREFIX = os.environ.get('DBBACT_KMER_INDEX')
+
+# multiplier for scrambling the k-mer values (so the minimizers are not biased to poly-A k-mers)
+_HASH_MULT = np.uint64(0x9E3779B97F4A7C15)
+_INVALID_HASH = np.iinfo(np.uint64).max
+
+# the per-worker index (created on first use by get_kmer_index())
+_kmer_index = None
+
+
+def get_minimizers(codes, k=KMER_LEN, w=WINDOW_LEN):
+    '''Get the (k, w) minimizers of a sequence
+
+    Parameters
+    ----------
+    codes : numpy array of uint8
+        the sequence base codes (see seqstore.encode_sequence())
+    k : int (optional)
+        the k-mer length
+    w : int (optional)
+        the number of consecutive k-mers in each window
+
+    Returns
+    -------
+    hashes : numpy array of uint64
+        the hash of each minimizer
+    positions : numpy array of int
+        the position (in sequence) of each minimizer k-mer
+    '''
+    numkmers = len(codes) - k + 1
+    if numkmers < 1:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    kmers = np.lib.stride_tricks.sliding_window_view(codes, k)
+    shifts = (2 * np.arange(k - 1, -1, -1)).astype(np.uint64)
+    values = (kmers.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+    hashes = values * _HASH_MULT
+    hashes[(kmers > 3).any(axis=1)] = _INVALID_HASH
+    if numkmers <= w:
+        positions = np.array([np.argmin(hashes)])
+    else:
+        positions = np.lib.stride_tricks.sliding_window_view(hashes, w).argmin(axis=1) + np.arange(numkmers - w + 1)
+        positions = np.unique(positions)
+    positions = positions[hashes[positions] != _INVALID_HASH]
+    return hashes[positions], positions
+
+
+def build_arrays(sequences):
+    '''Build the sorted minimizer index arrays for a set of sequences
+
+    Parameters
+    ----------
+    sequences : iterable of (int, numpy array of uint8)
+        the (dbbact id, sequence base codes) of the sequences to index
+
+    Returns
+    -------
+    hashes : numpy array of uint64
+        the minimizer hashes (sorted)
+    ids : numpy array of int32
+        the dbbact sequence id for each minimizer
+    positions : numpy array of int16
+        the position of the minimizer in the sequence
+    '''
+    all_hashes = []
+    all_ids = []
+    all_positions = []
+    for cid, ccodes in sequences:
+        chashes, cpositions = get_minimizers(ccodes)
+        all_hashes.append(chashes)
+        all_ids.append(np.full(len(chashes), cid, dtype=np.int32))
+        all_positions.append(cpositions.astype(np.int16))
+    if len(all_hashes) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int16)
+    hashes = np.concatenate(all_hashes)
+    order = np.argsort(hashes, kind='stable')
+    return hashes[order], np.concatenate(all_ids)[order], np.concatenate(all_positions)[order]
+
+
+def save_arrays(prefix, hashes, ids, positions):
+    '''Save the index arrays as .npy files (so they can be memory-mapped by the workers)
+
+    Parameters
+    ----------
+    prefix : str
+        the output file name prefix (files are prefix.hashes.npy, prefix.ids.npy, prefix.positions.npy)
+    hashes, ids, positions : numpy array
+        the index arrays (see build_arrays())
+    '''
+    np.save(prefix + '.hashes.npy', hashes)
+    np.save(prefix + '.ids.npy', ids)
+    np.save(prefix + '.positions.npy', positions)
+
+
+class KmerIndex:
+    '''Minimizer index of the dbbact sequences.
+
+    Minimizers of the bulk-built sequences are in sorted numpy arrays (searched with searchsorted),
+    and minimizers of sequences added since are kept in a dict.
+    '''
+    def __init__(self, hashes=None, ids=None, positions=None):
+        if hashes is None:
+            hashes, ids, positions = build_arrays([])
+        self.hashes = hashes
+        self.ids = ids
+        self.positions = positions
+        # the ids in the bulk arrays
+        self.indexed_ids = set(np.unique(ids).tolist())
+        # dict of {hash(int): list of (id(int), position(int))} for the sequences added after the bulk build
+        self.added = defaultdict(list)
+        # number of seqindex.SequenceIndex ids already synced
+        self.num_synced = 0
+
+    @classmethod
+    def load(cls, prefix):
+        '''Load a bulk-built index from the .npy files (memory-mapped)
+
+        Parameters
+        ----------
+        prefix : str
+            the index file name prefix (see save_arrays())
+        '''
+        debug(2, 'loading kmer index from %s' % prefix)
+        hashes = np.load(prefix + '.hashes.npy', mmap_mode='r')
+        ids = np.load(prefix + '.ids.npy', mmap_mode='r')
+        positions = np.load(prefix + '.positions.npy', mmap_mode='r')
+        return cls(hashes, ids, positions)
+
+    def sync(self, index):
+        '''Add all the sequences from the sequence index that are not in the kmer index yet
+
+        Parameters
+        ----------
+        index : seqindex.SequenceIndex
+            the worker sequence index
+        '''
+        new_ids = index.ids_from(self.num_synced)
+        if self.num_synced == 0 and len(self.indexed_ids) == 0 and len(new_ids) > 0:
+            debug(4, 'building kmer index for %d sequences' % len(new_ids))
+            self.hashes, self.ids, self.positions = build_arrays([(cid, index.get_codes(cid)[0]) for cid in new_ids])
+            self.indexed_ids = set(new_ids)
+        else:
+            for cid in new_ids:
+                if cid in self.indexed_ids:
+                    continue
+                chashes, cpositions = get_minimizers(index.get_codes(cid)[0])
+                for chash, cpos in zip(chashes.tolist(), cpositions.tolist()):
+                    self.added[chash].append((cid, cpos))
+                self.indexed_ids.add(cid)
+        self.num_synced = len(new_ids) + self.num_synced
+
+    def get_candidates(self, codes):
+        '''Get the database sequences sharing a minimizer with the query and the query offset in each
+
+        Parameters
+        ----------
+        codes : numpy array of uint8
+            the query sequence base codes (see seqstore.encode_sequence())
+
+        Returns
+        -------
+        ids : numpy array of int
+            the dbbact ids of the candidate sequences
+        diagonals : numpy array of int
+            the position of the query start in the candidate sequence (can be negative).
+            each (id, diagonal) pair appears once
+        '''
+        qhashes, qpositions = get_minimizers(codes)
+        # no valid minimizers (i.e. all the k-mers contain non-ACGT characters)
+        if len(qhashes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        starts = np.searchsorted(self.hashes, qhashes, side='left')
+        ends = np.searchsorted(self.hashes, qhashes, side='right')
+        counts = ends - starts
+        # skip the very common minimizers (i.e. conserved regions), if we have others
+        use = counts <= MAX_OCCURRENCES
+        if not use.any():
+            use = counts == counts.min()
+        starts, counts, cqpos = starts[use], counts[use], qpositions[use]
+        # indices of all the index entries for all the query minimizers
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        ids = np.asarray(self.ids[offsets], dtype=np.int64)
+        diagonals = np.asarray(self.positions[offsets], dtype=np.int64) - np.repeat(cqpos, counts)
+        if self.added:
+            added_ids = []
+            added_diagonals = []
+            for chash, cpos in zip(qhashes[use].tolist(), cqpos.tolist()):
+                for cid, cdbpos in self.added.get(chash, []):
+                    added_ids.append(cid)
+                    added_diagonals.append(cdbpos - cpos)
+            ids = np.concatenate([ids, np.array(added_ids, dtype=np.int64)])
+            diagonals = np.concatenate([diagonals, np.array(added_diagonals, dtype=np.int64)])
+        pairs = np.unique(np.stack([ids, diagonals], axis=1), axis=0)
+        return pairs[:, 0], pairs[:, 1]
+
+    def find(self, sequence, index, idprimer=None, min_overlap=100):
+        '''Get the ids of the database sequences having an exact overlap with the query
+
+        A database sequence matches if the query and the database sequence are identical on their overlap,
+        and the overlap contains the whole query, the whole database sequence, or at least min_overlap bases
+
+        Parameters
+        ----------
+        sequence : str
+            the query sequence (ACGT)
+        index : seqindex.SequenceIndex
+            the sequence index (for getting the database sequences)
+        idprimer : int (optional)
+            if supplied, return only sequences from this idPrimer
+        min_overlap : int (optional)
+            the minimal overlap for a partial (suffix/prefix) overlap match
+
+        Returns
+        -------
+        list of int
+            the ids of the matching sequences (sorted)
+        '''
+        qcodes = encode_sequence(sequence)
+        cseqlen = len(qcodes)
+        if cseqlen < MIN_QUERY_LEN:
+            return []
+        ids, diagonals = self.get_candidates(qcodes)
+        sid = set()
+        for cid, cdiag in zip(ids.tolist(), diagonals.tolist()):
+            if cid in sid:
+                continue
+            dbseq, dbprimer = index.get_codes(cid)
+            if dbseq is None:
+                continue
+            if idprimer is not None and dbprimer != idprimer:
+                continue
+            dbstart = max(cdiag, 0)
+            dbend = min(len(dbseq), cdiag + cseqlen)
+            overlap = dbend - dbstart
+            if overlap < cseqlen and overlap < len(dbseq) and overlap < min_overlap:
+                continue
+            if np.array_equal(dbseq[dbstart:dbend], qcodes[dbstart - cdiag:dbend - cdiag]):
+                sid.add(cid)
+        return sorted(sid)
+
+    def find_approx(self, sequence, index, max_mismatches, idprimer=None, min_overlap=100):
+        '''Get the ids of the database sequences closest to the query (allowing mismatches)
+
+        Candidates are the database sequences (and query offsets) sharing a minimizer with the query
+        (so the query needs an exact stretch of at least KMER_LEN + WINDOW_LEN - 1 bases),
+        and are scored by the number of mismatches on the aligned overlap (see hamming_distances()).
+        The overlap must contain the whole query, the whole database sequence, or at least min_overlap bases
+
+        Parameters
+        ----------
+        sequence : str
+            the query sequence (ACGT)
+        index : seqindex.SequenceIndex
+            the sequence index (for getting the database sequences)
+        max_mismatches : int
+            the maximal number of mismatches allowed
+        idprimer : int (optional)
+            if supplied, return only sequences from this idPrimer
+        min_overlap : int (optional)
+            the minimal overlap for a partial (suffix/prefix) overlap match
+
+        Returns
+        -------
+        ids : list of int
+            the ids of the matching sequences with the smallest number of mismatches (sorted)
+        distance : int or None
+            the number of mismatches of the returned sequences (None if no match found)
+        '''
+        qcodes = encode_sequence(sequence)
+        cseqlen = len(qcodes)
+        if cseqlen < MIN_QUERY_LEN:
+            return [], None
+        ids, diagonals = self.get_candidates(qcodes)
+        # get the candidate sequences
+        dbseqs = []
+        keep = np.zeros(len(ids), dtype=bool)
+        for idx, cid in enumerate(ids.tolist()):
+            dbseq, dbprimer = index.get_codes(cid)
+            if dbseq is None:
+                continue
+            if idprimer is not None and dbprimer != idprimer:
+                continue
+            keep[idx] = True
+            dbseqs.append(dbseq)
+        if len(dbseqs) == 0:
+            return [], None
+        ids = ids[keep]
+        diagonals = diagonals[keep]
+        mismatches, overlaps = hamming_distances(qcodes, dbseqs, diagonals)
+        dblens = np.array([len(x) for x in dbseqs])
+        ok = (mismatches <= max_mismatches) & ((overlaps >= cseqlen) | (overlaps >= dblens) | (overlaps >= min_overlap))
+        if not ok.any():
+            return [], None
+        distance = mismatches[ok].min()
+        return sorted(set(ids[ok & (mismatches == distance)].tolist())), int(distance)
+
+
+def hamming_distances(qcodes, dbseqs, diagonals):
+    '''Count the mismatches between the query and each database sequence on their aligned overlap
+
+    Parameters
+    ----------
+    qcodes : numpy array of uint8
+        the query sequence base codes (see seqstore.encode_sequence())
+    dbseqs : list of numpy array of uint8
+        the database sequences base codes
+    diagonals : numpy array of int
+        the position of the query start in each database sequence (can be negative)
+
+    Returns
+    -------
+    mismatches : numpy array of int
+        the number of mismatching positions in the overlap of the query with each database sequence
+        (non-ACGT characters are counted as mismatches)
+    overlaps : numpy array of int
+        the overlap length of the query with each database sequence
+    '''
+    # all the database sequences concatenated, with the start position of each
+    dbcodes = np.concatenate(dbseqs)
+    dblens = np.array([len(x) for x in dbseqs])
+    dbstarts = np.cumsum(dblens) - dblens
+    # the position in each database sequence aligned with each query position
+    dbpos = np.asarray(diagonals)[:, np.newaxis] + np.arange(len(qcodes))[np.newaxis, :]
+    valid = (dbpos >= 0) & (dbpos < dblens[:, np.newaxis])
+    aligned = dbcodes[np.where(valid, dbpos + dbstarts[:, np.newaxis], 0)]
+    mismatches = ((aligned != qcodes[np.newaxis, :]) | (aligned > 3)) & valid
+    return mismatches.sum(axis=1), valid.sum(axis=1)
+
+
+def get_kmer_index(con, cur):
+    '''Get the worker kmer index (loading it on first use and adding new sequences from the sequence index)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    (KmerIndex, seqindex.SequenceIndex) or (None, None) if the sequence index is not available
+    '''
+    global _kmer_index
+
+    index = seqindex.get_index(con, cur)
+    if index is None:
+        return None, None
+    if _kmer_index is None:
+        if INDEX_FILE_PREFIX is not None and os.path.exists(INDEX_FILE_PREFIX + '.hashes.npy'):
+            _kmer_index = KmerIndex.load(INDEX_FILE_PREFIX)
+        else:
+            debug(6, 'kmer index files not found (DBBACT_KMER_INDEX). building index from the sequence index')
+            _kmer_index = KmerIndex()
+    if _kmer_index.num_synced < index.num_ids():
+        _kmer_index.sync(index)
+    return _kmer_index, index
@@ -0,0 +1,277 @@
+'''Worker-resident ontology DAG.
+
+Holds the whole OntologyTreeStructureTable in memory as a CSR adjacency list (for each term id, the ids of
+its immediate parents), together with the OntologyTable term names, so the ancestors of a term
+(see dbontology.GetParents() / GetTermsParents()) are found without database round trips.
+The ancestor set of each term is computed on first use and memoized.
+
+The DAG is loaded once per worker and then refreshed incrementally by pulling only the tree entries / terms
+with id > last seen id (entries added after the load are kept in a dict next to the CSR arrays).
+The DAG is loaded / refreshed only when the transaction of the connection has no pending writes, so it contains
+only committed terms and tree entries (and not rows of the current transaction that may be rolled back).
+dbontology.AddTerm() forces a refresh of the worker DAG after adding new tree entries.
+'''
+
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import psycopg2
+
+from .utils import debug
+from . import db_access
+
+# minimal time (seconds) between two refreshes of the DAG from the database (unless forced)
+REFRESH_INTERVAL = 10
+
+# how long (seconds) to keep looking for ids skipped during a refresh
+# (ids of uncommitted inserts - if not committed by then, they were rolled back)
+GAP_TIMEOUT = 600
+
+# maximal number of memoized ancestor sets
+MAX_CACHED_ANCESTORS = 100000
+
+# set the DBBACT_NO_ONTOLOGY_DAG environment variable to use the database for the ontology parents
+USE_DAG = 'DBBACT_NO_ONTOLOGY_DAG' not in os.environ
+
+# the per-worker DAG (created on first use by get_ontology_dag())
+_dag = None
+
+
+class OntologyDAG:
+    '''In-memory ontology tree (DAG) with integer term ids
+
+    The parents of term id i are parent_ids[parent_indptr[i]:parent_indptr[i + 1]] (for the bulk loaded entries)
+    and extra_parents[i] (for the entries added since the load).
+    '''
+    def __init__(self):
+        # the CSR arrays of the bulk loaded tree entries
+        self.parent_indptr = np.zeros(1, dtype=np.int64)
+        self.parent_ids = np.zeros(0, dtype=np.int64)
+        # dict of {term id(int): list of parent ids(int)} for the entries added after the load
+        self.extra_parents = {}
+        # dict of {term id(int): description(str)}
+        self.descriptions = {}
+        # dict of {description(str): term id(int)} (the first id if a description appears more than once)
+        self.term_ids = {}
+        self.last_edge_id = 0
+        self.last_term_id = 0
+        self.last_refresh = 0
+        # dict of {id(int): time first missed(float)} for ids lower than the last seen id not yet seen
+        self._edge_gaps = {}
+        self._term_gaps = {}
+        # the memoized ancestors - OrderedDict of {term id(int): list of ancestor ids(int)}
+        self._ancestors = OrderedDict()
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def load(self, cur):
+        '''Load the ontology tree and terms from the database (replacing the current DAG)
+
+        Parameters
+        ----------
+        cur : database cursor
+        '''
+        debug(2, 'loading ontology DAG')
+        self.__init__()
+        cur.execute('SELECT id, description FROM OntologyTable ORDER BY id')
+        for cid, cdescription in cur:
+            self._add_term(cid, cdescription, 0, bulk=True)
+        cur.execute('SELECT uniqueId, ontologyId, ontologyParentId FROM OntologyTreeStructureTable')
+        edges = np.array([list(cres) for cres in cur], dtype=np.int64).reshape(-1, 3)
+        if len(edges) > 0:
+            num_nodes = int(max(edges[:, 1].max(), edges[:, 2].max())) + 1
+            order = np.argsort(edges[:, 1], kind='stable')
+            self.parent_ids = edges[order, 2]
+            self.parent_indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(edges[:, 1], minlength=num_nodes), out=self.parent_indptr[1:])
+            self.last_edge_id = int(edges[:, 0].max())
+        self.last_refresh = time.time()
+        debug(3, 'loaded ontology DAG. %d terms, %d tree entries' % (len(self.descriptions), len(self.parent_ids)))
+
+    def refresh(self, cur, force=False):
+        '''Add to the DAG the terms and tree entries added to the database since the last refresh
+
+        Parameters
+        ----------
+        cur : database cursor
+        force : bool (optional)
+            False (default) to skip the refresh if the last one was less than REFRESH_INTERVAL seconds ago.
+            True to always refresh
+        '''
+        ctime = time.time()
+        if not force and ctime - self.last_refresh < REFRESH_INTERVAL:
+            return
+        for cgaps in (self._term_gaps, self._edge_gaps):
+            for cid, ctime_missed in list(cgaps.items()):
+                if ctime - ctime_missed > GAP_TIMEOUT:
+                    del cgaps[cid]
+        cur.execute('SELECT id, description FROM OntologyTable WHERE id > %s OR id = ANY(%s) ORDER BY id', [self.last_term_id, list(self._term_gaps.keys())])
+        for cid, cdescription in cur:
+            self._add_term(cid, cdescription, ctime)
+        cur.execute('SELECT uniqueId, ontologyId, ontologyParentId FROM OntologyTreeStructureTable WHERE uniqueId > %s OR uniqueId = ANY(%s) ORDER BY uniqueId',
+                    [self.last_edge_id, list(self._edge_gaps.keys())])
+        numadded = 0
+        for cid, ctermid, cparentid in cur:
+            if cid in self._edge_gaps:
+                del self._edge_gaps[cid]
+            elif cid > self.last_edge_id:
+                for cmissing in range(self.last_edge_id + 1, cid):
+                    self._edge_gaps[cmissing] = ctime
+                self.last_edge_id = cid
+            else:
+                continue
+            if ctermid not in self.extra_parents:
+                self.extra_parents[ctermid] = []
+            self.extra_parents[ctermid].append(cparentid)
+            numadded += 1
+        if numadded > 0:
+            debug(2, 'added %d tree entries to the ontology DAG' % numadded)
+            # the new entries can change the ancestors of any descendant of the terms
+            self._ancestors.clear()
+        self.last_refresh = ctime
+
+    def _add_term(self, cid, cdescription, ctime, bulk=False):
+        '''Add a term to the DAG term names
+
+        Parameters
+        ----------
+        cid : int
+            the term id
+        cdescription : str
+            the term
+        ctime : float
+            the time of the refresh (for the skipped ids)
+        bulk : bool (optional)
+            True when loading (the ids are not tracked for gaps)
+        '''
+        if cid in self._term_gaps:
+            del self._term_gaps[cid]
+        elif cid > self.last_term_id:
+            if not bulk:
+                for cmissing in range(self.last_term_id + 1, cid):
+                    self._term_gaps[cmissing] = ctime
+            self.last_term_id = cid
+        self.descriptions[cid] = cdescription
+        self.term_ids.setdefault(cdescription, cid)
+
+    def parents(self, termid):
+        '''Get the ids of the immediate parents of a term
+
+        Parameters
+        ----------
+        termid : int
+
+        Returns
+        -------
+        list of int
+        '''
+        if termid < len(self.parent_indptr) - 1:
+            parents = self.parent_ids[self.parent_indptr[termid]:self.parent_indptr[termid + 1]].tolist()
+        else:
+            parents = []
+        if termid in self.extra_parents:
+            parents = parents + self.extra_parents[termid]
+        return parents
+
+    def ancestors(self, termid):
+        '''Get the ids of all the ancestors of a term (breadth first order, without the term itself)
+
+        Parameters
+        ----------
+        termid : int
+
+        Returns
+        -------
+        list of int
+        '''
+        if termid in self._ancestors:
+            self._ancestors.move_to_end(termid)
+            return self._ancestors[termid]
+        ancestors = []
+        seen = set([termid])
+        plist = [termid]
+        pos = 0
+        while pos < len(plist):
+            for cparent in self.parents(plist[pos]):
+                if cparent not in seen:
+                    seen.add(cparent)
+                    ancestors.append(cparent)
+                    plist.append(cparent)
+            pos += 1
+        self._ancestors[termid] = ancestors
+        if len(self._ancestors) > MAX_CACHED_ANCESTORS:
+            self._ancestors.popitem(last=False)
+        return ancestors
+
+    def get_term_id(self, term):
+        '''Get the id of a term
+
+        Parameters
+        ----------
+        term : str
+            the term (lowercase)
+
+        Returns
+        -------
+        int or None if the term is not in the ontology
+        '''
+        return self.term_ids.get(term)
+
+    def ancestor_terms(self, termid):
+        '''Get the names of all the ancestors of a term (breadth first order, without the term itself)
+
+        Parameters
+        ----------
+        termid : int
+
+        Returns
+        -------
+        list of str
+        '''
+        return [self.descriptions[cid] for cid in self.ancestors(termid) if cid in self.descriptions]
+
+
+def get_ontology_dag(con, cur, force_refresh=False):
+    '''Get the worker ontology DAG (loading it on first use and refreshing it if needed)
+
+    Parameters
+    ----------
+    con, cur
+    force_refresh : bool (optional)
+        False (default) to refresh only if the last refresh was more than REFRESH_INTERVAL seconds ago.
+        True to always get the new tree entries from the database
+
+    Returns
+    -------
+    OntologyDAG or None if the DAG is disabled or could not be loaded.
+        If the transaction has pending writes, the DAG is not loaded / refreshed (the current DAG, or None, is returned)
+    '''
+    global _dag
+
+    if not USE_DAG:
+        return None
+    try:
+        # do not read uncommitted terms / tree entries (they stay in the DAG if the transaction is rolled back)
+        if db_access.has_pending_writes(con, cur):
+            debug(1, 'transaction has pending writes. not refreshing ontology DAG')
+            return _dag
+        if _dag is None:
+            cdag = OntologyDAG()
+            cdag.load(cur)
+            _dag = cdag
+        else:
+            _dag.refresh(cur, force=force_refresh)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when loading ontology DAG' % e)
+        return None
+    return _dag
+
+
+def invalidate():
+    '''Force a refresh of the worker DAG on its next use (i.e. after adding new tree entries)
+    '''
+    if _dag is not None:
+        _dag.last_refresh = 0
@@ -0,0 +1,364 @@
+'''Worker-resident index of the dbbact sequences.
+
+Holds all the SequencesTable sequences (id, primer, sequence) in memory so
+sequence id lookups (see dbsequences.GetSequenceId()) do not need a database
+round trip. The index is loaded once per worker and then refreshed incrementally
+by pulling only the rows with id > last seen id.
+
+The sequences loaded at startup are kept in a 2-bit packed store (see seqstore.py), memory-mapped from the
+files created by dbutils/build_seq_store.py if the DBBACT_SEQ_STORE environment variable is set (so all the workers share it).
+Otherwise the store is built from the database, and each worker has its own copy (unless the index is loaded before
+the workers fork, i.e. gunicorn --preload with load_seq_index=True, so the pages are shared copy-on-write).
+Sequences added later (and sequences containing non-ACGT characters) are kept as python strings.
+'''
+
+import os
+import time
+import bisect
+from collections import defaultdict
+
+import psycopg2
+
+from .utils import debug
+from . import seqstore
+
+# only sequences at least this long are indexed / looked up
+# (same as dbsequences.SEED_SEQ_LEN)
+MIN_SEQ_LEN = 100
+
+# minimal time (seconds) between two refreshes of the index from the database (unless forced)
+REFRESH_INTERVAL = 10
+
+# how long (seconds) to keep looking for ids skipped during a refresh
+# (ids of uncommitted inserts - if not committed by then, they were rolled back)
+GAP_TIMEOUT = 600
+
+# set the DBBACT_NO_SEQ_INDEX environment variable to use the database for the sequence lookups
+USE_INDEX = 'DBBACT_NO_SEQ_INDEX' not in os.environ
+
+# the prefix of the .npy sequence store files (created by dbutils/build_seq_store.py) to load
+STORE_FILE_PREFIX = os.environ.get('DBBACT_SEQ_STORE')
+
+_ACGT = set('acgt')
+
+# the per-worker index (created on first use by get_index())
+_index = None
+
+
+class SequenceIndex:
+    '''In-memory prefix index of the dbbact sequences.
+
+    The bulk loaded sequences are in a seqstore.PackedSequenceStore.
+    The rest are kept in a sorted list (for finding all the database sequences starting with the query using bisect)
+    and in a dict (for finding all the database sequences which are a prefix of the query, one length at a time).
+    '''
+    def __init__(self):
+        # the packed store of the bulk loaded sequences (or None)
+        self.store = None
+        # sorted list of all the (unique) sequences not in the store
+        self.sequences = []
+        # dict of {sequence(str): list of (id(int), idprimer(int))}
+        self.seq_ids = defaultdict(list)
+        # the lengths of all the sequences in the index
+        self.lengths = set()
+        # dict of {id(int): (sequence(str), idprimer(int))}
+        self.id_seq = {}
+        # the ids of the sequences not in the store, in the order they were added to the index
+        self.id_list = []
+        self.last_seen_id = 0
+        self.last_refresh = 0
+        # dict of {id(int): time first missed(float)} for ids lower than last_seen_id not yet seen
+        self._gaps = {}
+
+    def __len__(self):
+        return self.num_ids()
+
+    def num_ids(self):
+        '''Get the number of sequence ids in the index
+        '''
+        if self.store is None:
+            return len(self.id_list)
+        return len(self.store) + len(self.id_list)
+
+    def ids_from(self, start):
+        '''Get the ids in the index, in the order they were added, starting from position start
+        (so new ids can be found by calling with the previous num_ids())
+
+        Parameters
+        ----------
+        start : int
+
+        Returns
+        -------
+        list of int
+        '''
+        if self.store is None:
+            return self.id_list[start:]
+        numstore = len(self.store)
+        if start >= numstore:
+            return self.id_list[start - numstore:]
+        return self.store.ids[start:].tolist() + self.id_list
+
+    def load(self, cur):
+        '''Load all the sequences from the database (replacing the current index)
+
+        Parameters
+        ----------
+        cur : database cursor
+        '''
+        debug(2, 'loading sequence index')
+        self.__init__()
+        if STORE_FILE_PREFIX is not None and seqstore.PackedSequenceStore.exists(STORE_FILE_PREFIX):
+            self.store = seqstore.PackedSequenceStore.load(STORE_FILE_PREFIX)
+            self.last_seen_id = self.store.last_id
+            self._add_rows(cur, 'SELECT id, sequence, idPrimer FROM SequencesTable WHERE id > %s ORDER BY id', [self.last_seen_id], bulk=True)
+        else:
+            self.store = build_store(cur, self)
+        self.last_refresh = time.time()
+        debug(3, 'loaded sequence index. %d sequences, last id %d' % (len(self), self.last_seen_id))
+
+    def refresh(self, cur, force=False):
+        '''Add to the index the sequences added to the database since the last refresh
+
+        Parameters
+        ----------
+        cur : database cursor
+        force : bool (optional)
+            False (default) to skip the refresh if the last one was less than REFRESH_INTERVAL seconds ago.
+            True to always refresh
+        '''
+        if not force and time.time() - self.last_refresh < REFRESH_INTERVAL:
+            return
+        ctime = time.time()
+        for cid, ctime_missed in list(self._gaps.items()):
+            if ctime - ctime_missed > GAP_TIMEOUT:
+                del self._gaps[cid]
+        if self._gaps:
+            self._add_rows(cur, 'SELECT id, sequence, idPrimer FROM SequencesTable WHERE id > %s OR id = ANY(%s) ORDER BY id', [self.last_seen_id, list(self._gaps.keys())])
+        else:
+            self._add_rows(cur, 'SELECT id, sequence, idPrimer FROM SequencesTable WHERE id > %s ORDER BY id', [self.last_seen_id])
+
+    def _add_rows(self, cur, query, params, bulk=False):
+        '''Add the (id, sequence, idprimer) rows returned by query to the index
+
+        Parameters
+        ----------
+        cur : database cursor
+        query : str
+            the SQL query returning the rows (ordered by id)
+        params : list
+            the query parameters
+        bulk : bool (optional)
+            True to re-sort the sequence list once at the end (for loading many sequences),
+            False (default) to insert each new sequence in place
+        '''
+        ctime = time.time()
+        cur.execute(query, params)
+        numadded = 0
+        for cres in cur:
+            if self._add_row(cres[0], cres[1], cres[2], ctime, bulk=bulk):
+                numadded += 1
+        if bulk:
+            self.sequences.sort()
+        self.last_refresh = ctime
+        if numadded > 0:
+            debug(2, 'added %d sequences to sequence index' % numadded)
+
+    def _add_row(self, cid, cseq, cprimer, ctime, bulk=False):
+        '''Add one sequence to the (non-packed part of the) index
+
+        Parameters
+        ----------
+        cid : int
+            the sequence id
+        cseq : str
+            the sequence
+        cprimer : int
+            the sequence idprimer
+        ctime : float
+            the time of the refresh (for the skipped ids)
+        bulk : bool (optional)
+            see _add_rows()
+
+        Returns
+        -------
+        bool
+            True if the sequence was added
+        '''
+        if cid in self._gaps:
+            del self._gaps[cid]
+        elif cid > self.last_seen_id:
+            # remember the skipped ids, their insert may still be uncommitted
+            if not bulk:
+                for cmissing in range(self.last_seen_id + 1, cid):
+                    self._gaps[cmissing] = ctime
+            self.last_seen_id = cid
+        if cseq is None or len(cseq) < MIN_SEQ_LEN:
+            return False
+        cseq = cseq.lower()
+        if cseq not in self.seq_ids:
+            if bulk:
+                self.sequences.append(cseq)
+            else:
+                bisect.insort(self.sequences, cseq)
+            self.lengths.add(len(cseq))
+        else:
+            # use the same str object for identical sequences
+            cseq = self.id_seq[self.seq_ids[cseq][0][0]][0]
+        self.seq_ids[cseq].append((cid, cprimer))
+        self.id_seq[cid] = (cseq, cprimer)
+        self.id_list.append(cid)
+        return True
+
+    def get_sequence(self, seqid):
+        '''Get the sequence and primer for a dbbact sequence id
+
+        Parameters
+        ----------
+        seqid : int
+            the dbbact sequence id
+
+        Returns
+        -------
+        (str, int) of (sequence, idprimer) or (None, None) if the id is not in the index
+        '''
+        if self.store is not None:
+            centry = self.store.get_entry(seqid)
+            if centry is not None:
+                return self.store.get_sequence(centry), int(self.store.primers[centry])
+        return self.id_seq.get(seqid, (None, None))
+
+    def get_codes(self, seqid):
+        '''Get the sequence base codes (see seqstore.encode_sequence()) and primer for a dbbact sequence id
+
+        Parameters
+        ----------
+        seqid : int
+            the dbbact sequence id
+
+        Returns
+        -------
+        (numpy array of uint8, int) of (base codes, idprimer) or (None, None) if the id is not in the index
+        '''
+        if self.store is not None:
+            centry = self.store.get_entry(seqid)
+            if centry is not None:
+                return self.store.get_codes(centry), int(self.store.primers[centry])
+        if seqid not in self.id_seq:
+            return None, None
+        cseq, cprimer = self.id_seq[seqid]
+        return seqstore.encode_sequence(cseq), cprimer
+
+    def lookup(self, sequence, idprimer=None, no_shorter=False, no_longer=False):
+        '''Get the ids of the sequences matching the query (same matching as dbsequences.GetSequenceId())
+        A database sequence matches if it starts with the query, or the query starts with it.
+
+        Parameters
+        ----------
+        sequence : str
+            the query sequence (ACGT)
+        idprimer : int (optional)
+            if supplied, return only sequences from this idPrimer
+        no_shorter : bool (optional)
+            False (default) to enable shorter db sequences matching sequence, True to require at least length of query sequence
+        no_longer : bool (optional)
+            False (default) to enable longer db sequences matching sequence, True to require at least length of database sequence
+
+        Returns
+        -------
+        list of int
+            the ids of the matching sequences (sorted)
+        '''
+        cseq = sequence.lower()
+        cseqlen = len(cseq)
+        if cseqlen < MIN_SEQ_LEN:
+            return []
+        matches = []
+        if self.store is not None:
+            for centry in self.store.lookup(seqstore.encode_sequence(cseq), no_shorter=no_shorter, no_longer=no_longer):
+                matches.append((int(self.store.ids[centry]), int(self.store.primers[centry])))
+        # database sequences which are a prefix of the query (including the query itself)
+        if no_shorter:
+            prefixes = [cseq]
+        else:
+            prefixes = [cseq[:clen] for clen in self.lengths if clen <= cseqlen]
+        for cprefix in prefixes:
+            if cprefix in self.seq_ids:
+                matches.extend(self.seq_ids[cprefix])
+        # database sequences starting with the query (and longer than it)
+        if not no_longer:
+            pos = bisect.bisect_right(self.sequences, cseq)
+            while pos < len(self.sequences) and self.sequences[pos].startswith(cseq):
+                matches.extend(self.seq_ids[self.sequences[pos]])
+                pos += 1
+        return sorted([cid for cid, cprimer in matches if idprimer is None or cprimer == idprimer])
+
+
+def build_store(cur, index=None):
+    '''Build the packed sequence store from all the SequencesTable sequences
+
+    Parameters
+    ----------
+    cur : database cursor
+    index : SequenceIndex or None (optional)
+        if supplied, add to it the sequences that cannot be packed (non-ACGT)
+
+    Returns
+    -------
+    seqstore.PackedSequenceStore
+    '''
+    ids = []
+    sequences = []
+    primers = []
+    ctime = time.time()
+    last_id = 0
+    cur.execute('SELECT id, sequence, idPrimer FROM SequencesTable ORDER BY id')
+    for cres in cur:
+        last_id = cres[0]
+        cseq = cres[1]
+        if cseq is None or len(cseq) < MIN_SEQ_LEN:
+            continue
+        cseq = cseq.lower()
+        if not set(cseq) <= _ACGT:
+            if index is not None:
+                index._add_row(cres[0], cseq, cres[2], ctime, bulk=True)
+            continue
+        ids.append(cres[0])
+        sequences.append(cseq)
+        primers.append(cres[2])
+    store = seqstore.PackedSequenceStore.from_sequences(ids, sequences, primers)
+    if index is not None:
+        index.sequences.sort()
+        index.last_seen_id = max(index.last_seen_id, last_id)
+    return store
+
+
+def get_index(con, cur, force_refresh=False):
+    '''Get the worker sequence index (loading it on first use and refreshing it if needed)
+
+    Parameters
+    ----------
+    con, cur
+    force_refresh : bool (optional)
+        False (default) to refresh only if the last refresh was more than REFRESH_INTERVAL seconds ago.
+        True to always get the new sequences from the database (i.e. before adding sequences)
+
+    Returns
+    -------
+    SequenceIndex or None if the index is disabled or could not be loaded
+    '''
+    global _index
+
+    if not USE_INDEX:
+        return None
+    try:
+        if _index is None:
+            cindex = SequenceIndex()
+            cindex.load(cur)
+            _index = cindex
+        else:
+            _index.refresh(cur, force=force_refresh)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when loading sequence index' % e)
+        return None
+    return _index
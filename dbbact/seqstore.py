@@ -0,0 +1,368 @@
+'''2-bit packed store of the dbbact sequences.
+
+Each sequence is stored as 2 bits per base (4 bases per byte, first base in the high bits), starting on a byte boundary,
+in one numpy uint8 buffer with a byte offsets array. The store is immutable and is either built in the worker
+(before forking, so the pages are shared copy-on-write), or built by dbutils/build_seq_store.py and saved as .npy
+files which all the workers memory-map.
+
+Sequence lookups are done on the packed representation:
+* exact / prefix (database sequence is a prefix of the query) matches use a sorted array of polynomial hashes of
+  the whole sequences, compared against all the query prefix hashes at once.
+* extension (database sequence starts with the query) matches use binary search on the lexicographic order of the sequences,
+  comparing the packed bytes.
+Only sequences made of ACGT can be stored.
+'''
+
+import os
+
+import numpy as np
+
+from .utils import debug
+
+# 2 bit code for each ascii character (4 for non-ACGT)
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _cpos, _cbase in enumerate('acgt'):
+    _BASE_CODES[ord(_cbase)] = _cpos
+    _BASE_CODES[ord(_cbase.upper())] = _cpos
+_BASES = np.frombuffer(b'acgt', dtype=np.uint8)
+_UNPACK_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+# base for the polynomial sequence hash (and its inverse mod 2^64, precomputed since pow(x, -1, m) needs python >= 3.8)
+_HASH_BASE = 0x100000001B3
+_HASH_BASE_INV = 0xCE965057AFF6957B
+# cached powers of the hash base (and its inverse)
+_powers = np.ones(1, dtype=np.uint64)
+_inv_powers = np.ones(1, dtype=np.uint64)
+
+# the store arrays (each saved as prefix.name.npy)
+_ARRAY_NAMES = ['packed', 'offsets', 'lengths', 'ids', 'primers', 'hashes', 'hash_order', 'lex_order']
+
+
+def encode_sequence(sequence):
+    '''Convert an ACGT sequence to a numpy array of 2 bit base codes
+
+    Parameters
+    ----------
+    sequence : str
+        the sequence (ACGT)
+
+    Returns
+    -------
+    numpy array of uint8
+        the code of each base (0-3 for A,C,G,T, 4 for any other character)
+    '''
+    return _BASE_CODES[np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)]
+
+
+def decode_sequence(codes):
+    '''Convert a numpy array of base codes (0-3) to a (lower case) sequence string
+
+    Parameters
+    ----------
+    codes : numpy array of uint8
+        the base codes (0-3 for A,C,G,T)
+
+    Returns
+    -------
+    str
+    '''
+    return _BASES[codes].tobytes().decode('ascii')
+
+
+def pack_codes(codes):
+    '''Pack base codes (0-3) into 4 bases per byte (first base in the high bits, padded with A)
+
+    Parameters
+    ----------
+    codes : numpy array of uint8
+        the base codes (0-3 for A,C,G,T)
+
+    Returns
+    -------
+    numpy array of uint8
+        the packed sequence (length is ceil(len(codes) / 4))
+    '''
+    pad = (-len(codes)) % 4
+    if pad:
+        codes = np.concatenate([codes, np.zeros(pad, dtype=np.uint8)])
+    codes = codes.reshape(-1, 4)
+    return (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+
+def unpack_codes(packed, length):
+    '''Unpack a packed sequence to base codes
+
+    Parameters
+    ----------
+    packed : numpy array of uint8
+        the packed sequence (see pack_codes())
+    length : int
+        the number of bases in the sequence
+
+    Returns
+    -------
+    numpy array of uint8
+        the base codes (0-3 for A,C,G,T)
+    '''
+    return ((packed[:, np.newaxis] >> _UNPACK_SHIFTS) & 3).ravel()[:length]
+
+
+def _get_powers(length):
+    '''Get the powers 0..length-1 of the hash base and of its inverse (mod 2^64)
+    '''
+    global _powers, _inv_powers
+
+    if len(_powers) < length:
+        cpowers = np.full(length, np.uint64(_HASH_BASE), dtype=np.uint64)
+        cpowers[0] = 1
+        cinv_powers = np.full(length, np.uint64(_HASH_BASE_INV), dtype=np.uint64)
+        cinv_powers[0] = 1
+        _powers = np.cumprod(cpowers, dtype=np.uint64)
+        _inv_powers = np.cumprod(cinv_powers, dtype=np.uint64)
+    return _powers[:length], _inv_powers[:length]
+
+
+def prefix_hashes(codes):
+    '''Get the hash of each prefix of a sequence
+
+    The hash of a sequence c_0..c_(L-1) is sum((c_t + 1) * B^(L-1-t)) mod 2^64
+
+    Parameters
+    ----------
+    codes : numpy array of uint8
+        the base codes of the sequence (0-3)
+
+    Returns
+    -------
+    numpy array of uint64
+        position i contains the hash of the first i bases (position 0 is 0)
+    '''
+    powers, inv_powers = _get_powers(len(codes) + 1)
+    cumulative = np.cumsum((codes.astype(np.uint64) + np.uint64(1)) * inv_powers[:len(codes)], dtype=np.uint64)
+    hashes = np.zeros(len(codes) + 1, dtype=np.uint64)
+    hashes[1:] = cumulative * powers[:len(codes)]
+    return hashes
+
+
+def window_hashes(codes, length):
+    '''Get the hash (same as prefix_hashes()) of each window of a given length in the sequence
+
+    Parameters
+    ----------
+    codes : numpy array of uint8
+        the base codes of the sequence (0-3)
+    length : int
+        the window length
+
+    Returns
+    -------
+    numpy array of uint64
+        position i contains the hash of the window starting at position i
+    '''
+    numwindows = len(codes) - length + 1
+    if numwindows < 1:
+        return np.zeros(0, dtype=np.uint64)
+    powers, inv_powers = _get_powers(len(codes))
+    cumulative = np.zeros(len(codes) + 1, dtype=np.uint64)
+    cumulative[1:] = np.cumsum((codes.astype(np.uint64) + np.uint64(1)) * inv_powers, dtype=np.uint64)
+    return (cumulative[length:] - cumulative[:numwindows]) * powers[length - 1:]
+
+
+class PackedSequenceStore:
+    '''Immutable 2-bit packed store of (id, sequence, idprimer).
+
+    Entries are ordered by id. All the arrays can be numpy memory-maps.
+    '''
+    def __init__(self, packed, offsets, lengths, ids, primers, hashes, hash_order, lex_order):
+        # the packed sequences (each starting on a byte boundary)
+        self.packed = packed
+        # the byte offset of each entry in packed (len is number of entries + 1)
+        self.offsets = offsets
+        # the sequence length (bases) of each entry
+        self.lengths = lengths
+        # the dbbact id of each entry (sorted)
+        self.ids = ids
+        # the idprimer of each entry
+        self.primers = primers
+        # the hash of each sequence (sorted) and the entry for each hash
+        self.hashes = hashes
+        self.hash_order = hash_order
+        # the entries sorted by sequence
+        self.lex_order = lex_order
+        # all the sequence lengths in the store
+        self.unique_lengths = np.unique(lengths)
+        self.last_id = int(ids[-1]) if len(ids) > 0 else 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_sequences(cls, ids, sequences, primers):
+        '''Build the store
+
+        Parameters
+        ----------
+        ids : list of int
+            the dbbact id of each sequence (sorted)
+        sequences : list of str
+            the sequences (lower case ACGT only)
+        primers : list of int
+            the idprimer of each sequence
+
+        Returns
+        -------
+        PackedSequenceStore
+        '''
+        lengths = np.array([len(x) for x in sequences], dtype=np.int32)
+        # pad each sequence to a byte boundary and pack them all at once
+        padded = ''.join([cseq + 'a' * ((-len(cseq)) % 4) for cseq in sequences])
+        packed = pack_codes(encode_sequence(padded))
+        numbytes = (lengths.astype(np.int64) + 3) // 4
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(numbytes)
+        hashes = np.array([prefix_hashes(encode_sequence(cseq))[-1] for cseq in sequences], dtype=np.uint64)
+        hash_order = np.argsort(hashes, kind='stable').astype(np.int32)
+        lex_order = np.array(sorted(range(len(sequences)), key=lambda x: sequences[x]), dtype=np.int32)
+        return cls(packed, offsets, lengths, np.array(ids, dtype=np.int32), np.array(primers, dtype=np.int32), hashes[hash_order], hash_order, lex_order)
+
+    @classmethod
+    def load(cls, prefix):
+        '''Load the store from the .npy files (memory-mapped)
+
+        Parameters
+        ----------
+        prefix : str
+            the store file name prefix (see save())
+        '''
+        debug(2, 'loading sequence store from %s' % prefix)
+        return cls(*[np.load('%s.%s.npy' % (prefix, cname), mmap_mode='r') for cname in _ARRAY_NAMES])
+
+    @staticmethod
+    def exists(prefix):
+        '''Check if the store files exist
+
+        Parameters
+        ----------
+        prefix : str
+            the store file name prefix (see save())
+        '''
+        return all([os.path.exists('%s.%s.npy' % (prefix, cname)) for cname in _ARRAY_NAMES])
+
+    def save(self, prefix):
+        '''Save the store as .npy files (prefix.packed.npy, prefix.offsets.npy etc.)
+
+        Parameters
+        ----------
+        prefix : str
+            the output file name prefix
+        '''
+        for cname in _ARRAY_NAMES:
+            np.save('%s.%s.npy' % (prefix, cname), getattr(self, cname))
+
+    def get_entry(self, seqid):
+        '''Get the entry index of a dbbact sequence id
+
+        Parameters
+        ----------
+        seqid : int
+
+        Returns
+        -------
+        int or None if the id is not in the store
+        '''
+        pos = int(np.searchsorted(self.ids, seqid))
+        if pos < len(self.ids) and self.ids[pos] == seqid:
+            return pos
+        return None
+
+    def get_codes(self, entry):
+        '''Get the base codes (0-3) of an entry
+        '''
+        return unpack_codes(self.packed[self.offsets[entry]:self.offsets[entry + 1]], self.lengths[entry])
+
+    def get_sequence(self, entry):
+        '''Get the sequence (lower case str) of an entry
+        '''
+        return decode_sequence(self.get_codes(entry))
+
+    def _compare_prefix(self, entry, qpacked, length):
+        '''Compare the first length bases of an entry with the packed query
+        Returns -1/0/1 if the entry prefix is smaller/equal/larger than the query prefix
+        '''
+        numbytes = (length + 3) // 4
+        cseq = self.packed[self.offsets[entry]:self.offsets[entry] + numbytes].tobytes()
+        cquery = qpacked[:numbytes].tobytes()
+        if length % 4:
+            mask = (0xFF << (8 - 2 * (length % 4))) & 0xFF
+            cseq = cseq[:-1] + bytes([cseq[-1] & mask])
+            cquery = cquery[:-1] + bytes([cquery[-1] & mask])
+        if cseq < cquery:
+            return -1
+        if cseq > cquery:
+            return 1
+        return 0
+
+    def _is_before(self, entry, qpacked, qlen):
+        '''True if the entry sequence is lexicographically smaller than the query and does not start with it
+        '''
+        clen = int(self.lengths[entry])
+        res = self._compare_prefix(entry, qpacked, min(clen, qlen))
+        if res != 0:
+            return res < 0
+        return clen < qlen
+
+    def lookup(self, codes, no_shorter=False, no_longer=False):
+        '''Get the entries matching the query: the entry sequence is a prefix of the query or the query is a prefix of it
+
+        Parameters
+        ----------
+        codes : numpy array of uint8
+            the query base codes (see encode_sequence())
+        no_shorter : bool (optional)
+            False (default) to enable shorter sequences matching the query, True to require at least length of query sequence
+        no_longer : bool (optional)
+            False (default) to enable longer sequences matching the query, True to require at most length of query sequence
+
+        Returns
+        -------
+        list of int
+            the matching entries
+        '''
+        matches = []
+        qlen = len(codes)
+        # only the ACGT prefix of the query can match a stored sequence
+        invalid = np.flatnonzero(codes > 3)
+        validlen = int(invalid[0]) if len(invalid) > 0 else qlen
+        # stored sequences which are a prefix of the query (including the query itself)
+        if no_shorter:
+            clengths = np.array([qlen]) if validlen == qlen else np.zeros(0, dtype=np.int64)
+        else:
+            clengths = self.unique_lengths[self.unique_lengths <= validlen]
+        if len(clengths) > 0:
+            qhashes = prefix_hashes(codes[:validlen])[clengths]
+            starts = np.searchsorted(self.hashes, qhashes, side='left')
+            ends = np.searchsorted(self.hashes, qhashes, side='right')
+            for cstart, cend in zip(starts.tolist(), ends.tolist()):
+                for centry in self.hash_order[cstart:cend].tolist():
+                    clen = int(self.lengths[centry])
+                    if clen <= validlen and np.array_equal(self.get_codes(centry), codes[:clen]):
+                        matches.append(centry)
+        # stored sequences starting with the query (and longer than it)
+        if not no_longer and validlen == qlen:
+            qpacked = pack_codes(codes)
+            low = 0
+            high = len(self.lex_order)
+            while low < high:
+                mid = (low + high) // 2
+                if self._is_before(self.lex_order[mid], qpacked, qlen):
+                    low = mid + 1
+                else:
+                    high = mid
+            while low < len(self.lex_order):
+                centry = int(self.lex_order[low])
+                if self.lengths[centry] < qlen or self._compare_prefix(centry, qpacked, qlen) != 0:
+                    break
+                if self.lengths[centry] > qlen:
+                    matches.append(centry)
+                low += 1
+        return matches
@@ -0,0 +1,240 @@
+'''Worker-resident index of the dbbact sequence taxonomies.
+
+Holds the taxonomy names of all the SequencesTable sequences (the taxrootrank ... taxgenus columns) in memory,
+so taxonomy searches (see dbsequences.get_taxonomy_seqids()) do not need a full scan of SequencesTable.
+Supports exact match (optionally for a given rank), prefix match (using a sorted list of the names)
+and substring match (using a trigram index of the names).
+
+The index (and the cached lookup results) are reloaded when the 'taxonomy' version in CacheVersionsTable changes
+(it is bumped by dbsequences.AddSequenceTax(), used by Update_Tax.py).
+'''
+
+import os
+import time
+import bisect
+from collections import defaultdict, OrderedDict
+
+import numpy as np
+import psycopg2
+
+from .utils import debug
+from . import dbversions
+
+# the taxonomic ranks searched (the SequencesTable column for each rank is 'tax' + rank)
+RANKS = ['rootrank', 'domain', 'phylum', 'class', 'order', 'family', 'genus']
+
+# the supported match types for lookup()
+MATCH_TYPES = ['exact', 'prefix', 'substring']
+
+# the name of the version counter in CacheVersionsTable
+VERSION_NAME = 'taxonomy'
+
+# minimal time (seconds) between two checks of the taxonomy version
+VERSION_CHECK_INTERVAL = 10
+
+# minimal time (seconds) between two reloads of the index (so a running Update_Tax.py does not cause constant reloads)
+RELOAD_INTERVAL = 300
+
+# maximal number of lookup results to cache
+MAX_CACHED_RESULTS = 1000
+
+# set the DBBACT_NO_TAX_INDEX environment variable to use the database for the taxonomy lookups
+USE_INDEX = 'DBBACT_NO_TAX_INDEX' not in os.environ
+
+# the per-worker index (created on first use by get_taxonomy_index())
+_index = None
+
+
+def get_trigrams(name):
+    '''Get the set of trigrams (3 character substrings) of a string
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    set of str
+    '''
+    return set(name[pos:pos + 3] for pos in range(len(name) - 2))
+
+
+class TaxonomyIndex:
+    '''In-memory index of the taxonomy names of the dbbact sequences
+    '''
+    def __init__(self):
+        # sorted list of all the (unique, lowercase) taxonomy names
+        self.names = []
+        # list (same order as names) of dict {rank(str): numpy array of sequence ids}
+        self.name_ids = []
+        # dict of {trigram(str): numpy array of positions in names}
+        self.trigrams = {}
+        # the taxonomy version (from CacheVersionsTable) of the loaded index
+        self.version = 0
+        self.last_load = 0
+        self.last_version_check = 0
+        # the cached lookup results - OrderedDict of {(taxonomy, rank, match): list of sequence ids}
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, con, cur):
+        '''Load all the taxonomies from the database (replacing the current index)
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        debug(2, 'loading taxonomy index')
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        # dict of {name: {rank: list of ids}}
+        name_ids = defaultdict(lambda: defaultdict(list))
+        cur.execute('SELECT id, %s FROM SequencesTable' % ', '.join(['tax' + crank for crank in RANKS]))
+        for cres in cur:
+            cid = cres[0]
+            for crank, cname in zip(RANKS, cres[1:]):
+                if cname is None or cname == '':
+                    continue
+                name_ids[cname.lower()][crank].append(cid)
+        self.__init__()
+        self.names = sorted(name_ids.keys())
+        for cname in self.names:
+            self.name_ids.append({crank: np.array(cids, dtype=np.int64) for crank, cids in name_ids[cname].items()})
+        trigrams = defaultdict(list)
+        for cpos, cname in enumerate(self.names):
+            for ctri in get_trigrams(cname):
+                trigrams[ctri].append(cpos)
+        self.trigrams = {ctri: np.array(cpos, dtype=np.int64) for ctri, cpos in trigrams.items()}
+        self.version = version
+        self.last_load = time.time()
+        self.last_version_check = self.last_load
+        debug(3, 'loaded taxonomy index. %d names, %d trigrams, version %d' % (len(self.names), len(self.trigrams), self.version))
+
+    def refresh(self, con, cur):
+        '''Reload the index if the taxonomy version in the database changed.
+        The version is checked at most once every VERSION_CHECK_INTERVAL seconds, and the index is reloaded
+        at most once every RELOAD_INTERVAL seconds.
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        ctime = time.time()
+        if ctime - self.last_version_check < VERSION_CHECK_INTERVAL:
+            return
+        if ctime - self.last_load < RELOAD_INTERVAL:
+            return
+        self.last_version_check = ctime
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        if version == self.version or version < 0:
+            return
+        debug(2, 'taxonomy version changed from %d to %d' % (self.version, version))
+        self.load(con, cur)
+
+    def _find_names(self, taxonomy, match):
+        '''Get the positions (in self.names) of the names matching the query
+
+        Parameters
+        ----------
+        taxonomy : str
+            the lowercase query
+        match : str
+            the match type (see lookup())
+
+        Returns
+        -------
+        list of int
+        '''
+        if match == 'exact':
+            pos = bisect.bisect_left(self.names, taxonomy)
+            if pos < len(self.names) and self.names[pos] == taxonomy:
+                return [pos]
+            return []
+        if match == 'prefix':
+            positions = []
+            pos = bisect.bisect_left(self.names, taxonomy)
+            while pos < len(self.names) and self.names[pos].startswith(taxonomy):
+                positions.append(pos)
+                pos += 1
+            return positions
+        # substring - the candidates are the names containing all the query trigrams
+        if len(taxonomy) < 3:
+            return [cpos for cpos, cname in enumerate(self.names) if taxonomy in cname]
+        candidates = None
+        for ctri in sorted(get_trigrams(taxonomy), key=lambda x: len(self.trigrams.get(x, []))):
+            if ctri not in self.trigrams:
+                return []
+            if candidates is None:
+                candidates = self.trigrams[ctri]
+            else:
+                candidates = np.intersect1d(candidates, self.trigrams[ctri], assume_unique=True)
+            if len(candidates) == 0:
+                return []
+        return [cpos for cpos in candidates.tolist() if taxonomy in self.names[cpos]]
+
+    def lookup(self, taxonomy, rank=None, match='exact'):
+        '''Get the ids of the sequences with a taxonomy name matching the query
+
+        Parameters
+        ----------
+        taxonomy : str
+            the taxonomy name to look for (case insensitive)
+        rank : str or None (optional)
+            None (default) to match the name in any rank, or one of RANKS to match only in this rank
+        match : str (optional)
+            'exact' (default) to match the whole name
+            'prefix' to match names starting with taxonomy
+            'substring' to match names containing taxonomy
+
+        Returns
+        -------
+        list of int
+            the ids of the matching sequences (sorted)
+        '''
+        taxonomy = taxonomy.lower()
+        ckey = (taxonomy, rank, match)
+        if ckey in self._results:
+            self._results.move_to_end(ckey)
+            return self._results[ckey]
+        idarrays = []
+        for cpos in self._find_names(taxonomy, match):
+            for crank, cids in self.name_ids[cpos].items():
+                if rank is None or crank == rank:
+                    idarrays.append(cids)
+        if len(idarrays) == 0:
+            seqids = []
+        else:
+            seqids = np.unique(np.concatenate(idarrays)).tolist()
+        self._results[ckey] = seqids
+        if len(self._results) > MAX_CACHED_RESULTS:
+            self._results.popitem(last=False)
+        return seqids
+
+
+def get_taxonomy_index(con, cur):
+    '''Get the worker taxonomy index (loading it on first use and reloading it if the taxonomy version changed)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    TaxonomyIndex or None if the index is disabled or could not be loaded
+    '''
+    global _index
+
+    if not USE_INDEX:
+        return None
+    try:
+        if _index is None:
+            cindex = TaxonomyIndex()
+            cindex.load(con, cur)
+            _index = cindex
+        else:
+            _index.refresh(con, cur)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when loading taxonomy index' % e)
+        return None
+    return _index
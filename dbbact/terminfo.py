@@ -0,0 +1,159 @@
+'''Worker-resident cache of the TermInfoTable term counts.
+
+Holds the number of experiments / annotations containing each term (see dbontology.get_term_counts()) in a dict keyed by term,
+so the counts for all the parent terms of the annotations (i.e. in dbannotations.GetFastAnnotations()) do not need a query per term.
+The single terms are loaded in bulk. Other terms (i.e. term pairs) are fetched on first use with one query per batch of missing terms,
+and then kept in the cache (including the terms not in TermInfoTable).
+
+The cache is cleared and reloaded when the 'terminfo' version in CacheVersionsTable changes
+(it is bumped by dbutils/add_term_info.py when rebuilding TermInfoTable).
+'''
+
+import os
+import time
+
+import psycopg2
+
+from .utils import debug
+from . import dbversions
+
+# the name of the version counter in CacheVersionsTable
+VERSION_NAME = 'terminfo'
+
+# minimal time (seconds) between two checks of the terminfo version
+VERSION_CHECK_INTERVAL = 10
+
+# maximal number of cached terms not found in TermInfoTable (the set is cleared when it gets larger)
+MAX_CACHED_MISSING = 100000
+
+# set the DBBACT_NO_TERM_INFO_CACHE environment variable to get the term counts from the database
+USE_CACHE = 'DBBACT_NO_TERM_INFO_CACHE' not in os.environ
+
+# the per-worker cache (created on first use by get_term_info_cache())
+_cache = None
+
+
+def fetch_term_counts(cur, terms):
+    '''Get the counts of terms from TermInfoTable
+
+    Parameters
+    ----------
+    cur : database cursor
+    terms : list of str
+
+    Returns
+    -------
+    dict of {term(str): (total_experiments(int), total_annotations(int))}
+        only for the terms found in TermInfoTable
+    '''
+    counts = {}
+    if len(terms) == 0:
+        return counts
+    cur.execute('SELECT term, TotalExperiments, TotalAnnotations FROM TermInfoTable WHERE term = ANY(%s)', [list(terms)])
+    for cterm, cexperiments, cannotations in cur:
+        counts.setdefault(cterm, (cexperiments, cannotations))
+    return counts
+
+
+class TermInfoCache:
+    '''In-memory cache of the TermInfoTable counts
+    '''
+    def __init__(self):
+        # dict of {term(str): (total_experiments(int), total_annotations(int))}
+        self.counts = {}
+        # set of the terms not in TermInfoTable
+        self.missing = set()
+        # the terminfo version (from CacheVersionsTable) of the loaded cache
+        self.version = 0
+        self.last_version_check = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def load(self, con, cur):
+        '''Load the single term counts from the database (replacing the current cache)
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        debug(2, 'loading term info cache')
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        counts = {}
+        cur.execute("SELECT term, TotalExperiments, TotalAnnotations FROM TermInfoTable WHERE TermType='single'")
+        for cterm, cexperiments, cannotations in cur:
+            counts.setdefault(cterm, (cexperiments, cannotations))
+        self.__init__()
+        self.counts = counts
+        self.version = version
+        self.last_version_check = time.time()
+        debug(3, 'loaded term info cache. %d terms, version %d' % (len(self.counts), self.version))
+
+    def refresh(self, con, cur):
+        '''Reload the cache if the terminfo version in the database changed.
+        The version is checked at most once every VERSION_CHECK_INTERVAL seconds.
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        ctime = time.time()
+        if ctime - self.last_version_check < VERSION_CHECK_INTERVAL:
+            return
+        self.last_version_check = ctime
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        if version == self.version or version < 0:
+            return
+        debug(2, 'terminfo version changed from %d to %d' % (self.version, version))
+        self.load(con, cur)
+
+    def get_counts(self, cur, terms):
+        '''Get the counts of terms, fetching the terms not in the cache from the database
+
+        Parameters
+        ----------
+        cur : database cursor
+        terms : list of str
+
+        Returns
+        -------
+        dict of {term(str): (total_experiments(int), total_annotations(int))}
+            only for the terms found in TermInfoTable
+        '''
+        unknown = [cterm for cterm in terms if cterm not in self.counts and cterm not in self.missing]
+        if len(unknown) > 0:
+            debug(1, 'fetching term info for %d terms not in cache' % len(unknown))
+            fetched = fetch_term_counts(cur, unknown)
+            self.counts.update(fetched)
+            if len(self.missing) + len(unknown) > MAX_CACHED_MISSING:
+                self.missing.clear()
+            self.missing.update(cterm for cterm in unknown if cterm not in fetched)
+        return {cterm: self.counts[cterm] for cterm in terms if cterm in self.counts}
+
+
+def get_term_info_cache(con, cur):
+    '''Get the worker term info cache (loading it on first use and reloading it if the terminfo version changed)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    TermInfoCache or None if the cache is disabled or could not be loaded
+    '''
+    global _cache
+
+    if not USE_CACHE:
+        return None
+    try:
+        if _cache is None:
+            ccache = TermInfoCache()
+            ccache.load(con, cur)
+            _cache = ccache
+        else:
+            _cache.refresh(con, cur)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when loading term info cache' % e)
+        return None
+    return _cache
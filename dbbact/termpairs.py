@@ -0,0 +1,188 @@
+'''Worker-resident index of the TermPairsTable counts.
+
+Holds the term pair counts (see dbontology.get_term_pairs_count()) as two parallel numpy arrays:
+a sorted array of the 64 bit hashes of the term pairs and the matching counts, so a batch of pairs
+is looked up with one numpy.searchsorted() call instead of a query per pair.
+The hash is the first 8 bytes of the blake2b digest of the pair string. With 64 bit hashes the chance of a collision
+(returning the count of another pair) is negligible for any realistic number of pairs.
+
+The index is reloaded when the 'termpairs' version in CacheVersionsTable changes
+(processes rebuilding TermPairsTable should bump it using dbversions.bump_version()).
+Since TermPairsTable can also be rebuilt without bumping the version, the row count and maximal ctid of the table
+are checked every STALE_CHECK_INTERVAL seconds, and the index is reloaded if they changed.
+'''
+
+import os
+import time
+import hashlib
+
+import numpy as np
+import psycopg2
+
+from .utils import debug
+from . import dbversions
+
+# the name of the version counter in CacheVersionsTable
+VERSION_NAME = 'termpairs'
+
+# minimal time (seconds) between two checks of the termpairs version
+VERSION_CHECK_INTERVAL = 10
+
+# minimal time (seconds) between two checks of the TermPairsTable row count / maximal ctid
+STALE_CHECK_INTERVAL = 300
+
+# set the DBBACT_NO_TERM_PAIR_INDEX environment variable to get the term pair counts from the database
+USE_INDEX = 'DBBACT_NO_TERM_PAIR_INDEX' not in os.environ
+
+# the per-worker index (created on first use by get_term_pair_index())
+_index = None
+
+
+def pair_hash(term_pair):
+    '''Get the 64 bit hash of a term pair
+
+    Parameters
+    ----------
+    term_pair : str
+        the term pair (i.e. 'feces+homo sapiens')
+
+    Returns
+    -------
+    int
+    '''
+    return int.from_bytes(hashlib.blake2b(term_pair.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def get_table_state(cur):
+    '''Get the row count and maximal ctid of TermPairsTable (to detect changes to the table)
+
+    Parameters
+    ----------
+    cur : database cursor
+
+    Returns
+    -------
+    tuple of (int, str)
+        the number of rows and the maximal ctid (None if the table is empty)
+    '''
+    # ctid has no max() aggregate - take the maximal one using the ctid ordering
+    cur.execute('SELECT COUNT(*), (SELECT ctid FROM TermPairsTable ORDER BY ctid DESC LIMIT 1) FROM TermPairsTable')
+    count, ctid = cur.fetchone()
+    return count, None if ctid is None else str(ctid)
+
+
+class TermPairIndex:
+    '''In-memory index of the term pair counts
+    '''
+    def __init__(self):
+        # sorted numpy array (uint64) of the term pair hashes
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        # numpy array (same order as hashes) of the counts
+        self.counts = np.zeros(0)
+        # the termpairs version (from CacheVersionsTable) of the loaded index
+        self.version = 0
+        self.last_version_check = 0
+        # the (row count, maximal ctid) of TermPairsTable when the index was loaded
+        self.table_state = None
+        self.last_stale_check = 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def load(self, con, cur):
+        '''Load all the term pair counts from the database (replacing the current index)
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        debug(2, 'loading term pair index')
+        version = dbversions.get_version(con, cur, VERSION_NAME)
+        table_state = get_table_state(cur)
+        cur.execute('SELECT TermPair, AnnotationCount FROM TermPairsTable')
+        res = cur.fetchall()
+        hashes = np.fromiter((pair_hash(cres[0]) for cres in res), dtype=np.uint64, count=len(res))
+        counts = np.array([cres[1] for cres in res])
+        # stable sort so a pair appearing more than once gets the count of its first row
+        order = np.argsort(hashes, kind='stable')
+        self.__init__()
+        self.hashes = hashes[order]
+        if len(res) > 0:
+            self.counts = counts[order]
+        self.version = version
+        self.table_state = table_state
+        self.last_version_check = time.time()
+        self.last_stale_check = self.last_version_check
+        debug(3, 'loaded term pair index. %d pairs, version %d' % (len(self.hashes), self.version))
+
+    def refresh(self, con, cur):
+        '''Reload the index if the termpairs version in the database changed, or if TermPairsTable changed.
+        The version is checked at most once every VERSION_CHECK_INTERVAL seconds,
+        and the TermPairsTable row count / maximal ctid at most once every STALE_CHECK_INTERVAL seconds.
+
+        Parameters
+        ----------
+        con, cur
+        '''
+        ctime = time.time()
+        if ctime - self.last_version_check >= VERSION_CHECK_INTERVAL:
+            self.last_version_check = ctime
+            version = dbversions.get_version(con, cur, VERSION_NAME)
+            if version >= 0 and version != self.version:
+                debug(2, 'termpairs version changed from %d to %d' % (self.version, version))
+                self.load(con, cur)
+                return
+        if ctime - self.last_stale_check >= STALE_CHECK_INTERVAL:
+            self.last_stale_check = ctime
+            table_state = get_table_state(cur)
+            if table_state != self.table_state:
+                debug(2, 'TermPairsTable changed from %s to %s' % (self.table_state, table_state))
+                self.load(con, cur)
+
+    def lookup(self, term_pairs):
+        '''Get the counts of term pairs
+
+        Parameters
+        ----------
+        term_pairs : list of str
+
+        Returns
+        -------
+        list
+            the count of each term pair (same order as term_pairs), 0 for pairs not in the index
+        '''
+        if len(term_pairs) == 0 or len(self.hashes) == 0:
+            return [0] * len(term_pairs)
+        query = np.fromiter((pair_hash(cpair) for cpair in term_pairs), dtype=np.uint64, count=len(term_pairs))
+        pos = np.searchsorted(self.hashes, query)
+        pos[pos == len(self.hashes)] = 0
+        found = self.hashes[pos] == query
+        return np.where(found, self.counts[pos], 0).tolist()
+
+
+def get_term_pair_index(con, cur):
+    '''Get the worker term pair index (loading it on first use and reloading it if the termpairs version changed)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    TermPairIndex or None if the index is disabled or could not be loaded
+    '''
+    global _index
+
+    if not USE_INDEX:
+        return None
+    try:
+        if _index is None:
+            cindex = TermPairIndex()
+            cindex.load(con, cur)
+            _index = cindex
+        else:
+            _index.refresh(con, cur)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s when loading term pair index' % e)
+        return None
+    return _index
@@ -0,0 +1,16 @@
+from unittest import TestCase, main
+
+from dbbact import dbsequences
+
+
+class DbSequencesTests(TestCase):
+    def test_get_exact_distances(self):
+        # the distances returned by /sequences/get_fast_annotations for hashes with max_mismatches
+        self.assertEqual(dbsequences.get_exact_distances([[1], [], [2, 3]]), [0, None, 0])
+
+    def test_get_exact_distances_empty(self):
+        self.assertEqual(dbsequences.get_exact_distances([]), [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+from unittest import TestCase, main
+
+import numpy as np
+
+from dbbact import kmerindex
+from dbbact.seqstore import encode_sequence
+
+
+class FakeSequenceIndex:
+    '''Minimal stand-in for seqindex.SequenceIndex (only get_codes() is used by the kmer index lookups)
+    '''
+    def __init__(self, sequences, primer=1):
+        self.sequences = {cid: encode_sequence(cseq) for cid, cseq in sequences.items()}
+        self.primer = primer
+
+    def get_codes(self, seqid):
+        if seqid not in self.sequences:
+            return None, None
+        return self.sequences[seqid], self.primer
+
+
+class KmerIndexTests(TestCase):
+    def setUp(self):
+        rand = np.random.RandomState(2019)
+        self.seqs = {cid: ''.join(rand.choice(list('acgt'), 150)) for cid in range(1, 6)}
+        hashes, ids, positions = kmerindex.build_arrays([(cid, encode_sequence(cseq)) for cid, cseq in self.seqs.items()])
+        self.kindex = kmerindex.KmerIndex(hashes, ids, positions)
+        self.index = FakeSequenceIndex(self.seqs)
+
+    def test_get_minimizers(self):
+        hashes, positions = kmerindex.get_minimizers(encode_sequence(self.seqs[1]))
+        self.assertTrue(len(hashes) > 0)
+        self.assertEqual(len(hashes), len(positions))
+        # every window of WINDOW_LEN k-mers contains a minimizer
+        self.assertTrue(np.all(np.diff(positions) <= kmerindex.WINDOW_LEN))
+
+    def test_get_minimizers_no_valid_kmers(self):
+        hashes, positions = kmerindex.get_minimizers(encode_sequence('n' * 150))
+        self.assertEqual(len(hashes), 0)
+        self.assertEqual(len(positions), 0)
+
+    def test_get_candidates(self):
+        ids, diagonals = self.kindex.get_candidates(encode_sequence(self.seqs[3][20:120]))
+        self.assertIn(3, ids.tolist())
+        self.assertEqual(diagonals[ids == 3].tolist(), [20])
+
+    def test_get_candidates_no_minimizers(self):
+        for cseq in ['n' * 150, 'acgt' + 'n' * 146]:
+            ids, diagonals = self.kindex.get_candidates(encode_sequence(cseq))
+            self.assertEqual(len(ids), 0)
+            self.assertEqual(len(diagonals), 0)
+
+    def test_get_candidates_empty_index(self):
+        ids, diagonals = kmerindex.KmerIndex().get_candidates(encode_sequence(self.seqs[1]))
+        self.assertEqual(len(ids), 0)
+
+    def test_find(self):
+        # exact, shorter, and offset-trimmed queries
+        self.assertEqual(self.kindex.find(self.seqs[2], self.index), [2])
+        self.assertEqual(self.kindex.find(self.seqs[2][:100], self.index), [2])
+        self.assertEqual(self.kindex.find(self.seqs[2][30:], self.index, min_overlap=100), [2])
+
+    def test_find_not_found(self):
+        seq = self.seqs[4][:50] + ('a' if self.seqs[4][50] != 'a' else 'c') + self.seqs[4][51:]
+        self.assertEqual(self.kindex.find(seq, self.index), [])
+        self.assertEqual(self.kindex.find(self.seqs[1][:10], self.index), [])
+
+    def test_find_no_minimizers(self):
+        self.assertEqual(self.kindex.find('n' * 150, self.index), [])
+        self.assertEqual(self.kindex.find('acgt' + 'n' * 146, self.index), [])
+
+    def test_find_idprimer(self):
+        self.assertEqual(self.kindex.find(self.seqs[2], self.index, idprimer=2), [])
+
+    def test_find_approx(self):
+        seq = list(self.seqs[4])
+        for cpos in [40, 90]:
+            seq[cpos] = 'a' if seq[cpos] != 'a' else 'c'
+        seq = ''.join(seq)
+        self.assertEqual(self.kindex.find_approx(seq, self.index, 2), ([4], 2))
+        self.assertEqual(self.kindex.find_approx(seq, self.index, 1), ([], None))
+        self.assertEqual(self.kindex.find_approx(self.seqs[4][10:], self.index, 2), ([4], 0))
+
+    def test_find_approx_no_minimizers(self):
+        self.assertEqual(self.kindex.find_approx('n' * 150, self.index, 3), ([], None))
+        self.assertEqual(self.kindex.find_approx('acgt' + 'n' * 146, self.index, 3), ([], None))
+
+    def test_hamming_distances(self):
+        qcodes = encode_sequence('acgtn')
+        dbseqs = [encode_sequence('acgta'), encode_sequence('ttacgt')]
+        mismatches, overlaps = kmerindex.hamming_distances(qcodes, dbseqs, np.array([0, 2]))
+        # the non-ACGT query base is a mismatch
+        self.assertEqual(mismatches.tolist(), [1, 0])
+        self.assertEqual(overlaps.tolist(), [5, 4])
+
+
+if __name__ == '__main__':
+    main()
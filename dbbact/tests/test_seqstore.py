@@ -0,0 +1,74 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from dbbact import seqstore
+
+
+class SeqStoreTests(TestCase):
+    def setUp(self):
+        self.ids = [1, 2, 5, 7]
+        self.seqs = ['acgtacgtac', 'acgtacgtacgg', 'ttgacca', 'acgtacgtacggtt']
+        self.primers = [1, 1, 2, 1]
+        self.store = seqstore.PackedSequenceStore.from_sequences(self.ids, self.seqs, self.primers)
+
+    def test_encode_decode(self):
+        codes = seqstore.encode_sequence('ACgtN')
+        npt.assert_array_equal(codes, [0, 1, 2, 3, 4])
+        self.assertEqual(seqstore.decode_sequence(codes[:4]), 'acgt')
+
+    def test_pack_unpack(self):
+        codes = seqstore.encode_sequence('acgtacgtacg')
+        packed = seqstore.pack_codes(seqstore.encode_sequence('acgtacgtacga'))
+        npt.assert_array_equal(seqstore.unpack_codes(packed, len(codes)), codes)
+
+    def test_window_hashes(self):
+        codes = seqstore.encode_sequence('acgtacgtacggtt')
+        prefix = seqstore.prefix_hashes(codes)
+        windows = seqstore.window_hashes(codes, 4)
+        self.assertEqual(len(windows), len(codes) - 3)
+        # the window hash equals the hash of the window sequence
+        for cpos in range(len(windows)):
+            self.assertEqual(windows[cpos], seqstore.prefix_hashes(codes[cpos:cpos + 4])[-1])
+        self.assertEqual(windows[0], prefix[4])
+        self.assertEqual(len(seqstore.window_hashes(codes, 20)), 0)
+
+    def test_hash_base_inverse(self):
+        self.assertEqual((seqstore._HASH_BASE * seqstore._HASH_BASE_INV) % 2 ** 64, 1)
+
+    def test_get_entry(self):
+        for cpos, cid in enumerate(self.ids):
+            centry = self.store.get_entry(cid)
+            self.assertEqual(self.store.get_sequence(centry), self.seqs[cpos])
+        self.assertIsNone(self.store.get_entry(3))
+
+    def test_lookup(self):
+        res = self.store.lookup(seqstore.encode_sequence('acgtacgtacgg'))
+        self.assertEqual(sorted(self.store.ids[res].tolist()), [1, 2, 7])
+        res = self.store.lookup(seqstore.encode_sequence('acgtacgtacgg'), no_shorter=True)
+        self.assertEqual(sorted(self.store.ids[res].tolist()), [2, 7])
+        res = self.store.lookup(seqstore.encode_sequence('acgtacgtacgg'), no_longer=True)
+        self.assertEqual(sorted(self.store.ids[res].tolist()), [1, 2])
+        res = self.store.lookup(seqstore.encode_sequence('gggg'))
+        self.assertEqual(len(res), 0)
+
+    def test_lookup_non_acgt(self):
+        # only the ACGT prefix of the query can match
+        res = self.store.lookup(seqstore.encode_sequence('acgtacgtacnn'))
+        self.assertEqual(sorted(self.store.ids[res].tolist()), [1])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prefix = os.path.join(tmpdir, 'store')
+            self.store.save(prefix)
+            self.assertTrue(seqstore.PackedSequenceStore.exists(prefix))
+            loaded = seqstore.PackedSequenceStore.load(prefix)
+            for centry in range(len(self.ids)):
+                self.assertEqual(loaded.get_sequence(centry), self.seqs[centry])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import sys
+import json
 import smtplib
 import random
 import string
@@ -84,6 +85,26 @@ def tolist(data):
     return data
 
 
+def stream_ndjson(items):
+    """
+    generate a newline delimited json (one json object per line) response from an iterable (for streaming flask responses)
+
+    input:
+    items : iterable
+        the (json serializable) items to return
+
+    output:
+    yields str
+        the json line for each item. if an exception is encountered, yields a last line with {"error": str}
+    """
+    try:
+        for citem in items:
+            yield json.dumps(citem) + '\n'
+    except Exception as e:
+        debug(7, 'error encountered while streaming response: %s' % e)
+        yield json.dumps({'error': str(e)}) + '\n'
+
+
 def send_email(user, pwd, recipient, subject, body):
     import os
 
@@ -20,8 +20,8 @@ classifiers = [
     'Topic :: Scientific/Engineering :: Bio-Informatics',
     'Programming Language :: Python',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.5',
-    'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.7',
+    'Programming Language :: Python :: 3.8',
     'Operating System :: Unix',
     'Operating System :: POSIX',
     'Operating System :: MacOS :: MacOS X',
@@ -46,6 +46,8 @@ setup(name='dbbact',
       maintainer="dbbact development team",
       url='https://github.com/amnona/supercooldb',
       packages=find_packages(),
+      python_requires='>=3.7',
+      install_requires=['numpy>=1.20'],
       # package_data={'dbbact': ['log.cfg']},
       # install_requires=[
       #     'calour'],